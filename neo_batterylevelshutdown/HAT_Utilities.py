@@ -10,7 +10,6 @@
 """
 import os
 import logging
-from luma.core import cmdline, error  # pylint: disable=import-error
 
 
 def GetReleaseVersion():
@@ -23,19 +22,31 @@ def GetReleaseVersion():
     return "unknown"
 
 
+# luma's argument parser is slow to build, so it and the parsed arguments are
+#  kept for subsequent get_device calls
+_device_parser_args = None
+
+
 def get_device(actual_args=None):
     """
     Create device from command-line arguments and return it.
     """
-    parser = cmdline.create_parser(description='luma.examples arguments')
-    # We only every use i2c-port 0. We may be able to define this in a nicer
-    #  way... but this is ok for the moment
-    args = parser.parse_args(['--i2c-port', '0'])
+    # luma is imported here rather than at module level so that modules that
+    #  only need GetReleaseVersion don't pay for importing it
+    from luma.core import cmdline, error  # pylint: disable=import-error
+    global _device_parser_args  # pylint: disable=global-statement
+    if _device_parser_args is None or actual_args:
+        parser = cmdline.create_parser(description='luma.examples arguments')
+        # We only every use i2c-port 0. We may be able to define this in a
+        #  nicer way... but this is ok for the moment
+        args = parser.parse_args(['--i2c-port', '0'])
 
-    if args.config:
-        # load config from file
-        config = cmdline.load_config(args.config)
-        args = parser.parse_args(config + actual_args)
+        if args.config:
+            # load config from file
+            config = cmdline.load_config(args.config)
+            args = parser.parse_args(config + actual_args)
+        _device_parser_args = (parser, args)
+    parser, args = _device_parser_args
 
     # create device
     try:
@@ -53,6 +64,7 @@ def display_settings(args):
     Display a short summary of the settings.
     :rtype: str
     """
+    from luma.core import cmdline  # pylint: disable=import-error
     iface = ''
     display_types = cmdline.get_display_types()
     if args.display not in display_types['emulator']:
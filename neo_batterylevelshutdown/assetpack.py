@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+The PNG assets, pre-converted to what the SSD1306 is sent
+
+Decoding a PNG, compositing it against white and converting it to 1-bit
+is the same work every time, so it's done once when the package is built
+(see setup.py, or run this module to do it by hand). Each asset is stored
+binarised and packed in SSD1306 page layout (Bitmap.toPages) in a single
+file alongside the PNGs, which is memory mapped when first needed. A page
+that shows an asset unchanged can then be pushed without PIL at all (see
+framebuffer.showAsset) and backgrounds are unpacked without decoding.
+
+The file starts with FORMAT_VERSION. A pack built by a different version
+of this module is ignored (the PNGs are used instead) until it's rebuilt.
+"""
+
+import glob
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from .framebuffer import ASSETS_PATH, Bitmap
+
+FORMAT_VERSION = 1
+PACK_NAME = 'assets.pack'
+PACK_PATH = os.path.join(ASSETS_PATH, PACK_NAME)
+
+_MAGIC = b'CBAP'
+# magic, format version, asset count
+_HEADER = struct.Struct('<4sHH')
+# name (ASCII, NUL padded), width, height, offset of the data in the file
+_ENTRY = struct.Struct('<32sHHI')
+
+
+def pageBytes(width, height):
+    return width * ((height + 7) // 8)
+
+
+def writePack(path, bitmaps):
+    """Write a pack of bitmaps ({asset name: Bitmap}) to path"""
+    names = sorted(bitmaps)
+    offset = _HEADER.size + _ENTRY.size * len(names)
+    index = [_HEADER.pack(_MAGIC, FORMAT_VERSION, len(names))]
+    data = []
+    for name in names:
+        bitmap = bitmaps[name]
+        index.append(_ENTRY.pack(name.encode('ascii'), bitmap.width,
+                                 bitmap.height, offset))
+        pages = bitmap.toPages()
+        data.append(pages)
+        offset += len(pages)
+    # Written to the side and renamed, so a running daemon never maps half
+    #  a file
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(b''.join(index + data))
+    os.replace(tmpPath, path)
+
+
+def packAssets(assetsPath=ASSETS_PATH, path=None):
+    """Convert every assetsPath/*.png and write the pack. Needs PIL"""
+    from PIL import Image
+    from .framebuffer import binarise
+    bitmaps = {}
+    for pngPath in sorted(glob.glob(os.path.join(assetsPath, '*.png'))):
+        with Image.open(pngPath) as image:
+            bitmaps[os.path.basename(pngPath)] = binarise(image)
+    path = os.path.join(assetsPath, PACK_NAME) if path is None else path
+    writePack(path, bitmaps)
+    return len(bitmaps)
+
+
+class AssetPack:
+
+    def __init__(self, data):
+        """data is the pack's contents (usually an mmap)"""
+        self._data = data
+        # name -> (width, height, offset)
+        self._index = {}
+        magic, version, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != FORMAT_VERSION:
+            raise ValueError("asset pack is format %s, not %s" %
+                             (version, FORMAT_VERSION))
+        for i in range(count):
+            name, width, height, offset = _ENTRY.unpack_from(
+                data, _HEADER.size + i * _ENTRY.size)
+            if offset + pageBytes(width, height) > len(data):
+                raise ValueError("asset pack is truncated")
+            self._index[name.rstrip(b'\0').decode('ascii')] = \
+                (width, height, offset)
+
+    @classmethod
+    def open(cls, path=PACK_PATH):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def names(self):
+        return sorted(self._index)
+
+    def get(self, name):
+        """(width, height, page layout data) for name, or None"""
+        try:
+            width, height, offset = self._index[name]
+        except KeyError:
+            return None
+        return width, height, memoryview(self._data)[
+            offset:offset + pageBytes(width, height)]
+
+    def bitmap(self, name):
+        """name as a Bitmap, or None"""
+        entry = self.get(name)
+        return None if entry is None else Bitmap.fromPages(*entry)
+
+
+_packLock = threading.Lock()
+# The installed pack, or False if there isn't a usable one
+_pack = None
+
+
+def installed():
+    """The pack next to the PNGs, or None if it's missing or stale"""
+    global _pack  # pylint: disable=global-statement
+    with _packLock:
+        if _pack is None:
+            try:
+                _pack = AssetPack.open()
+            except FileNotFoundError:
+                logging.info("No asset pack; using the PNGs")
+                _pack = False
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning("Ignoring asset pack %s (%s); run "
+                                "python -m neo_batterylevelshutdown.assetpack "
+                                "to rebuild it", PACK_PATH, e)
+                _pack = False
+        return _pack or None
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    path = args[0] if args else None
+    count = packAssets(path=path)
+    print("Packed %d assets (format %d) into %s" %
+          (count, FORMAT_VERSION, path or PACK_PATH))
+
+
+if __name__ == "__main__":
+    main()
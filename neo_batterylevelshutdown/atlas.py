@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pre-rasterised glyphs for a font at one size, kept on disk between runs
+
+Almost everything the pages write is printable ASCII (digits, %, C, "Up:",
+"Tx:"/"Rx:", stats filenames) so those glyphs are rasterised together the
+first time a (font, size) is used and saved in the state directory. Later
+runs load them with a single read instead of starting FreeType at all.
+framebuffer.Font rasterises anything else on demand.
+
+The file records the format version and the font file's size and
+modification time; a mismatch (a new font, or a new version of this
+module) means the atlas is rebuilt.
+"""
+
+import logging
+import os
+import struct
+
+from .framebuffer import Bitmap
+from .hardware import statePath
+
+ATLAS_CHARS = ''.join(chr(code) for code in range(0x20, 0x7F))
+
+
+class GlyphAtlas:
+
+    _MAGIC = b'CBGA'
+    _VERSION = 1
+    # magic, version, size, font mtime (ns), font size (bytes), glyph count
+    _HEADER = struct.Struct('<4sHHqqH')
+    # code point, width, height, advance
+    _GLYPH = struct.Struct('<HBBB')
+
+    def __init__(self, fontPath, size, glyphs):
+        self.fontPath = fontPath
+        self.size = size
+        # char -> (mask Bitmap, advance), as framebuffer.Font keeps them
+        self.glyphs = glyphs
+
+    @classmethod
+    def build(cls, fontPath, size, rasterise, chars=ATLAS_CHARS):
+        """Rasterise chars with rasterise(char) -> (mask, advance)"""
+        return cls(fontPath, size, {char: rasterise(char) for char in chars})
+
+    @staticmethod
+    def _fontStamp(fontPath):
+        stat = os.stat(fontPath)
+        return stat.st_mtime_ns, stat.st_size
+
+    def serialise(self):
+        mtime, fontBytes = self._fontStamp(self.fontPath)
+        parts = [self._HEADER.pack(self._MAGIC, self._VERSION, self.size,
+                                   mtime, fontBytes, len(self.glyphs))]
+        for char, (mask, advance) in sorted(self.glyphs.items()):
+            parts.append(self._GLYPH.pack(ord(char), mask.width, mask.height,
+                                          advance))
+            parts.append(mask.toBytes())
+        return b''.join(parts)
+
+    @classmethod
+    def deserialise(cls, blob, fontPath, size):
+        """The atlas in blob, or None if it's for another font or version"""
+        try:
+            magic, version, blobSize, mtime, fontBytes, count = \
+                cls._HEADER.unpack_from(blob)
+        except struct.error:
+            return None
+        if magic != cls._MAGIC or version != cls._VERSION or \
+                blobSize != size or \
+                (mtime, fontBytes) != cls._fontStamp(fontPath):
+            return None
+        glyphs = {}
+        offset = cls._HEADER.size
+        try:
+            for _ in range(count):
+                code, width, height, advance = \
+                    cls._GLYPH.unpack_from(blob, offset)
+                offset += cls._GLYPH.size
+                length = (width + 7) // 8 * height
+                if offset + length > len(blob):
+                    return None
+                glyphs[chr(code)] = (
+                    Bitmap.fromBytes(width, height,
+                                     blob[offset:offset + length]),
+                    advance)
+                offset += length
+        except struct.error:
+            return None
+        return cls(fontPath, size, glyphs)
+
+    @staticmethod
+    def cachePath(fontPath, size):
+        """Where the atlas for (font, size) is kept, or None"""
+        name = os.path.splitext(os.path.basename(fontPath))[0]
+        return statePath('glyphs-%s-%d.bin' % (name, size))
+
+    def save(self, path):
+        # Written to the side and renamed, so a crash can't leave half a file
+        tmpPath = path + '.tmp'
+        try:
+            with open(tmpPath, 'wb') as f:
+                f.write(self.serialise())
+            os.replace(tmpPath, path)
+        except OSError as e:
+            logging.warning("Unable to save glyph atlas %s: %s", path, e)
+
+
+def load(fontPath, size, rasterise):
+    """The atlas for (font, size) from disk, building and saving if need be"""
+    path = GlyphAtlas.cachePath(fontPath, size)
+    if path is not None:
+        try:
+            with open(path, 'rb') as f:
+                atlas = GlyphAtlas.deserialise(f.read(), fontPath, size)
+            if atlas is not None:
+                return atlas
+            logging.info("Glyph atlas %s is out of date", path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Unable to read glyph atlas %s: %s", path, e)
+    atlas = GlyphAtlas.build(fontPath, size, rasterise)
+    if path is not None:
+        atlas.save(path)
+    return atlas
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+"""
+Display backends: what the pages' frames are sent to
+
+Pages are laid out for a 128x64 panel (the size of the assets) and push
+1-bit frames with framebuffer.show/showAsset. The device that OLED gives
+them is a DisplayBackend, which presents that logical 128x64 mode '1'
+surface whatever the panel, scales each frame up by the largest whole
+factor that fits, centres it and sends it on in the panel's own way. So a
+new display needs a backend, not changes to the pages.
+
+Backends are registered by name with register() and chosen with the
+displayBackend setting. 'auto' tries each backend registered with
+autodetect=True in turn (just the SSD1306 on I2C, as before).
+
+Each backend has its own render cache of the panel-ready forms (page
+layout data, luma images, e-paper buffers) of the frames it was last sent,
+so a page shown again (a static page, or a status page whose values
+haven't changed) costs no conversion. A frame that's the same as the one
+on the panel isn't sent at all.
+
+E-paper is slow to refresh, and ghosts after too many partial refreshes,
+so EPaperBackend refreshes through a RefreshScheduler: refreshes are at
+least epaperMinRefreshSecs apart, with the frames in between coalesced,
+and are partial unless a full refresh is due or most of the panel changed.
+"""
+
+from collections import OrderedDict
+import importlib
+import logging
+import shlex
+import threading
+
+from . import config
+from . import framebuffer
+from . import telemetry
+from .framebuffer import BLACK, WHITE, FrameBuffer
+from .hardware import clock, shared, sharedDisplayDevice
+
+LOGICAL_WIDTH = 128
+LOGICAL_HEIGHT = 64
+
+# name -> (factory, autodetect). factory() returns a DisplayBackend or
+#  raises OSError if its display isn't there
+_registry = OrderedDict()
+
+
+def register(name, factory, autodetect=False):
+    """Make factory available as the display backend called name"""
+    _registry[name] = (factory, autodetect)
+
+
+def names():
+    return list(_registry)
+
+
+def create(name):
+    """A new backend called name; OSError if its display isn't there"""
+    if name == 'auto':
+        for candidate, (factory, autodetect) in _registry.items():
+            if not autodetect:
+                continue
+            try:
+                return factory()
+            except OSError as e:
+                logging.debug("No %s display: %s", candidate, e)
+        raise OSError("no display detected")
+    try:
+        factory, _ = _registry[name]
+    except KeyError:
+        raise OSError("unknown display backend %r (known: %s)" %
+                      (name, ', '.join(names())))
+    return factory()
+
+
+def sharedBackend(name=None):
+    """
+    The backend for the display, created on the first call only
+
+    name defaults to the displayBackend setting. Raises OSError if there's
+    no display, on every call, without probing again.
+    """
+    name = config.current().displayBackend if name is None else name
+    return shared('displayBackend', lambda: create(name))
+
+
+class DisplayBackend:
+    """A panel that shows the pages' frames, scaled to fit"""
+
+    name = None
+    # What the pages see (see framebuffer.blank)
+    width = LOGICAL_WIDTH
+    height = LOGICAL_HEIGHT
+    mode = '1'
+    # The colour around frames that don't fill the panel
+    borderColor = BLACK
+    RENDER_CACHE_SIZE = 8
+
+    def __init__(self, panelWidth, panelHeight):
+        self.panelWidth = panelWidth
+        self.panelHeight = panelHeight
+        self.scale = max(1, min(panelWidth // LOGICAL_WIDTH,
+                                panelHeight // LOGICAL_HEIGHT))
+        self.offset = ((panelWidth - LOGICAL_WIDTH * self.scale) // 2,
+                       (panelHeight - LOGICAL_HEIGHT * self.scale) // 2)
+        # Logical frame rows -> what render() made of them, oldest first
+        self._renderCache = OrderedDict()
+        self._shownRows = None
+        self._lock = threading.Lock()
+        # Called with each logical frame sent (see mirror.py)
+        self.listeners = []
+        self._skipped = telemetry.counter(
+            'connectbox_display_frames_skipped',
+            'Frames not sent because the display already showed them')
+
+    def layout(self, frame):
+        """frame scaled and placed on a panel sized FrameBuffer"""
+        if self.scale == 1 and self.offset == (0, 0) and \
+                (frame.width, frame.height) == (self.panelWidth,
+                                                self.panelHeight):
+            return frame
+        panelFrame = FrameBuffer(self.panelWidth, self.panelHeight)
+        panelFrame.fill(self.borderColor)
+        panelFrame.paste(frame.scaled(self.scale), *self.offset)
+        return panelFrame
+
+    def dirtyBox(self, rows):
+        """
+        The panel box (x0, y0, x1, y1) that differs between the frame shown
+        and one with rows, or None if they're the same
+        """
+        if self._shownRows is None:
+            return 0, 0, self.panelWidth - 1, self.panelHeight - 1
+        changed = [y for y, (old, new)
+                   in enumerate(zip(self._shownRows, rows))
+                   if old != new]
+        if not changed:
+            return None
+        diff = 0
+        for y in changed:
+            diff |= self._shownRows[y] ^ rows[y]
+        x0 = LOGICAL_WIDTH - diff.bit_length()
+        x1 = LOGICAL_WIDTH - (diff & -diff).bit_length()
+        offsetX, offsetY = self.offset
+        return (offsetX + x0 * self.scale, offsetY + changed[0] * self.scale,
+                offsetX + (x1 + 1) * self.scale - 1,
+                offsetY + (changed[-1] + 1) * self.scale - 1)
+
+    def pushFrame(self, frame):
+        """Show a logical frame, unless it's already shown"""
+        rows = tuple(frame.rows)
+        with self._lock:
+            box = self.dirtyBox(rows)
+            if box is None:
+                self._skipped.inc()
+                return
+            payload = self._renderCache.get(rows)
+            if payload is None:
+                payload = self.render(self.layout(frame))
+                self._renderCache[rows] = payload
+                if len(self._renderCache) > self.RENDER_CACHE_SIZE:
+                    self._renderCache.popitem(last=False)
+            else:
+                self._renderCache.move_to_end(rows)
+            self._shownRows = rows
+            self.send(payload, box)
+        self._notify(frame)
+
+    def _notify(self, frame):
+        for listener in self.listeners:
+            try:
+                listener(frame)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Display listener failed")
+
+    def forget(self):
+        """Make the next frame be sent, e.g. after the panel was blanked"""
+        with self._lock:
+            self._shownRows = None
+
+    def render(self, panelFrame):
+        """What send() needs for panelFrame (a panel sized FrameBuffer)"""
+        raise NotImplementedError
+
+    def send(self, payload, box):
+        """Show payload; box is the part of the panel that changed"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Finish sending anything that's been held back"""
+
+    def contrast(self, level):
+        pass
+
+    def hide(self):
+        pass
+
+    def show(self):
+        pass
+
+
+class LumaBackend(DisplayBackend):
+    """A luma.oled/luma.lcd device, e.g. the SSD1306 on I2C or SPI panels"""
+
+    def __init__(self, device, name='luma'):
+        self.name = name
+        self.device = device
+        super().__init__(device.width, device.height)
+
+    def render(self, panelFrame):
+        if framebuffer.canPushPages(self.device, panelFrame.width,
+                                    panelFrame.height):
+            # Straight to the SSD1306 without luma (or PIL) repacking it
+            return 'pages', panelFrame.toPages()
+        image = panelFrame.toImage()
+        if self.device.mode != '1':
+            image = image.convert(self.device.mode)
+        return 'image', image
+
+    def send(self, payload, box):
+        kind, data = payload
+        if kind == 'pages':
+            framebuffer._pushPages(  # pylint: disable=protected-access
+                self.device, self.panelWidth, self.panelHeight, data)
+        else:
+            self.device.display(data)
+            self.device.show()
+
+    def contrast(self, level):
+        self.device.contrast(level)
+
+    def hide(self):
+        self.device.hide()
+        # The panel is off, so whatever comes next must be sent
+        self.forget()
+        blank = FrameBuffer(self.width, self.height)
+        blank.fill(BLACK)
+        self._notify(blank)
+
+    def show(self):
+        self.device.show()
+
+
+def _openSSD1306():
+    return LumaBackend(sharedDisplayDevice(), 'ssd1306')
+
+
+def _openLuma():
+    """A luma device from the displayLumaArgs command line options"""
+    from luma.core import cmdline, error  # pylint: disable=import-error
+    from .telemetry import ProfiledDevice
+    parser = cmdline.create_parser(description='luma display backend')
+    args = parser.parse_args(shlex.split(config.current().displayLumaArgs))
+    try:
+        device = cmdline.create_device(args)
+    except error.Error as e:
+        raise OSError(str(e))
+    return LumaBackend(ProfiledDevice(device), 'luma')
+
+
+class RefreshScheduler:
+    """
+    When e-paper refreshes happen and whether they're full or partial
+
+    refresh(payload, full) does a refresh. Payloads submitted sooner than
+    epaperMinRefreshSecs after the last refresh are held (only the latest
+    is kept) and refreshed when that time is up.
+    """
+
+    def __init__(self, refresh, panelArea):
+        self.refresh = refresh
+        self.panelArea = panelArea
+        # None until the first (always full) refresh
+        self.partialsSinceFull = None
+        self.lastRefreshTime = None
+        self._pending = None
+        self._pendingBox = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._refreshes = {
+            full: telemetry.counter(
+                'connectbox_epaper_%s_refreshes' %
+                ('full' if full else 'partial'),
+                'E-paper %s refreshes' % ('full' if full else 'partial'))
+            for full in (True, False)}
+
+    @staticmethod
+    def _startTimer(delay, func):
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def needsFull(self, box):
+        settings = config.current()
+        if self.partialsSinceFull is None or \
+                self.partialsSinceFull >= settings.epaperFullRefreshEvery:
+            return True
+        x0, y0, x1, y1 = box
+        changed = (x1 - x0 + 1) * (y1 - y0 + 1)
+        return changed * 100 > \
+            self.panelArea * settings.epaperFullRefreshAbovePerc
+
+    def submit(self, payload, box):
+        with self._lock:
+            self._pending = payload
+            if self._pendingBox is not None:
+                box = (min(box[0], self._pendingBox[0]),
+                       min(box[1], self._pendingBox[1]),
+                       max(box[2], self._pendingBox[2]),
+                       max(box[3], self._pendingBox[3]))
+            self._pendingBox = box
+            if self.lastRefreshTime is not None:
+                wait = self.lastRefreshTime + \
+                    config.current().epaperMinRefreshSecs - clock.monotonic()
+                if wait > 0:
+                    if self._timer is None:
+                        self._timer = self._startTimer(wait, self.flush)
+                    return
+        self.flush()
+
+    def flush(self):
+        """Refresh with the held payload, if there is one"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending is None:
+                return
+            payload, box = self._pending, self._pendingBox
+            self._pending = self._pendingBox = None
+            full = self.needsFull(box)
+            self.refresh(payload, full)
+            self._refreshes[full].inc()
+            self.lastRefreshTime = clock.monotonic()
+            self.partialsSinceFull = 0 if full else self.partialsSinceFull + 1
+
+
+class EPaperBackend(DisplayBackend):
+    """A Waveshare e-paper panel, driven through its epdXinY module"""
+
+    borderColor = WHITE
+
+    def __init__(self, epd, name='epaper'):
+        self.name = name
+        self.epd = epd
+        # Waveshare sizes are portrait; getbuffer() takes either orientation
+        super().__init__(max(epd.width, epd.height),
+                         min(epd.width, epd.height))
+        self.scheduler = RefreshScheduler(self._refresh,
+                                          self.panelWidth * self.panelHeight)
+        # init() above left the panel in full refresh mode
+        self._partialMode = False
+
+    def render(self, panelFrame):
+        return self.epd.getbuffer(panelFrame.toImage())
+
+    def send(self, payload, box):
+        self.scheduler.submit(payload, box)
+
+    def flush(self):
+        self.scheduler.flush()
+
+    def _refresh(self, buffer, full):
+        # Older drivers only have full refreshes
+        partial = not full and hasattr(self.epd, 'displayPartial')
+        if partial != self._partialMode and hasattr(self.epd, 'PART_UPDATE'):
+            self.epd.init(self.epd.PART_UPDATE if partial
+                          else self.epd.FULL_UPDATE)
+        self._partialMode = partial
+        with telemetry.timed('device_display'):
+            if partial:
+                self.epd.displayPartial(buffer)
+            else:
+                self.epd.display(buffer)
+
+
+def _openEPaper():
+    name = config.current().displayEpaperDriver
+    try:
+        driver = importlib.import_module(name)
+        epd = driver.EPD()
+        if hasattr(epd, 'FULL_UPDATE'):
+            epd.init(epd.FULL_UPDATE)
+        else:
+            epd.init()
+    except ImportError as e:
+        raise OSError("e-paper driver %s unavailable: %s" % (name, e))
+    return EPaperBackend(epd)
+
+
+register('ssd1306', _openSSD1306, autodetect=True)
+register('luma', _openLuma)
+register('epaper', _openEPaper)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Battery state estimation
+
+The AXP209 fuel gauge jitters by a few percent when the wifi load changes,
+so decisions based on a single reading flap (e.g. the low battery warning
+appearing and disappearing on successive checks). BatteryEstimator keeps a
+short history of readings, smooths them and predicts how long is left.
+"""
+
+from collections import deque, namedtuple
+
+BatterySample = namedtuple(
+    'BatterySample', 'time voltage current gauge charging')
+
+
+class BatteryEstimator:
+    """
+    Smoothed battery level and time-to-empty prediction
+
+    The gauge and current are smoothed with an exponential moving average.
+    Time to empty comes from a least squares fit of the gauge against time
+    over the recent samples, which is much less sensitive to jitter than
+    the difference between consecutive readings.
+    """
+
+    def __init__(self, maxSamples=64, alpha=0.3, windowSecs=20 * 60,
+                 minSamples=4, minSpanSecs=10 * 60):
+        # maxSamples bounds memory; windowSecs is how far back we look when
+        #  predicting, so that a change in load shows up reasonably quickly.
+        #  Fits over less than minSpanSecs are dominated by jitter
+        self.samples = deque(maxlen=maxSamples)
+        self.alpha = alpha
+        self.windowSecs = windowSecs
+        self.minSamples = minSamples
+        self.minSpanSecs = minSpanSecs
+        self.smoothedGauge = None
+        self.smoothedCurrent = None
+
+    def addSample(self, time, voltage, current, gauge, charging):
+        """
+        Record a reading
+
+        current is the discharge current in mA (negative when charging).
+        A negative gauge (no battery) is ignored.
+        """
+        if gauge < 0:
+            return
+        if self.samples and charging != self.samples[-1].charging:
+            # The trend before and after plugging in (or out) the charger is
+            #  unrelated, so start again
+            self.samples.clear()
+            self.smoothedGauge = None
+            self.smoothedCurrent = None
+        self.samples.append(
+            BatterySample(time, voltage, current, gauge, charging))
+        if self.smoothedGauge is None:
+            self.smoothedGauge = float(gauge)
+            self.smoothedCurrent = float(current)
+        else:
+            self.smoothedGauge += self.alpha * (gauge - self.smoothedGauge)
+            self.smoothedCurrent += \
+                self.alpha * (current - self.smoothedCurrent)
+
+    @property
+    def charging(self):
+        return bool(self.samples) and self.samples[-1].charging
+
+    def _fitTrend(self):
+        """
+        Least squares fit of the recent gauge readings against time
+
+        Returns (slope in percent per second, fitted level at the latest
+        sample) or None if there aren't enough recent samples.
+        """
+        if not self.samples:
+            return None
+        latest = self.samples[-1].time
+        recent = [s for s in self.samples
+                  if s.time >= latest - self.windowSecs]
+        if len(recent) < self.minSamples or \
+                latest - recent[0].time < self.minSpanSecs:
+            return None
+        n = len(recent)
+        meanTime = sum(s.time for s in recent) / n
+        meanGauge = sum(s.gauge for s in recent) / n
+        covariance = sum((s.time - meanTime) * (s.gauge - meanGauge)
+                         for s in recent)
+        variance = sum((s.time - meanTime) ** 2 for s in recent)
+        if variance == 0:
+            return None
+        slope = covariance / variance
+        return slope, meanGauge + slope * (latest - meanTime)
+
+    def gaugeSlope(self):
+        """Rate of change of the gauge in percent per second, or None"""
+        trend = self._fitTrend()
+        return trend[0] if trend else None
+
+    def minutesToEmpty(self, emptyPerc=0):
+        """
+        Predicted minutes until the gauge reaches emptyPerc
+
+        None while charging, if the level isn't falling or if there isn't
+        enough history to make a prediction.
+        """
+        if self.charging:
+            return None
+        trend = self._fitTrend()
+        if trend is None or trend[0] >= 0:
+            return None
+        slope, level = trend
+        # The fitted level is used rather than smoothedGauge because an
+        #  exponential moving average lags behind a steadily falling level
+        return max(0, level - emptyPerc) / -slope / 60
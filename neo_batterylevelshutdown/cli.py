@@ -3,13 +3,40 @@
 """Console script for neo_batterylevelshutdown."""
 
 import logging
+import signal
+import time
 
-import axp209
-import click
-import RPi.GPIO as GPIO  # pylint: disable=import-error
-import neo_batterylevelshutdown.hats as hats
-import neo_batterylevelshutdown.displays as displays
-from .HAT_Utilities import get_device
+# Taken before any other imports so that the startup report includes them
+STARTUP_TIME = time.monotonic()
+
+import click  # noqa: E402 pylint: disable=wrong-import-position
+import neo_batterylevelshutdown.hats as hats  # noqa: E402
+import neo_batterylevelshutdown.displays as displays  # noqa: E402
+from . import config  # noqa: E402
+from . import telemetry  # noqa: E402
+from .hardware import GPIO, sharedAXP209  # noqa: E402
+
+
+class StartupTimer:
+    """Records how long each stage of daemon startup took"""
+
+    def __init__(self, startTime=STARTUP_TIME):
+        self.lastTime = startTime
+        self.startTime = startTime
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages.append((stage, now - self.lastTime))
+        self.lastTime = now
+
+    def report(self):
+        """Log (at debug level) the stages recorded since the last report"""
+        for stage, duration in self.stages:
+            logging.debug("startup: %-28s %6.3fs", stage, duration)
+        logging.debug("startup: %-28s %6.3fs", "elapsed",
+                      self.lastTime - self.startTime)
+        self.stages = []
 
 
 def getHATClass():
@@ -27,8 +54,8 @@ def getHATClass():
         return hats.DummyHAT
 
     try:
-        axp = axp209.AXP209()
-        axp.close()
+        # The AXP209 stays open so that the HAT can reuse it
+        sharedAXP209()
         # AXP209 found... we have HAT from Q3Y2018 or later
         # Test PA1... LOW => Q4Y2018; HIGH => Q3Y2018
         GPIO.setup(hats.q3y2018HAT.PA1, GPIO.IN)
@@ -49,32 +76,115 @@ def getHATClass():
 
 
 def getDisplayClass():
+    from . import backends
     try:
-        # See if we can find an OLED
-        get_device()
-        logging.info("Found OLED")
+        # See if we can find the configured display (by default, probe for
+        #  an OLED). The backend stays open so that the display can reuse it
+        backend = backends.sharedBackend()
+        logging.info("Found %s display", backend.name)
         return displays.OLED
-    except OSError:
-        # No OLED. This is a standard Axp209 HAT
-        logging.info("No OLED detected")
+    except OSError as e:
+        # No display. This is a standard Axp209 HAT
+        logging.info("No display detected (%s)", e)
         return displays.DummyDisplay
 
 
 @click.command()
 @click.option('-v', '--verbose', is_flag=True, default=False)
-def main(verbose):
+@click.option('--asyncio', 'useAsyncio', is_flag=True, default=False,
+              help='Run AXP209 HATs from an asyncio event loop')
+@click.option('--metrics-port', 'metricsPort', type=int, default=None,
+              help='Serve OpenMetrics telemetry over HTTP on this port')
+@click.option('--metrics-address', 'metricsAddress', default='127.0.0.1',
+              show_default=True,
+              help='Address to serve metrics on (0.0.0.0 for every '
+                   'interface, including the Wi-Fi)')
+@click.option('--profile', is_flag=True, default=False,
+              help='Time hot paths; SIGUSR1 logs a summary')
+@click.option('--control-socket', 'controlSocket', default=None,
+              help='Accept JSON control requests on this Unix socket '
+                   '(AXP209 HATs only)')
+@click.option('--config', 'configPath', default=config.DEFAULT_CONFIG_PATH,
+              show_default=True,
+              help='JSON file of thresholds, timings and paths; reloaded '
+                   'on SIGHUP or when it changes')
+@click.option('--mirror-port', 'mirrorPort', type=int, default=None,
+              help='Mirror the display over HTTP (PNG snapshots and a '
+                   'stream of frame diffs) on this port')
+@click.option('--mirror-address', 'mirrorAddress', default='127.0.0.1',
+              show_default=True,
+              help='Address to mirror the display on (0.0.0.0 for every '
+                   'interface, including the Wi-Fi)')
+@click.option('--power-governor', 'powerGovernor', default='off',
+              type=click.Choice(['off', 'on', 'dry-run']), show_default=True,
+              help='Adjust CPU frequency and Wi-Fi transmit power to the '
+                   'battery state (AXP209 HATs only)')
+def main(verbose, useAsyncio, metricsPort, metricsAddress, profile,
+         controlSocket, configPath, mirrorPort, mirrorAddress,
+         powerGovernor):
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
+    if profile:
+        telemetry.enableProfiling()
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: telemetry.dumpProfile())
+
+    timer = StartupTimer()
+    timer.mark("imports")
+    # An invalid file is logged and the defaults used
+    config.ConfigWatcher(configPath).start()
+    timer.mark("config")
     GPIO.setmode(GPIO.BOARD)
     hatClass = getHATClass()
-    displayClass = getDisplayClass()
-    logging.info("starting main loop")
+    timer.mark("HAT detection")
+    frameMirror = None
+    if mirrorPort is not None:
+        from .mirror import FrameMirror, MirrorServer
+        frameMirror = FrameMirror()
+        MirrorServer(frameMirror, mirrorPort, mirrorAddress).start()
+
+    def loadDisplay(powerManagementDevice, metrics=None):
+        # Called by the HAT once its LED and shutdown handling are armed, so
+        #  the display libraries and OLED probe don't delay those
+        displayClass = getDisplayClass()
+        timer.mark("display detection")
+        display = displayClass(powerManagementDevice, metrics)
+        if frameMirror is not None and isinstance(display, displays.OLED):
+            frameMirror.attach(display.display_device)
+        timer.mark("display initialisation")
+        timer.report()
+        return display
+
     try:
-        hatClass(displayClass).mainLoop()
+        hat = hatClass(loadDisplay)
+        timer.mark("shutdown protection armed")
+        timer.report()
+        if metricsPort is not None:
+            from .exporter import MetricsExporter
+            MetricsExporter(hat, metricsPort, metricsAddress).start()
+        if powerGovernor != 'off' and isinstance(hat, hats.Axp209HAT):
+            from .governor import PowerGovernor
+            hat.powerGovernor = PowerGovernor(
+                dryRun=powerGovernor == 'dry-run')
+        if controlSocket is not None and isinstance(hat, hats.Axp209HAT):
+            from .ipc import ControlServer
+            try:
+                ControlServer(hat, controlSocket).start()
+            except OSError as e:
+                # Carry on without it: the battery must still be watched
+                logging.error("Unable to listen on %s: %s", controlSocket, e)
+        if useAsyncio and isinstance(hat, hats.Axp209HAT):
+            from .controller import AsyncController
+            AsyncController(hat).run()
+        else:
+            logging.info("starting main loop")
+            hat.mainLoop()
     except KeyboardInterrupt:
+        if profile:
+            telemetry.dumpProfile()
         GPIO.cleanup()       # clean up GPIO on CTRL+C exit
     GPIO.cleanup()           # clean up GPIO on normal exit
 
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deployment tunable thresholds, timings and paths
+
+Values come from a JSON file (DEFAULT_CONFIG_PATH unless --config says
+otherwise) containing any subset of the Config fields, e.g.
+
+    {"displayTimeoutSecs": 60, "batteryWarningThresholdPerc": 10}
+
+Fields that aren't in the file keep their defaults. The file is validated
+as a whole and becomes an immutable Config that code fetches with current()
+whenever it needs a value, so a reload takes effect at the next use without
+anything holding on to stale values. ConfigWatcher reloads on SIGHUP and,
+where inotify is available, whenever the file is written. A file that
+fails validation is logged and ignored, leaving the previous config (at
+startup, the defaults) active.
+"""
+
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import signal
+import struct
+import threading
+
+DEFAULT_CONFIG_PATH = '/etc/neo_batterylevelshutdown.json'
+
+_DEFAULTS = (
+    # Battery checks are frequent near the warning threshold and rare when
+    #  the battery is well charged or charging
+    ('batteryCheckMinSecs', 10),
+    ('batteryCheckMaxSecs', 120),
+    ('batteryCheckSecsPerPerc', 4),  # extra interval per % above warning
+    ('ledSolidThresholdPerc', 63),  # Parity with PIN_VOLT_3_84
+    ('ledSingleFlashThresholdPerc', 33),  # Parity with PIN_VOLT_3_71
+    ('ledDoubleFlashThresholdPerc', 3),  # Parity with PIN_VOLT_3_45
+    ('batteryWarningThresholdPerc', 3),
+    ('batteryShutdownThresholdPerc', 1),
+    # Predicted time left, based on recent readings, that triggers a warning
+    #  or (once below the warning threshold) a shutdown
+    ('batteryWarningMinutesToEmpty', 15),
+    ('batteryShutdownMinutesToEmpty', 2),
+    # Level above the warning threshold before the warning is hidden, so
+    #  that jitter around the threshold doesn't make the warning flap
+    ('batteryWarningHysteresisPerc', 2),
+    # The display dims after displayDimSecs without use and blanks after
+    #  displayTimeoutSecs. Contrast is 0-255; luma's SSD1306 default is 0xCF
+    ('displayDimSecs', 10),
+    ('displayTimeoutSecs', 20),
+    ('displayContrast', 0xCF),
+    ('displayDimContrast', 0x10),
+    # How often the status page being shown is redrawn to keep its values
+    #  current, on external power and on battery. On battery below
+    #  displayEconomyBelowPerc there are no redraws and the display dims
+    #  and blanks in half the time
+    ('displayRefreshSecs', 5),
+    ('displayRefreshOnBatterySecs', 30),
+    ('displayEconomyBelowPerc', 33),
+    # Which display backend to use (see backends.py; 'auto' probes for an
+    #  SSD1306), the luma.core command line options for the 'luma' backend
+    #  and the Waveshare driver module for the 'epaper' backend. These are
+    #  only read at startup
+    ('displayBackend', 'auto'),
+    ('displayLumaArgs', '--display ssd1306 --interface i2c --i2c-port 0'),
+    ('displayEpaperDriver', 'waveshare_epd.epd2in13_V2'),
+    # E-paper refreshes are at least epaperMinRefreshSecs apart (frames in
+    #  between are coalesced), and are full rather than partial refreshes
+    #  after epaperFullRefreshEvery partial ones, to clear ghosting, or when
+    #  more than epaperFullRefreshAbovePerc of the panel has changed
+    ('epaperMinRefreshSecs', 10),
+    ('epaperFullRefreshEvery', 20),
+    ('epaperFullRefreshAbovePerc', 50),
+    # Power profiles (see governor.py). On battery, the saver profile is
+    #  used below governorSaverBelowPerc or when the battery is predicted to
+    #  be empty within governorSaverMinutesToEmpty
+    ('governorSaverBelowPerc', 30),
+    ('governorSaverMinutesToEmpty', 90),
+    ('governorHysteresisPerc', 5),
+    ('governorMinDwellSecs', 300),
+    ('governorBalancedMaxFreqPerc', 75),
+    ('governorSaverMaxFreqPerc', 50),
+    ('wifiTxPowerBalancedDbm', 15),
+    ('wifiTxPowerSaverDbm', 10),
+    ('ledCycleTimeSecs', 5),
+    ('checkPressThresholdSec', 3),  # what qualifies as a long press
+    # Space to leave free on the internal card when copying from USB
+    ('freeSpaceCushionBytes', 1024 ** 3),
+    # When a USB stick's content doesn't all fit, copy as much as does (in
+    #  order; see copyplan.py) rather than refusing
+    ('copyPartial', 0),
+    # What to copy from USB sticks: glob patterns (fnmatch, where * also
+    #  matches /) for paths relative to the stick. Nothing is copied that
+    #  doesn't match copyInclude (when it isn't empty), that matches
+    #  copyExclude (which also skips whole folders) or that's bigger than
+    #  copyMaxFileBytes (when that isn't 0). Files matching earlier
+    #  copyPriority patterns are copied first, e.g.
+    #  ["videos/*", "*.mp4", "*.pdf"]
+    ('copyInclude', ()),
+    ('copyExclude', ()),
+    ('copyMaxFileBytes', 0),
+    ('copyPriority', ()),
+    # Limits on copying from USB (see throttle.py), so that content keeps
+    #  being served while a stick is copied. The byte rate backs off
+    #  towards copyMinBytesPerSec as stations connect or traffic rises.
+    #  0 (the default) for no limit; e.g. 8388608 bytes and 200 operations
+    #  a second keep a Class 10 card responsive
+    ('copyMaxBytesPerSec', 0),
+    ('copyMinBytesPerSec', 512 * 1024),
+    ('copyMaxOpsPerSec', 0),
+    ('copyBackoffSampleSecs', 2),
+    # Copy in the idle I/O class (as ionice -c 3 would)
+    ('copyIdleIO', 1),
+    # Copy from USB through a content addressed store (see dedup.py) so
+    #  that files with the same content are stored once. The store must be
+    #  on the same filesystem as contentPath but outside it, so that it
+    #  isn't served ('' for a hidden folder beside contentPath)
+    ('copyDedup', 0),
+    ('dedupStorePath', ''),
+    # Where content is served from, where a USB stick is mounted while
+    #  copying from it, and the USB stick's device
+    ('contentPath', '/media/usb0'),
+    ('usbMountPath', '/media/usb1'),
+    ('usbDevicePath', '/dev/sda1'),
+    ('statsFilePath',
+     '/var/www/connectbox/connectbox_default/stats.top10.json'),
+)
+
+Config = namedtuple('Config', [name for name, _ in _DEFAULTS])
+
+DEFAULTS = Config(*[value for _, value in _DEFAULTS])
+
+# Settings that are strings but not paths
+_NON_PATH_SETTINGS = ('displayBackend', 'displayLumaArgs',
+                      'displayEpaperDriver')
+
+# Settings that are on (1 or true) or off (0 or false)
+_FLAG_SETTINGS = ('copyPartial', 'copyIdleIO', 'copyDedup')
+
+# Paths that can be '' for a default worked out from other settings
+_OPTIONAL_PATH_SETTINGS = ('dedupStorePath',)
+
+_current = DEFAULTS
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def current():
+    """The active Config"""
+    return _current
+
+
+def use(config):
+    """Make config the active Config"""
+    global _current  # pylint: disable=global-statement
+    _current = config
+
+
+def validate(values):
+    """A Config from a dict of overrides, or raise ConfigError"""
+    if not isinstance(values, dict):
+        raise ConfigError("the config must be a JSON object")
+    unknown = set(values) - set(Config._fields)
+    if unknown:
+        raise ConfigError("unknown settings: %s" % ', '.join(sorted(unknown)))
+    # Lists are stored as tuples, so copied rather than changed in place
+    values = dict(values)
+    for name, value in list(values.items()):
+        default = getattr(DEFAULTS, name)
+        if isinstance(default, tuple):
+            if not isinstance(value, list) or \
+                    not all(isinstance(item, str) for item in value):
+                raise ConfigError("%s must be a list of strings" % name)
+            values[name] = tuple(value)
+        elif name in _FLAG_SETTINGS:
+            if value not in (0, 1) or isinstance(value, float):
+                raise ConfigError("%s must be true or false (or 1 or 0)" %
+                                  name)
+        elif name in _NON_PATH_SETTINGS:
+            if not isinstance(value, str) or not value:
+                raise ConfigError("%s must be a non-empty string" % name)
+        elif isinstance(default, str):
+            if not isinstance(value, str) or not (
+                    os.path.isabs(value) or
+                    (not value and name in _OPTIONAL_PATH_SETTINGS)):
+                raise ConfigError("%s must be an absolute path" % name)
+        elif isinstance(value, bool) or \
+                not isinstance(value, (int, float)) or value < 0:
+            raise ConfigError("%s must be a non-negative number" % name)
+    config = DEFAULTS._replace(**values)
+
+    if config.batteryCheckMinSecs <= 0:
+        raise ConfigError("batteryCheckMinSecs must be positive")
+    if config.batteryCheckMinSecs > config.batteryCheckMaxSecs:
+        raise ConfigError(
+            "batteryCheckMinSecs is more than batteryCheckMaxSecs")
+    if not config.ledDoubleFlashThresholdPerc <= \
+            config.ledSingleFlashThresholdPerc <= \
+            config.ledSolidThresholdPerc <= 100:
+        raise ConfigError("LED thresholds must increase from double flash "
+                          "to single flash to solid")
+    if not config.batteryShutdownThresholdPerc < \
+            config.batteryWarningThresholdPerc <= 100:
+        raise ConfigError("batteryShutdownThresholdPerc must be below "
+                          "batteryWarningThresholdPerc")
+    if config.batteryShutdownMinutesToEmpty > \
+            config.batteryWarningMinutesToEmpty:
+        raise ConfigError("batteryShutdownMinutesToEmpty is more than "
+                          "batteryWarningMinutesToEmpty")
+    if config.displayDimSecs > config.displayTimeoutSecs:
+        raise ConfigError("displayDimSecs is more than displayTimeoutSecs")
+    if max(config.displayContrast, config.displayDimContrast) > 255:
+        raise ConfigError("display contrast must be 0-255")
+    if min(config.displayRefreshSecs,
+           config.displayRefreshOnBatterySecs) <= 0:
+        raise ConfigError("display refresh intervals must be positive")
+    if not 0 < config.governorSaverMaxFreqPerc <= \
+            config.governorBalancedMaxFreqPerc <= 100:
+        raise ConfigError("governor frequency caps must be 1-100% and no "
+                          "higher for saver than for balanced")
+    if config.wifiTxPowerSaverDbm > config.wifiTxPowerBalancedDbm:
+        raise ConfigError("wifiTxPowerSaverDbm is more than "
+                          "wifiTxPowerBalancedDbm")
+    if config.epaperFullRefreshEvery < 1:
+        raise ConfigError("epaperFullRefreshEvery must be at least 1")
+    if config.epaperFullRefreshAbovePerc > 100:
+        raise ConfigError("epaperFullRefreshAbovePerc must be 0-100")
+    if config.ledCycleTimeSecs <= 0:
+        raise ConfigError("ledCycleTimeSecs must be positive")
+    if config.copyBackoffSampleSecs <= 0:
+        raise ConfigError("copyBackoffSampleSecs must be positive")
+    if config.copyMaxBytesPerSec and \
+            not 0 < config.copyMinBytesPerSec <= config.copyMaxBytesPerSec:
+        raise ConfigError("copyMinBytesPerSec must be positive and no more "
+                          "than copyMaxBytesPerSec")
+    contentPath = os.path.normpath(config.contentPath)
+    if os.path.commonpath([contentPath, dedupStorePath(config)]) == \
+            contentPath:
+        raise ConfigError("dedupStorePath must be outside contentPath, "
+                          "which is served")
+    return config
+
+
+def dedupStorePath(config=None):
+    """Where the dedup store is: dedupStorePath, or beside contentPath"""
+    config = config or current()
+    if config.dedupStorePath:
+        return config.dedupStorePath
+    contentPath = os.path.normpath(config.contentPath)
+    return os.path.join(os.path.dirname(contentPath),
+                        '.%s-dedup' % os.path.basename(contentPath))
+
+
+def load(path):
+    """The Config in the file at path (defaults if it doesn't exist)"""
+    try:
+        with open(path) as f:
+            values = json.load(f)
+    except FileNotFoundError:
+        logging.info("No config file at %s; using defaults", path)
+        return DEFAULTS
+    except (OSError, ValueError) as e:
+        raise ConfigError("unable to read %s: %s" % (path, e))
+    return validate(values)
+
+
+class ConfigWatcher:
+
+    # From <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, path=DEFAULT_CONFIG_PATH):
+        self.path = path
+
+    def reload(self):
+        """Load and activate the config file, keeping the old one on error"""
+        try:
+            config = load(self.path)
+        except ConfigError as e:
+            logging.error("Config not reloaded: %s", e)
+            return False
+        if config != current():
+            changed = [name for name in Config._fields
+                       if getattr(config, name) != getattr(current(), name)]
+            logging.info("Config changed: %s", ', '.join(changed))
+        use(config)
+        return True
+
+    def start(self):
+        """Load the config, then reload on SIGHUP and when the file changes"""
+        if not self.reload():
+            # Not fatal: without the daemon running, nothing shuts the box
+            #  down before the battery is flat
+            logging.error("Running with the default config until %s is "
+                          "fixed", self.path)
+            use(DEFAULTS)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        fd = self._inotifyWatch()
+        if fd is not None:
+            threading.Thread(target=self._watch, args=(fd,),
+                             name='config-watcher', daemon=True).start()
+
+    def _inotifyWatch(self):
+        """An inotify fd watching the config file's directory, or None"""
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            logging.info("No inotify; the config reloads on SIGHUP only")
+            return None
+        fd = libc.inotify_init()
+        # The directory rather than the file, so that editors that replace
+        #  the file (rather than writing to it) are noticed
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if fd < 0 or libc.inotify_add_watch(
+                fd, directory.encode(),
+                self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE) < 0:
+            logging.info("Unable to watch %s: %s; the config reloads on "
+                         "SIGHUP only", directory,
+                         os.strerror(ctypes.get_errno()))
+            if fd >= 0:
+                os.close(fd)
+            return None
+        return fd
+
+    def _watch(self, fd):
+        name = os.path.basename(self.path).encode()
+        while True:
+            data = os.read(fd, 4096)
+            offset = 0
+            changed = False
+            while offset < len(data):
+                _, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                changed |= data[offset:offset + length].rstrip(b'\0') == name
+                offset += length
+            if changed:
+                self.reload()
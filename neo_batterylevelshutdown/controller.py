@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+"""
+asyncio based control loop for Axp209 HATs
+
+An alternative to Axp209HAT.mainLoop. Rather than a polling loop plus
+RPi.GPIO callback threads that all modify the HAT and display state, every
+input is turned into an event on a single asyncio loop:
+
+* GPIO edges (buttons and the AXP209 interrupt line) are handed from the
+  RPi.GPIO callback thread to the loop and processed there. Button presses
+  are handled one at a time; AXP209 interrupts are handled straight away,
+  even while a button action is running. HATs without an interrupt line
+  have the AXP209's interrupt status polled instead
+* the LED cycle, battery checks and display dimming, blanking and refresh
+  are timers that only wake when they have something to do
+* while the "remove USB" page is showing, USB removal is watched for
+
+Everything that changes the HAT or display state (button actions, page
+refreshes, display dimming and blanking, the display power off button,
+battery checks and metrics samples) runs in a single job slot, a
+one-thread executor, so those never run at the same time as each other.
+Commands started over the control socket (see ipc.py) run in their own
+thread, but they hold the navigator's lock, so display work in the slot
+is done under that lock too (see Navigator.exclusive) and skipped while
+a command has it.
+
+Two things can't wait for a command (e.g. a long copy) to finish, and run
+alongside it on the loop instead: AXP209 interrupts, whose handlers only
+change the display through the navigator, and battery checks, which can
+shut down but leave the display alone until the command is done. Metrics
+samples wait for the slot, so the history has a gap while copying.
+
+Requires Python 3.5 or later.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+
+from . import config
+from .hardware import GPIO, clock
+from . import navigation
+from .usb import USB
+
+
+class AsyncController:
+
+    # How often a held button is sampled. The callback based implementation
+    #  busy-waits instead, which keeps a CPU core at 100% during the press
+    PRESS_POLL_SECS = 0.02
+    USB_POLL_SECS = 1
+    LED_FLASH_DELAY_SECS = 0.3
+    # How soon display work that was skipped (because an event was being
+    #  handled) is tried again
+    RETRY_SECS = 1
+
+    def __init__(self, hat, loop=None):
+        self.hat = hat
+        self.loop = loop or asyncio.new_event_loop()
+        # The job slot (see above)
+        self.jobs = ThreadPoolExecutor(max_workers=1)
+        # True while a button action runs in the job slot
+        self.busy = False
+        self.lastPressTime = 0
+        # Created on the loop in run()
+        self.edges = None
+        self.activity = None
+        self.batteryChecked = None
+        self.batteryCheckRequested = None
+        self.usbWatcher = None
+
+    def _onEdge(self, channel):
+        # Runs in the RPi.GPIO callback thread, so only hand the edge over
+        if channel == self.hat.PIN_AXP_INTERRUPT_LINE:
+            # Not queued behind a button action that might be copying
+            self.loop.call_soon_threadsafe(self.hat.irq.dispatch, channel)
+        else:
+            self.loop.call_soon_threadsafe(self.edges.put_nowait, channel)
+
+    def _onBatteryCheckRequested(self):
+        # Interrupts can be handled in the executor as well as on the loop
+        self.loop.call_soon_threadsafe(self.batteryCheckRequested.set)
+
+    def _takeOverEdges(self):
+        for channel, (edge, _, bouncetime) in self.hat.edgeHandlers.items():
+            GPIO.remove_event_detect(channel)
+            if bouncetime is None:
+                GPIO.add_event_detect(channel, edge, callback=self._onEdge)
+            else:
+                GPIO.add_event_detect(channel, edge, callback=self._onEdge,
+                                      bouncetime=bouncetime)
+
+    def _inSlot(self, func, *args):
+        """Run func in the job slot (a future for its result)"""
+        return self.loop.run_in_executor(self.jobs, func, *args)
+
+    def _exclusive(self, func):
+        """
+        Run func in the job slot while no navigator event is being handled,
+        resulting in False if one was (and func wasn't run)
+        """
+        return self._inSlot(functools.partial(
+            self.hat.navigator.exclusive, func, blocking=False))
+
+    async def _runJob(self, func, *args):
+        """Run a (perhaps long) button action in the job slot"""
+        def job():
+            # Set in the slot, so it's only true while the action runs
+            #  rather than while it waits for its turn
+            self.busy = True
+            try:
+                func(*args)
+            finally:
+                self.busy = False
+        try:
+            await self._inSlot(job)
+        finally:
+            self.activity.set()
+
+    async def _dispatchEdges(self):
+        while True:
+            channel = await self.edges.get()
+            _, callback, _ = self.hat.edgeHandlers[channel]
+            if callback == self.hat.handleButtonPress:
+                await self._handleButtonPress(channel)
+            else:
+                # The display power off button, which is display work like
+                #  the rest, so skipped while a command has the display
+                await self._exclusive(functools.partial(callback, channel))
+                self.activity.set()
+
+    async def _measurePress(self, channel):
+        """Async equivalent of Axp209HAT.checkPressTime"""
+        buttons = self.hat.USABLE_BUTTONS
+        otherChannel = buttons[0] if channel == buttons[1] else buttons[1]
+        startTime = dualStartTime = clock.time()
+        dualTimeRecorded = 0
+        while GPIO.input(channel) == 0:
+            if GPIO.input(otherChannel) == 1:
+                dualButtonTime = clock.time() - dualStartTime
+                dualTimeRecorded = max(dualButtonTime, dualTimeRecorded)
+                dualStartTime = clock.time()
+            await asyncio.sleep(self.PRESS_POLL_SECS)
+        return clock.time() - startTime, dualTimeRecorded
+
+    async def _handleButtonPress(self, channel):
+        if clock.time() - self.lastPressTime < \
+                self.hat.BUTTON_PRESS_TIMEOUT_SEC:
+            return
+        channelTime, dualTime = await self._measurePress(channel)
+        # Edges from the other button (during a dual press) or from bounces
+        #  are part of this press
+        while not self.edges.empty():
+            self.edges.get_nowait()
+        self.lastPressTime = clock.time()
+        await self._runJob(
+            self.hat.actOnButtonPress, channel, channelTime, dualTime)
+        if self.hat.navigator.state == navigation.REMOVE_USB and \
+                (self.usbWatcher is None or self.usbWatcher.done()):
+            self.usbWatcher = asyncio.ensure_future(self._watchUsbRemoval())
+
+    async def _watchUsbRemoval(self):
+        """Carry on from the remove USB page as soon as the USB is removed"""
+        usb = USB()
+        while self.hat.navigator.state == navigation.REMOVE_USB:
+            await asyncio.sleep(self.USB_POLL_SECS)
+            if self.busy or self.hat.navigator.state != navigation.REMOVE_USB:
+                continue
+            if not await self.loop.run_in_executor(None, usb.isUsbPresent):
+                logging.debug("USB removal detected")
+                await self._runJob(self.hat.usbRemoved)
+
+    async def _ledCycle(self):
+        while True:
+            cycleEnd = self.loop.time() + config.current().ledCycleTimeSecs
+            flashes = self.hat.ledFlashCount()
+            if not flashes:
+                self.hat.solidLED()
+                # The LED can only change after the battery level is read
+                #  again, so there's no need to wake until then
+                self.batteryChecked.clear()
+                await self.batteryChecked.wait()
+                continue
+            for _ in range(flashes):
+                GPIO.output(self.hat.PIN_LED, GPIO.HIGH)
+                await asyncio.sleep(self.LED_FLASH_DELAY_SECS)
+                GPIO.output(self.hat.PIN_LED, GPIO.LOW)
+                await asyncio.sleep(self.LED_FLASH_DELAY_SECS)
+            await asyncio.sleep(max(0, cycleEnd - self.loop.time()))
+
+    async def _pollInterrupts(self):
+        while True:
+            await asyncio.sleep(config.current().ledCycleTimeSecs)
+            self.hat.irq.dispatch()
+
+    async def _batteryCheck(self):
+        while True:
+            delay = self.hat.nextBatteryCheckTime - clock.time()
+            if delay > 0:
+                # Woken early when an interrupt (e.g. the charger being
+                #  plugged in) asks for a check
+                self.batteryCheckRequested.clear()
+                try:
+                    await asyncio.wait_for(self.batteryCheckRequested.wait(),
+                                           timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Not queued behind a button action, which might be copying
+            if self.busy or not await self._exclusive(self.hat.checkBattery):
+                # A command (perhaps a long copy) is running. Check now, as
+                #  the battery may need to shut down, and again (to show
+                #  any warning) as soon as the config allows
+                self.hat.checkBattery(updateDisplay=False)
+                self.hat.nextBatteryCheckTime = min(
+                    self.hat.nextBatteryCheckTime,
+                    clock.time() + config.current().batteryCheckMinSecs)
+            self.batteryChecked.set()
+            self.activity.set()
+
+    async def _sampleMetrics(self):
+        while True:
+            await asyncio.sleep(
+                max(0, self.hat.nextMetricsSampleTime - clock.time()))
+            # Counting wifi users runs a subprocess
+            await self._inSlot(self.hat.sampleMetrics)
+
+    async def _displayTimeout(self):
+        while True:
+            self.activity.clear()
+            nextTime = self.hat.nextDisplayEventTime()
+            if nextTime is None:
+                # Nothing to do until the display is used again
+                await self.activity.wait()
+                continue
+            delay = nextTime - clock.time()
+            if delay <= 0:
+                if not self.busy and \
+                        await self._exclusive(self.hat.checkDisplayTimeout):
+                    continue
+                # Whatever is being handled wakes the display when it's done
+                delay = self.RETRY_SECS
+            try:
+                await asyncio.wait_for(self.activity.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refreshDisplay(self):
+        while True:
+            await asyncio.sleep(
+                max(0, self.hat.nextDisplayRefreshTime - clock.time()))
+            if self.busy or \
+                    not await self._exclusive(self.hat.refreshDisplay):
+                # Whatever is being handled has the display
+                await asyncio.sleep(self.hat.displayRefreshInterval())
+
+    async def _main(self):
+        self.edges = asyncio.Queue()
+        self.activity = asyncio.Event()
+        self.batteryChecked = asyncio.Event()
+        self.batteryCheckRequested = asyncio.Event()
+        self.hat.batteryCheckListener = self._onBatteryCheckRequested
+        self._takeOverEdges()
+        tasks = [self._dispatchEdges(), self._ledCycle(),
+                 self._displayTimeout(), self._refreshDisplay(),
+                 self._sampleMetrics()]
+        if self.hat.PIN_AXP_INTERRUPT_LINE is None:
+            tasks.append(self._pollInterrupts())
+        # As in mainLoop, there's no battery check without a battery
+        if self.hat.axp.battery_exists:
+            tasks.append(self._batteryCheck())
+        await asyncio.gather(*tasks)
+
+    def run(self):
+        """Start the display and run the HAT until interrupted"""
+        self.hat.startDisplay()
+        logging.info("Starting asyncio control loop")
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+            self.jobs.shutdown(wait=False)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Planning a copy from USB against the space that's really there
+
+Summing apparent file sizes against free blocks let copies start that
+then failed part way: every file takes whole blocks, every file and
+folder takes an inode (which small cards run out of first), blocks
+reserved for root (f_bfree - f_bavail) aren't ours to use, and files that
+are replaced give their blocks back (if they were the last link to
+them). Folders have to fit as well. plan() works all of that out in a
+single scan of the stick, with dest looked up for each file as it goes,
+and decides up front what will be copied: everything, or (if
+copyPartial is set) as many files as fit, in order, rather than
+failing at 95%.
+
+The same scan applies the copyInclude/copyExclude/copyMaxFileBytes
+filters (excluded folders aren't even entered) and orders the files by
+copyPriority, so that the most important content is planned, and copied,
+first. With copyInclude, folders are only created for files that are
+copied, each planned with the first file copied into it. Without it, as
+before, every folder is created (empty or not), before any files.
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+import logging
+import os
+
+from . import config
+
+PlannedFile = namedtuple('PlannedFile', 'source dest size')
+
+
+class CopyPlan:
+    """What a copy will do, and the space and inodes that it needs"""
+
+    def __init__(self, sourcePath, destPath, bytesAvailable=None,
+                 inodesAvailable=None):
+        self.sourcePath = sourcePath
+        self.destPath = destPath
+        # None means unlimited (or not reported, as on vfat)
+        self.bytesAvailable = bytesAvailable
+        self.inodesAvailable = inodesAvailable
+        # Folders to create, parents first, and those that didn't fit
+        self.dirs = []
+        self.skippedDirs = []
+        # PlannedFiles to copy, in order, and those that didn't fit
+        self.files = []
+        self.skipped = []
+        # Net change in used space (allocated blocks) and inodes
+        self.bytesNeeded = 0
+        self.inodesNeeded = 0
+
+    @property
+    def complete(self):
+        return not self.skipped and not self.skippedDirs
+
+    @property
+    def copyBytes(self):
+        return sum(planned.size for planned in self.files)
+
+    def fits(self, netBytes, inodes):
+        return (self.bytesAvailable is None or netBytes <= 0 or
+                self.bytesNeeded + netBytes <= self.bytesAvailable) and \
+            (self.inodesAvailable is None or inodes <= 0 or
+             self.inodesNeeded + inodes <= self.inodesAvailable)
+
+    def summary(self):
+        return "%d files (%d bytes) to copy, %d skipped; needs %d bytes " \
+            "and %d inodes of %s and %s" % (
+                len(self.files), self.copyBytes, len(self.skipped),
+                self.bytesNeeded, self.inodesNeeded,
+                'unlimited' if self.bytesAvailable is None
+                else self.bytesAvailable,
+                'unlimited' if self.inodesAvailable is None
+                else self.inodesAvailable)
+
+
+class CopyFilter:
+    """Which files to copy, and in what order, from the copy* settings"""
+
+    def __init__(self, include=(), exclude=(), maxFileBytes=0, priority=()):
+        self.include = include
+        self.exclude = exclude
+        self.maxFileBytes = maxFileBytes
+        self.priority = priority
+
+    @classmethod
+    def fromConfig(cls, settings=None):
+        settings = settings or config.current()
+        return cls(settings.copyInclude, settings.copyExclude,
+                   settings.copyMaxFileBytes, settings.copyPriority)
+
+    def excludesFolder(self, relPath):
+        return any(fnmatchcase(relPath, pattern) for pattern in self.exclude)
+
+    def wants(self, relPath, size):
+        """Whether to copy the file at relPath (relative to the stick)"""
+        if self.maxFileBytes and size > self.maxFileBytes:
+            return False
+        if self.include and \
+                not any(fnmatchcase(relPath, pattern)
+                        for pattern in self.include):
+            return False
+        return not any(fnmatchcase(relPath, pattern)
+                       for pattern in self.exclude)
+
+    def rank(self, relPath):
+        """Lower ranks are copied first"""
+        for rank, pattern in enumerate(self.priority):
+            if fnmatchcase(relPath, pattern):
+                return rank
+        return len(self.priority)
+
+
+def _allocated(size, blockSize):
+    """Space that a file of size bytes takes, in whole blocks"""
+    return -(-size // blockSize) * blockSize
+
+
+def _scan(sourceDir, destDir, relDir, copyFilter, dirs, candidates):
+    """
+    Find the folders that don't exist at dest and the files to copy, with
+    their rank and any file they'd replace
+    """
+    if not os.path.isdir(destDir):
+        dirs.append(destDir)
+    subdirs = []
+    # Read to the end (and so closed) by sorted(), as scandir() is only a
+    #  context manager from Python 3.6
+    for entry in sorted(os.scandir(sourceDir), key=lambda entry: entry.name):
+        # Matched with / whatever the OS
+        relPath = relDir + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            if not copyFilter.excludesFolder(relPath):
+                subdirs.append((entry, relPath))
+        elif entry.is_file():
+            size = entry.stat().st_size
+            if not copyFilter.wants(relPath, size):
+                continue
+            dest = os.path.join(destDir, entry.name)
+            try:
+                existing = os.lstat(dest)
+            except FileNotFoundError:
+                existing = None
+            candidates.append((copyFilter.rank(relPath),
+                               PlannedFile(entry.path, dest, size),
+                               existing))
+    for entry, relPath in subdirs:
+        _scan(entry.path, os.path.join(destDir, entry.name), relPath + '/',
+              copyFilter, dirs, candidates)
+
+
+def plan(sourcePath, destPath, store=None, limited=True, copyFilter=None):
+    """
+    A CopyPlan for the files under sourcePath
+
+    :param store: the DedupStore that the copy will go through, if any
+    :param limited: False to plan everything, whatever the space
+    :param copyFilter: a CopyFilter (default: from the config)
+    """
+    copyFilter = copyFilter or CopyFilter.fromConfig()
+    stat = os.statvfs(destPath)
+    blockSize = stat.f_frsize or stat.f_bsize
+    if limited:
+        result = CopyPlan(
+            sourcePath, destPath,
+            stat.f_bavail * blockSize - config.current().freeSpaceCushionBytes,
+            # Filesystems without inode limits report no inodes at all
+            stat.f_ffree if stat.f_files else None)
+    else:
+        result = CopyPlan(sourcePath, destPath)
+    dirs = []
+    candidates = []
+    _scan(sourcePath, destPath, '', copyFilter, dirs, candidates)
+    missing = set(dirs)
+    if not copyFilter.include:
+        # Those that don't fit are skipped with everything in them
+        for folder in dirs:
+            if os.path.dirname(folder) not in result.skippedDirs and \
+                    result.fits(blockSize, 1):
+                result.dirs.append(folder)
+                result.bytesNeeded += blockSize
+                result.inodesNeeded += 1
+            else:
+                result.skippedDirs.append(folder)
+    created = set(result.dirs)
+    # Stable, so scan order within a rank
+    candidates.sort(key=lambda candidate: candidate[0])
+    duplicates = set() if store is None else \
+        store.duplicates([(planned.source, planned.size)
+                          for _, planned, _ in candidates])
+    for _, planned, existing in candidates:
+        netBytes = 0 if planned.source in duplicates \
+            else _allocated(planned.size, blockSize)
+        # Files are replaced by unlinking them first, so only the last
+        #  link to one gives its blocks and inode back
+        replaced = existing is not None and existing.st_nlink == 1
+        if store is None:
+            inodes = 1
+        elif store.reflinks:
+            # A reflink is an inode of its own, as is a new object
+            inodes = 1 if planned.source in duplicates else 2
+        else:
+            # A hard link shares the object's inode, so only a new
+            #  object takes one
+            inodes = 0 if planned.source in duplicates else 1
+        if replaced:
+            netBytes -= existing.st_blocks * 512
+            inodes -= 1
+        # The folders that this is the first file copied into
+        folders = []
+        folder = os.path.dirname(planned.dest)
+        while folder in missing and folder not in created:
+            folders.append(folder)
+            folder = os.path.dirname(folder)
+        if folders and not copyFilter.include:
+            # Its folder didn't fit
+            result.skipped.append(planned)
+            continue
+        netBytes += blockSize * len(folders)
+        inodes += len(folders)
+        if result.fits(netBytes, inodes):
+            result.files.append(planned)
+            result.bytesNeeded += netBytes
+            result.inodesNeeded += inodes
+            created.update(folders)
+        else:
+            result.skipped.append(planned)
+    # Parents first
+    result.dirs = [folder for folder in dirs if folder in created]
+    logging.info("Copy plan: %s", result.summary())
+    return result
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content addressed store for files copied from USB sticks
+
+Sticks loaded through copy_from_usb often carry the same videos under
+different names, and copying each one again fills the SD card. With the
+copyDedup setting on, every copied file's content is kept once in the
+store (objects/<first 2 hex digits of its SHA-256>/<the rest>) and the
+file in the content folder is a reflink of it where the filesystem
+supports that, or else a hard link. Either way, identical files take the
+space of one.
+
+The index (index.bin) records the size and digest of every object. It's
+appended to as objects are added, so it's never rewritten, and a torn last
+entry from a power cut is ignored. Files are only hashed before copying
+if an object or another file being copied has the same size; otherwise
+they're hashed while they're copied, in the same pass.
+
+The store must be on the same filesystem as the content folder, but not
+in it, as it isn't to be served; by default it's a hidden folder beside
+it (see config.dedupStorePath). erase_folder empties it along with the
+content.
+
+Where there are no reflinks, an object and the files made from it are
+hard links of one file, so editing a copied file in place changes the
+object under its old digest. Objects are hashed again before anything
+else is linked to them, and dropped if they've changed. Hard linked
+objects that nothing in the content links to any more (e.g. the files
+were deleted) are pruned before each copy is planned.
+"""
+
+from collections import Counter
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import tempfile
+
+from . import telemetry
+
+# From <linux/fs.h>: clone (reflink) a whole file
+FICLONE = 0x40049409
+CHUNK_SIZE = 1 << 20
+
+
+def _reflink(source, dest):
+    with open(source, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            os.unlink(dest)
+            raise
+
+
+class DedupStore:
+
+    _MAGIC = b'CBDX'
+    _VERSION = 1
+    _HEADER = struct.Struct('<4sH')
+    # size, SHA-256 digest
+    _ENTRY = struct.Struct('<Q32s')
+
+    def __init__(self, root):
+        self.root = root
+        self.objectsPath = os.path.join(root, 'objects')
+        self.indexPath = os.path.join(root, 'index.bin')
+        # size -> digests of the objects of that size
+        self._bySize = {}
+        # (path, size, mtime) -> digest, so each file is hashed once
+        self._digests = {}
+        self.savedBytes = 0
+        self._saved = telemetry.counter(
+            'connectbox_copy_dedup_saved_bytes',
+            'Bytes not written because the content was already stored')
+        os.makedirs(self.objectsPath, exist_ok=True)
+        # Whether reflinks work here (and so are used, not hard links)
+        self._canReflink = self._probeReflink()
+        self._load()
+
+    @property
+    def reflinks(self):
+        """
+        Whether files are placed as reflinks of their objects (each an
+        inode of its own), not hard links (which share the object's)
+        """
+        return self._canReflink
+
+    def _probeReflink(self):
+        fd, probePath = tempfile.mkstemp(dir=self.root, prefix='.probe-')
+        os.close(fd)
+        try:
+            _reflink(probePath, probePath + '.clone')
+            os.unlink(probePath + '.clone')
+            return True
+        except OSError as e:
+            logging.debug("No reflinks in %s (%s); using hard links",
+                          self.root, e)
+            return False
+        finally:
+            os.unlink(probePath)
+
+    def _load(self):
+        try:
+            with open(self.indexPath, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            blob = b''
+        if blob[:self._HEADER.size] != \
+                self._HEADER.pack(self._MAGIC, self._VERSION):
+            self._rebuildIndex()
+            return
+        offset = self._HEADER.size
+        # A partial entry at the end (from a power cut) is ignored
+        while offset + self._ENTRY.size <= len(blob):
+            size, digest = self._ENTRY.unpack_from(blob, offset)
+            self._bySize.setdefault(size, set()).add(digest)
+            offset += self._ENTRY.size
+
+    def _rebuildIndex(self):
+        """Index the objects from their names, e.g. after a format change"""
+        logging.info("Rebuilding the dedup index in %s", self.root)
+        self._bySize = {}
+        entries = []
+        for dirpath, _, filenames in os.walk(self.objectsPath):
+            for name in filenames:
+                hexDigest = os.path.basename(dirpath) + name
+                try:
+                    digest = bytes.fromhex(hexDigest)
+                except ValueError:
+                    continue
+                if len(digest) != 32:
+                    continue
+                size = os.path.getsize(os.path.join(dirpath, name))
+                self._bySize.setdefault(size, set()).add(digest)
+                entries.append(self._ENTRY.pack(size, digest))
+        tmpPath = self.indexPath + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(self._HEADER.pack(self._MAGIC, self._VERSION))
+            f.write(b''.join(entries))
+        os.replace(tmpPath, self.indexPath)
+
+    def _addToIndex(self, size, digest):
+        self._bySize.setdefault(size, set()).add(digest)
+        with open(self.indexPath, 'ab') as f:
+            f.write(self._ENTRY.pack(size, digest))
+
+    def objectPath(self, digest):
+        hexDigest = digest.hex()
+        return os.path.join(self.objectsPath, hexDigest[:2], hexDigest[2:])
+
+    def contains(self, size, digest):
+        return digest in self._bySize.get(size, ())
+
+    def _verified(self, size, digest):
+        """
+        Whether the object still has the content that it's stored under,
+        dropping it if not
+        """
+        if self._canReflink:
+            # Files are reflinked, so changing them leaves the object be
+            return True
+        objectPath = self.objectPath(digest)
+        try:
+            intact = os.path.getsize(objectPath) == size and \
+                self.digest(objectPath) == digest
+        except FileNotFoundError:
+            intact = False
+        if not intact:
+            logging.warning("Dropping %s from the dedup store as its "
+                            "content has changed", objectPath)
+            if os.path.lexists(objectPath):
+                os.unlink(objectPath)
+            self._rebuildIndex()
+        return intact
+
+    def prune(self):
+        """
+        Remove the hard linked objects that no file links to any more
+
+        With reflinks, objects are never linked to, so it can't be told
+        whether they're in use and they're kept (until erase_folder).
+
+        :return: bytes freed
+        """
+        if self._canReflink:
+            return 0
+        removed = 0
+        freedBytes = 0
+        for dirpath, _, filenames in os.walk(self.objectsPath):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                stat = os.lstat(path)
+                if stat.st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+                    freedBytes += stat.st_blocks * 512
+        if removed:
+            logging.info("Pruned %d unused objects (%d bytes) from the "
+                         "dedup store", removed, freedBytes)
+            self._rebuildIndex()
+        return freedBytes
+
+    def digest(self, path):
+        """SHA-256 of the file at path (remembered for this store)"""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            digest = self._digests[key] = hasher.digest()
+        return digest
+
+    def duplicates(self, files):
+        """
+        The paths in files (a list of (path, size)) whose content is stored
+        or is that of an earlier file in the list
+
+        Only files whose size matches an object or another file in files
+        are hashed.
+        """
+        sizes = Counter(size for _, size in files)
+        seen = set()
+        found = set()
+        for path, size in files:
+            if size in self._bySize or sizes[size] > 1:
+                digest = self.digest(path)
+                if self.contains(size, digest) or (size, digest) in seen:
+                    found.add(path)
+                    continue
+                seen.add((size, digest))
+        return found
+
+    def newBytes(self, files):
+        """How many bytes copying files (a list of (path, size)) would add"""
+        duplicates = self.duplicates(files)
+        return sum(size for path, size in files if path not in duplicates)
+
+    def copy(self, source, dest, throttle=None, abort=None):
+        """
+        Put source's content at dest through the store
+
+        :param throttle: a CopyThrottle (see throttle.py) to pace writes with
+        :param abort: an Event that, once set, stops the copy part way
+          through (leaving neither dest nor an object)
+        :return: bytes written to the store (0 if it was already there)
+        """
+        size = os.path.getsize(source)
+        if size in self._bySize:
+            digest = self.digest(source)
+            if self.contains(size, digest) and \
+                    self._verified(size, digest):
+                self._place(self.objectPath(digest), dest)
+                self._recordSaved(size)
+                return 0
+        # Hashed while copying into the store, so it's read once
+        hasher = hashlib.sha256()
+        fd, tmpPath = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+        aborted = False
+        try:
+            with open(source, 'rb') as s, os.fdopen(fd, 'wb') as d:
+                for chunk in iter(lambda: s.read(CHUNK_SIZE), b''):
+                    if abort is not None and abort.is_set():
+                        aborted = True
+                        break
+                    hasher.update(chunk)
+                    d.write(chunk)
+                    if throttle is not None:
+                        throttle.pace(len(chunk))
+            if aborted:
+                os.unlink(tmpPath)
+                return 0
+            shutil.copystat(source, tmpPath)
+            digest = hasher.digest()
+            objectPath = self.objectPath(digest)
+            if self.contains(size, digest) and \
+                    self._verified(size, digest):
+                # Another file being copied had the same content
+                os.unlink(tmpPath)
+                written = 0
+                self._recordSaved(size)
+            else:
+                os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+                os.replace(tmpPath, objectPath)
+                # Hashed as it was written, so it's verified
+                self._digests[(objectPath, size,
+                               os.stat(objectPath).st_mtime_ns)] = digest
+                self._addToIndex(size, digest)
+                written = size
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+        self._place(objectPath, dest)
+        return written
+
+    def _recordSaved(self, size):
+        self.savedBytes += size
+        self._saved.inc(size)
+
+    def _place(self, objectPath, dest):
+        """Make dest a reflink (or failing that, a hard link) of the object"""
+        if os.path.lexists(dest):
+            if os.path.samefile(objectPath, dest):
+                return
+            os.unlink(dest)
+        if self._canReflink:
+            try:
+                _reflink(objectPath, dest)
+                shutil.copystat(objectPath, dest)
+                return
+            except OSError as e:
+                # e.g. the content is on another filesystem
+                logging.debug("Unable to reflink %s (%s); using hard links",
+                              dest, e)
+                self._canReflink = False
+        try:
+            os.link(objectPath, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # e.g. the store isn't on the content's filesystem
+            logging.warning("Unable to link %s to %s (%s); copying", dest,
+                            objectPath, e)
+            shutil.copy2(objectPath, dest)
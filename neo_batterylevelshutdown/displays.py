@@ -1,27 +1,55 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os
 import threading
-from PIL import Image
-from .HAT_Utilities import get_device
-from . import page_none
-from . import page_main
-from . import page_battery
-from . import page_info
-from . import page_stats
-from . import page_memory
-from . import page_battery_low
-from . import page_display_image
+import time
+from . import config
+from . import telemetry
+
+# PIL, psutil and the page modules are only imported once an OLED is created,
+#  so that importing this module (e.g. for DummyDisplay) stays cheap and the
+#  daemon can arm its shutdown handling before paying for those imports
+
 
 class DummyDisplay:
 
-    def __init__(self, powerManagementDevice):
+    def __init__(self, powerManagementDevice, metrics=None):
         pass
 
     def moveForward(self):
         pass
 
+    def showStatusPages(self):
+        pass
+
+    showAdminPages = resetPages = showConfirmPage = showStatusPages
+
+    def checkIfLastPage(self):
+        return True
+
+    def getAdminPageName(self):
+        return ''
+
+    def showStatusPage(self, index):
+        pass
+
+    def setContrast(self, level):
+        pass
+
+    def refreshPage(self):
+        pass
+
+    # Admin commands can be run over the control socket without an OLED,
+    #  so the pages they show need to exist
+    def showWaitPage(self):
+        pass
+
+    showRemoveUsbPage = showNoUsbPage = showNoSpacePage = showWaitPage
+    showSuccessPage = showErrorPage = showShutdownPage = showWaitPage
+
+    def showCopyRateLimit(self, rateLimit):
+        pass
+
     def moveBackward(self):
         pass
 
@@ -45,17 +73,50 @@ class OLED:
     # What to show after startup and blank screen
     STARTING_PAGE_INDEX = 0  # the main page
 
-    def __init__(self, powerManagementDevice):
+    def __init__(self, powerManagementDevice, metrics=None):
+        from . import page_none
+        from . import page_main
+        from . import page_battery
+        from . import page_info
+        from . import page_stats
+        from . import page_memory
+        from . import page_battery_low
+        from . import page_shutdown
+        from . import page_display_image
+        from . import page_history
+        from . import page_wait
+        # Kept for the show*Page methods, which create pages on demand
+        self.page_display_image = page_display_image
+        self.page_wait = page_wait
         # rename this.... perhaps it doesn't even need to be stored
         self.axp = powerManagementDevice
-        self.display_device = get_device()
+        # The display backend (see backends.py), shared with display
+        #  detection so the panel is only set up once. Pages draw for its
+        #  logical 128x64 size whatever the panel
+        from . import backends
+        self.display_device = backends.sharedBackend()
         self.blank_page = page_none.PageBlank(self.display_device)
         self.low_battery_page = \
             page_battery_low.PageBatteryLow(self.display_device)
+        self.shutdown_page = page_shutdown.PageShutdown(self.display_device)
         self.statusPages = [
             page_main.PageMain(self.display_device, self.axp),
             page_info.PageInfo(self.display_device),
             page_battery.PageBattery(self.display_device, self.axp),
+        ]
+        if metrics is not None:
+            # History of what's on the preceding pages
+            self.statusPages += [
+                page_history.PageHistory(
+                    self.display_device, metrics, 'battery', 'Battery %'),
+                page_history.PageHistory(
+                    self.display_device, metrics, 'current', 'Current mA'),
+                page_history.PageHistory(
+                    self.display_device, metrics, 'cpu_temp', 'CPU C'),
+                page_history.PageHistory(
+                    self.display_device, metrics, 'clients', 'Users'),
+            ]
+        self.statusPages += [
             page_memory.PageMemory(self.display_device),
             page_stats.PageStats(self.display_device, 'hour', 1),
             page_stats.PageStats(self.display_device, 'hour', 2),
@@ -78,130 +139,126 @@ class OLED:
             'exit'
         ]
 
+        # The stack of pages that the buttons move through, and where in
+        #  it we are. pageIndex is None while showing a page that isn't in
+        #  the stack (e.g. the blank page, or a command's result)
         self.pages = self.statusPages
-        self.pageStack = 'status'
+        self.pageIndex = self.STARTING_PAGE_INDEX
 
-        self._curPage = self.pages[self.STARTING_PAGE_INDEX]
+        self._curPage = self.pages[self.pageIndex]
         # callbacks run in another thread, so we need to lock access to the
         #  current page variable as it can be modified from the main loop
         #  and from callbacks
         self._curPageLock = threading.Lock()
+        # luma doesn't expose the contrast it's using, so assume its default
+        #  until we set one
+        self.contrast = None
+        self._redrawSeconds = telemetry.histogram(
+            'connectbox_display_redraw_seconds',
+            'Time taken to draw a page and push it to the OLED')
         # draw the connectbox logo - classes containing an OLED display
         #  manage timeouts and timed display power-downs, so we leave that
         #  as an exercise for anyone using this class
         self.drawLogo()
 
+    def _drawCurrentPage(self):
+        startTime = time.monotonic()
+        with telemetry.timed('draw_' + type(self._curPage).__name__.lower()):
+            self._curPage.draw_page()
+        self._redrawSeconds.observe(time.monotonic() - startTime)
+
     def getAdminPageName(self):
-        try:
-            return  self.adminPageNames[self.adminPages.index(self._curPage)]
-        except:
+        if self.pages is not self.adminPages or self.pageIndex is None:
             return ''
+        return self.adminPageNames[self.pageIndex]
 
     def checkIfLastPage(self):
-        return True if self._curPage == self.pages[-1] else False
+        return self.pageIndex == len(self.pages) - 1
 
-    def showRemoveUsbPage(self):
+    def _showImagePage(self, name):
+        """Draw one of the pages that isn't part of a stack"""
         with self._curPageLock:
-            logging.debug("Showing remove usb page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'remove_usb.png')
-            self._curPage.draw_page()
+            logging.debug("Showing %s", name)
+            self.pageIndex = None
+            self._curPage = self.page_display_image.PageDisplayImage(
+                self.display_device, name)
+            self._drawCurrentPage()
+
+    def showRemoveUsbPage(self):
+        self._showImagePage('remove_usb.png')
 
     def showNoUsbPage(self):
-        with self._curPageLock:
-            logging.debug("Showing no usb page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'error_no_usb.png')
-            self._curPage.draw_page()
+        self._showImagePage('error_no_usb.png')
 
     def showNoSpacePage(self):
-        with self._curPageLock:
-            logging.debug("Showing no space page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'error_no_space.png')
-            self._curPage.draw_page()
+        self._showImagePage('error_no_space.png')
 
     def showWaitPage(self):
+        self._showImagePage('wait.png')
+
+    def showCopyRateLimit(self, rateLimit):
+        """The wait page, with the rate that the copy is limited to"""
         with self._curPageLock:
-            logging.debug("Showing wait page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'wait.png')
-            self._curPage.draw_page()
+            self.pageIndex = None
+            self._curPage = self.page_wait.PageWait(self.display_device,
+                                                    rateLimit)
+            self._drawCurrentPage()
 
     def showConfirmPage(self):
-        with self._curPageLock:
-            logging.debug("Showing confirm choice page")
-            self.pageStack = 'confirm'
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'confirm.png')
-            self._curPage.draw_page()
+        self._showImagePage('confirm.png')
 
     def showSuccessPage(self):
-        with self._curPageLock:
-            logging.debug("Showing success page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'success.png')
-            self._curPage.draw_page()
+        self._showImagePage('success.png')
 
     def showErrorPage(self):
-        with self._curPageLock:
-            logging.debug("Showing error page")
-            self._curPage = page_display_image.PageDisplayImage(self.display_device, 'error.png')
-            self._curPage.draw_page()
+        self._showImagePage('error.png')
 
-    def switchPages(self):
-        '''
-        This method is to switch between the original stack of pages referred to as status pages and the new stack
-        of pages referred to as admin pages.  This is based upon the variable pageStack.
-        :return: Nothing
-        '''
+    def _showPage(self, pages, index):
+        """Move to pages[index] and draw it"""
         with self._curPageLock:
-            logging.debug("Previous page stack: {}".format(self.pageStack))
-            self.pages = self.statusPages if self.pageStack == 'admin' else self.adminPages
-            self.pageStack = 'status' if self.pageStack == 'admin' else 'admin'
-            logging.debug("Current page stack: {}".format(self.pageStack))
-            self._curPage = self.pages[0]
-
+            self.pages = pages
+            self.pageIndex = index
+            self._curPage = pages[index]
             # draw the page while holding the lock, so that it doesn't change
             #  underneath us
-            self._curPage.draw_page()
+            self._drawCurrentPage()
             logging.debug("Transitioned to page %s", self._curPage)
 
-    def moveForward(self):
-        with self._curPageLock:
-            logging.debug("Current page is %s", self._curPage)
-            if self._curPage not in self.pages:
-                # Always start with the starting page if the screen went off
-                #  or if we were showing the low battery page
-                self._curPage = self.pages[self.STARTING_PAGE_INDEX]
-            else:
-                # move forward in the page list
-                # If we're at the end of the page list, go to the start
-                if self._curPage == self.pages[-1]:
-                    self._curPage = self.pages[0]
-                else:
-                    self._curPage = \
-                        self.pages[self.pages.index(self._curPage) + 1]
+    def showStatusPage(self, index):
+        """Jump straight to statusPages[index]"""
+        self._showPage(self.statusPages, index)
 
-            # draw the page while holding the lock, so that it doesn't change
-            #  underneath us
-            self._curPage.draw_page()
-            logging.debug("Transitioned to page %s", self._curPage)
+    def showStatusPages(self):
+        """The first of the original stack of pages, the status pages"""
+        self._showPage(self.statusPages, 0)
 
-    def moveBackward(self):
+    def showAdminPages(self):
+        """The first of the stack of pages referred to as admin pages"""
+        self._showPage(self.adminPages, 0)
+
+    def resetPages(self):
+        """Start from the starting status page next time, without drawing"""
         with self._curPageLock:
-            logging.debug("Current page is %s", self._curPage)
-            if self._curPage not in self.pages:
-                # Always start with the starting page if the screen went off
-                #  or if we were showing the low battery page
-                self._curPage = self.pages[self.STARTING_PAGE_INDEX]
-            else:
-                # move backwards in the page list
-                # If we're at the start of the page list, go to the start
-                if self._curPage == self.pages[0]:
-                    self._curPage = self.pages[-1]
-                else:
-                    self._curPage = \
-                        self.pages[self.pages.index(self._curPage) - 1]
+            self.pages = self.statusPages
+            self.pageIndex = None
+
+    def _step(self, offset):
+        if self.pageIndex is None:
+            # Always start with the starting page if the screen went off
+            #  or if we were showing the low battery page
+            index = self.STARTING_PAGE_INDEX
+        else:
+            # Wrap around at either end of the page list
+            index = (self.pageIndex + offset) % len(self.pages)
+        self._showPage(self.pages, index)
 
-            # draw the page while holding the lock, so that it doesn't change
-            #  underneath us
-            self._curPage.draw_page()
-            logging.debug("Transitioned to page %s", self._curPage)
+    def moveForward(self):
+        logging.debug("Current page is %s", self._curPage)
+        self._step(1)
+
+    def moveBackward(self):
+        logging.debug("Current page is %s", self._curPage)
+        self._step(-1)
 
     def showLowBatteryWarning(self):
         if self._curPage == self.low_battery_page:
@@ -210,14 +267,42 @@ class OLED:
 
         with self._curPageLock:
             logging.debug("Current page is %s", self._curPage)
+            self.pageIndex = None
             self._curPage = self.low_battery_page
-            self._curPage.draw_page()
+            self._drawCurrentPage()
             logging.debug("Transitioned to page %s", self._curPage)
 
     def hideLowBatteryWarning(self):
         if self._curPage == self.low_battery_page:
             self.powerOffDisplay()
 
+    def setContrast(self, level):
+        """Set the OLED contrast (0-255); lower draws less current"""
+        if level != self.contrast:
+            self.display_device.contrast(level)
+            self.contrast = level
+
+    def refreshPage(self):
+        """Redraw the current page if it's a status page, for live values"""
+        with self._curPageLock:
+            if self.pages is self.statusPages and self.pageIndex is not None:
+                self._drawCurrentPage()
+
+    def showShutdownPage(self):
+        # Called while shutting down, so don't wait on a page that's being
+        #  drawn by another thread for long
+        locked = self._curPageLock.acquire(timeout=0.2)
+        try:
+            self.pageIndex = None
+            self._curPage = self.shutdown_page
+            self.setContrast(config.current().displayContrast)
+            self._drawCurrentPage()
+            # Don't leave it for a deferred e-paper refresh
+            self.display_device.flush()
+        finally:
+            if locked:
+                self._curPageLock.release()
+
     def powerOffDisplay(self):
         if self._curPage == self.blank_page:
             # nothing to do
@@ -225,20 +310,15 @@ class OLED:
 
         with self._curPageLock:
             logging.debug("Current page is %s", self._curPage)
+            self.pageIndex = None
             self._curPage = self.blank_page
-            self._curPage.draw_page()
+            self._drawCurrentPage()
             logging.debug("Transitioned to page %s", self._curPage)
 
     # Ideally this should be a page, like the low battery page
     def drawLogo(self):
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/connectbox_logo.png'
-        logo = Image.open(img_path).convert("RGBA")
-        fff = Image.new(logo.mode, logo.size, (255,) * 4)
-        background = Image.new("RGBA", self.display_device.size, "black")
-        posn = ((self.display_device.width - logo.width) // 2, 0)
-        img = Image.composite(logo, fff, logo)
-        background.paste(img, posn)
-        self.display_device.display(
-            background.convert(self.display_device.mode)
-        )
+        from . import framebuffer
+        logo = framebuffer.background('connectbox_logo.png')
+        frame = framebuffer.blank(self.display_device, framebuffer.BLACK)
+        frame.paste(logo, (self.display_device.width - logo.width) // 2, 0)
+        framebuffer.show(self.display_device, frame)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional OpenMetrics (Prometheus) endpoint for HAT telemetry
+
+Serves GET /metrics from a background thread. Scrapes are answered from the
+HAT's cached sensor snapshot and the in-process telemetry registry, so they
+never touch the I2C bus or spawn processes, no matter how often the fleet
+is scraped.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import math
+import threading
+
+from . import telemetry
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# snapshot field -> (metric name, help)
+SNAPSHOT_GAUGES = (
+    ('batteryGauge', 'connectbox_battery_gauge_percent',
+     'Battery charge reported by the AXP209 fuel gauge'),
+    ('batteryVoltage', 'connectbox_battery_voltage_millivolts',
+     'Battery voltage'),
+    ('batteryCurrent', 'connectbox_battery_current_milliamps',
+     'Battery discharge current (negative while charging)'),
+    ('charging', 'connectbox_charger_connected',
+     'Whether external power is connected'),
+    ('axpTemperature', 'connectbox_axp209_temperature_celsius',
+     'AXP209 internal temperature'),
+    ('cpuTemperature', 'connectbox_cpu_temperature_celsius',
+     'CPU temperature'),
+    ('connectedUsers', 'connectbox_wifi_stations',
+     'Number of stations associated with the access point'),
+    ('throughput', 'connectbox_wifi_throughput_bytes_per_second',
+     'Wifi traffic (sent plus received) over the last sample interval'),
+    ('time', 'connectbox_snapshot_timestamp_seconds',
+     'When the sensor snapshot was taken'),
+)
+
+
+def _formatValue(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render(snapshot):
+    """OpenMetrics text for snapshot (may be None) and the registry"""
+    lines = []
+    for field, name, documentation in SNAPSHOT_GAUGES:
+        value = getattr(snapshot, field, None)
+        if value is None:
+            continue
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('# HELP %s %s' % (name, documentation))
+        lines.append('%s %s' % (name, _formatValue(value)))
+    for metric in telemetry.registered():
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        for sampleName, labels, value in metric.samples():
+            lines.append('%s%s %s' % (sampleName, labels,
+                                      _formatValue(value)))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+
+    def __init__(self, hat, port, address='127.0.0.1'):
+        """
+        :param address: the address to listen on; by default, only this
+          machine (the hotspot's clients aren't to see the metrics)
+        """
+        self.hat = hat
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render(getattr(exporter.hat, 'snapshot', None))\
+                    .encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # pylint: disable=redefined-builtin
+                logging.debug("exporter: " + format, *args)
+
+        self.server = HTTPServer((address, port), Handler)
+
+    def start(self):
+        """Serve from a daemon thread, so it never blocks shutdown"""
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='metrics-exporter', daemon=True)
+        thread.start()
+        logging.info("Serving metrics on %s port %s",
+                     *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
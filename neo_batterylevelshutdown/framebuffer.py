@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+1-bit frame composition for the pages
+
+The OLED is 1-bit, so rather than drawing in RGBA, compositing against
+white and converting (several full frame passes per redraw), pages start
+from a copy of a background that was binarised once and draw on it with
+bitwise operations. Each row of a Bitmap is a Python int with the leftmost
+pixel in the most significant bit, so blitting a glyph or filling a
+rectangle costs one shift, mask and OR/AND per row it covers, and the
+packed rows are exactly the bytes of a PIL mode '1' image.
+
+Pixel values follow PIL's mode '1': WHITE (1) and BLACK (0). Pages draw
+black on white.
+
+PIL is still used, but only to decode assets that aren't in the asset pack
+(see assetpack.py), to rasterise glyphs the first time that each is needed
+(printable ASCII is kept on disk between runs; see atlas.py) and to wrap the
+finished frame for luma. Assets shown unchanged skip PIL (see showAsset).
+"""
+
+import functools
+import os.path
+import threading
+
+from . import telemetry
+
+BLACK = 0
+WHITE = 1
+
+ASSETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'assets')
+FONT_PATH = os.path.join(ASSETS_PATH, 'connectbox.ttf')
+
+
+class Bitmap:
+
+    def __init__(self, width, height, rows=None):
+        self.width = width
+        self.height = height
+        self.rows = list(rows) if rows is not None else [0] * height
+        self.fullMask = (1 << width) - 1
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @classmethod
+    def fromBytes(cls, width, height, data):
+        """From rows packed like a PIL mode '1' image (rows padded to bytes)"""
+        stride = (width + 7) // 8
+        pad = stride * 8 - width
+        return cls(width, height, [
+            int.from_bytes(data[y * stride:(y + 1) * stride], 'big') >> pad
+            for y in range(height)])
+
+    def toBytes(self):
+        stride = (self.width + 7) // 8
+        pad = stride * 8 - self.width
+        return b''.join((row << pad).to_bytes(stride, 'big')
+                        for row in self.rows)
+
+    @classmethod
+    def fromImage(cls, image):
+        """From a PIL image, which is converted to mode '1' if need be"""
+        if image.mode != '1':
+            image = image.convert('1')
+        return cls.fromBytes(image.width, image.height, image.tobytes())
+
+    @classmethod
+    def fromPages(cls, width, height, data):
+        """From SSD1306 page layout (see toPages)"""
+        rows = [0] * height
+        for y in range(height):
+            base = (y >> 3) * width
+            bit = 1 << (y & 7)
+            row = 0
+            for x in range(width):
+                row = row << 1 | (1 if data[base + x] & bit else 0)
+            rows[y] = row
+        return cls(width, height, rows)
+
+    def toPages(self):
+        """
+        The pixels in SSD1306 page layout
+
+        Each page is 8 rows. It's sent as one byte per column, left to right,
+        with the top row of the page in the least significant bit.
+        """
+        data = bytearray(self.width * ((self.height + 7) // 8))
+        for y, row in enumerate(self.rows):
+            base = (y >> 3) * self.width + self.width - 1
+            bit = 1 << (y & 7)
+            x = 0
+            while row:
+                if row & 1:
+                    data[base - x] |= bit
+                row >>= 1
+                x += 1
+        return bytes(data)
+
+    def toImage(self):
+        from PIL import Image
+        return Image.frombytes('1', self.size, self.toBytes())
+
+    def scaled(self, factor):
+        """A copy factor times the size, each pixel becoming a square"""
+        if factor == 1:
+            return self.copy()
+        table = _expansionTable(factor)
+        stride = (self.width + 7) // 8
+        pad = stride * 8 - self.width
+        rows = []
+        for row in self.rows:
+            wide = 0
+            for byte in (row << pad).to_bytes(stride, 'big'):
+                wide = wide << (8 * factor) | table[byte]
+            rows.extend([wide >> (pad * factor)] * factor)
+        return self.__class__(self.width * factor, self.height * factor, rows)
+
+    def getpixel(self, x, y):
+        return self.rows[y] >> (self.width - 1 - x) & 1
+
+    def copy(self):
+        return self.__class__(self.width, self.height, self.rows)
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.size == other.size and \
+            self.rows == other.rows
+
+
+@functools.lru_cache(maxsize=None)
+def _expansionTable(factor):
+    """Each byte value with every bit repeated factor times"""
+    table = []
+    for byte in range(256):
+        wide = 0
+        for bit in range(7, -1, -1):
+            wide = wide << factor | (((1 << factor) - 1)
+                                     if byte >> bit & 1 else 0)
+        table.append(wide)
+    return table
+
+
+class FrameBuffer(Bitmap):
+
+    def _place(self, row, rowWidth, x):
+        """row (rowWidth bits wide) moved to start at column x, clipped"""
+        shift = self.width - x - rowWidth
+        row = row << shift if shift >= 0 else row >> -shift
+        return row & self.fullMask
+
+    def fill(self, color):
+        self.rows = [self.fullMask if color else 0] * self.height
+
+    def paste(self, bitmap, x=0, y=0):
+        """Copy bitmap over the frame with its top left at (x, y)"""
+        spanMask = self._place(bitmap.fullMask, bitmap.width, x)
+        for sourceY in range(max(0, -y), min(bitmap.height, self.height - y)):
+            row = self.rows[y + sourceY] & ~spanMask
+            self.rows[y + sourceY] = row | self._place(
+                bitmap.rows[sourceY], bitmap.width, x)
+
+    def blit(self, mask, x, y, color=BLACK):
+        """Set the pixels that are 1 in mask (at x, y) to color"""
+        for sourceY in range(max(0, -y), min(mask.height, self.height - y)):
+            bits = self._place(mask.rows[sourceY], mask.width, x)
+            if color:
+                self.rows[y + sourceY] |= bits
+            else:
+                self.rows[y + sourceY] &= ~bits
+
+    def rectangle(self, box, color=BLACK):
+        """Fill (x0, y0, x1, y1), inclusive like ImageDraw.rectangle"""
+        x0, y0, x1, y1 = box
+        x0, x1 = max(0, min(x0, x1)), min(self.width - 1, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.height - 1, max(y0, y1))
+        if x0 > x1 or y0 > y1:
+            return
+        bits = self._place((1 << (x1 - x0 + 1)) - 1, x1 - x0 + 1, x0)
+        for y in range(y0, y1 + 1):
+            if color:
+                self.rows[y] |= bits
+            else:
+                self.rows[y] &= ~bits
+
+    def line(self, box, color=BLACK, width=1):
+        """A line from (x0, y0) to (x1, y1) of (roughly) width pixels"""
+        x0, y0, x1, y1 = box
+        if x0 == x1 or y0 == y1:
+            # Straight lines (e.g. sparkline columns) are rectangles
+            self.rectangle((x0, y0, x1 + width - 1, y1 + width - 1)
+                           if x0 == x1 else
+                           (x0, y0, x1, y1 + width - 1), color)
+            return
+        # Bresenham, with a width x width square at each point
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        stepX = 1 if x0 < x1 else -1
+        stepY = 1 if y0 < y1 else -1
+        error = dx + dy
+        offset = (width - 1) // 2
+        while True:
+            self.rectangle((x0 - offset, y0 - offset,
+                            x0 - offset + width - 1, y0 - offset + width - 1),
+                           color)
+            if x0 == x1 and y0 == y1:
+                return
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x0 += stepX
+            if doubled <= dx:
+                error += dx
+                y0 += stepY
+
+    def text(self, xy, text, font, color=BLACK):
+        """Draw text with its top left at xy, like ImageDraw.text"""
+        x, y = xy
+        for char in text:
+            mask, advance = font.glyph(char)
+            self.blit(mask, x, y, color)
+            x += advance
+
+
+class Font:
+    """connectbox.ttf (or another TrueType font) at one size, as bitmaps"""
+
+    def __init__(self, size, path=FONT_PATH):
+        self.size = size
+        self.path = path
+        # char -> (mask Bitmap, advance)
+        self._glyphs = {}
+        self._freetype = None
+        self._atlasLoaded = False
+
+    def _loadAtlas(self):
+        # ASCII comes from the atlas saved by an earlier run (see atlas.py)
+        #  so FreeType is usually never started
+        from . import atlas
+        self._atlasLoaded = True
+        self._glyphs.update(
+            atlas.load(self.path, self.size, self._rasterise).glyphs)
+
+    def _rasterise(self, char):
+        from PIL import Image, ImageDraw, ImageFont
+        if self._freetype is None:
+            self._freetype = ImageFont.truetype(self.path, self.size)
+        width, height = self._freetype.getsize(char)
+        # Drawn in ink (1) on nothing (0) so the result is a mask
+        image = Image.new('1', (max(width, 1), max(height, 1)), 0)
+        ImageDraw.Draw(image).text((0, 0), char, font=self._freetype, fill=1)
+        return Bitmap.fromImage(image), width
+
+    def glyph(self, char):
+        """(mask, advance) for char, rasterised on first use"""
+        try:
+            return self._glyphs[char]
+        except KeyError:
+            if not self._atlasLoaded:
+                self._loadAtlas()
+                if char in self._glyphs:
+                    return self._glyphs[char]
+            glyph = self._glyphs[char] = self._rasterise(char)
+            return glyph
+
+    def textsize(self, text):
+        """(width, height) of text, like ImageDraw.textsize"""
+        glyphs = [self.glyph(char) for char in text]
+        return (sum(advance for _, advance in glyphs),
+                max([mask.height for mask, _ in glyphs] or [0]))
+
+
+_cacheLock = threading.Lock()
+_fonts = {}
+_backgrounds = {}
+
+
+def font(size):
+    """The shared Font for connectbox.ttf at size"""
+    with _cacheLock:
+        if size not in _fonts:
+            _fonts[size] = Font(size)
+        return _fonts[size]
+
+
+def binarise(image):
+    """
+    A transparent asset composited against white and converted to 1-bit
+
+    This is what the pages used to do on every draw.
+    """
+    from PIL import Image
+    base = image.convert('RGBA')
+    white = Image.new(base.mode, base.size, (255,) * 4)
+    return Bitmap.fromImage(Image.composite(base, white, base))
+
+
+def background(name):
+    """A FrameBuffer to draw on, starting with assets/name"""
+    with _cacheLock:
+        bitmap = _backgrounds.get(name)
+        if bitmap is None:
+            from . import assetpack
+            pack = assetpack.installed()
+            bitmap = pack and pack.bitmap(name)
+            if bitmap:
+                _backgrounds[name] = bitmap
+        if bitmap is None:
+            from PIL import Image
+            path = os.path.join(ASSETS_PATH, name)
+            if not os.path.isfile(path):
+                path = os.path.join(ASSETS_PATH, 'error.png')
+            with Image.open(path) as image:
+                bitmap = _backgrounds[name] = binarise(image)
+    return FrameBuffer(bitmap.width, bitmap.height, bitmap.rows)
+
+
+def blank(device, color=WHITE):
+    """A FrameBuffer the size of device, filled with color"""
+    frame = FrameBuffer(device.width, device.height)
+    frame.fill(color)
+    return frame
+
+
+def show(device, frame):
+    """Push a finished frame to device (a luma device or a display backend)"""
+    if hasattr(device, 'pushFrame'):
+        # A backend (see backends.py), which lays it out for its panel
+        device.pushFrame(frame)
+        return
+    image = frame.toImage()
+    if device.mode != '1':
+        image = image.convert(device.mode)
+    device.display(image)
+    device.show()
+
+
+def canPushPages(device, width, height):
+    """
+    True if page layout data can go straight to device (see _pushPages)
+
+    That's what luma's display() does after packing the image, so it's only
+    done when that packing would be a plain copy: a mode '1' SSD1306 (or
+    similar) of the same size that isn't rotated.
+    """
+    return device.mode == '1' and not getattr(device, 'rotate', 0) and \
+        (device.width, device.height) == (width, height) and \
+        hasattr(getattr(device, '_const', None), 'PAGEADDR')
+
+
+def _pushPages(device, width, height, data):
+    """Send page layout data to a luma device; False if it can't take it"""
+    if not canPushPages(device, width, height):
+        return False
+    const = device._const  # pylint: disable=protected-access
+    with telemetry.timed('device_display'):
+        # pylint: disable=protected-access
+        device.command(const.COLUMNADDR, device._colstart,
+                       device._colend - 1,
+                       const.PAGEADDR, 0x00, device._pages - 1)
+        device.data(list(data))
+    device.show()
+    return True
+
+
+def showAsset(device, name):
+    """Push assets/name as it is, from the asset pack if possible"""
+    if hasattr(device, 'pushFrame'):
+        device.pushFrame(background(name))
+        return
+    from . import assetpack
+    pack = assetpack.installed()
+    entry = pack and pack.get(name)
+    if not entry or not _pushPages(device, *entry):
+        show(device, background(name))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+CPU frequency and Wi-Fi transmit power policy driven by the battery state
+
+There are three profiles:
+
+* performance: on external power. The ondemand governor, uncapped, and the
+  driver's choice of transmit power
+* balanced: on battery. The conservative governor, the maximum frequency
+  capped and transmit power reduced
+* saver: on a low battery, or when the battery is predicted to run out
+  soon. The powersave governor, a lower cap and the lowest transmit power
+
+Transmit power also drops to the saver level when nobody is connected, as
+there's no one to reach. Moving to a lower power profile happens as soon as
+it's called for, but moving back up from saver needs the battery to be
+governorHysteresisPerc above the threshold and the saver profile to have
+been in use for governorMinDwellSecs, so that a gauge bouncing around the
+threshold doesn't flip settings back and forth. Plugging in external power
+always moves straight to performance.
+
+In dry run mode, changes are logged but not made.
+"""
+
+from collections import namedtuple
+import logging
+import os.path
+import subprocess
+
+from . import config
+from . import telemetry
+from .hardware import clock
+
+Profile = namedtuple('Profile',
+                     'name governor maxFreqPercSetting txPowerSetting')
+
+# maxFreqPercSetting and txPowerSetting name config settings; None means
+#  uncapped and the driver's default respectively
+PROFILES = {
+    'performance': Profile('performance', 'ondemand', None, None),
+    'balanced': Profile('balanced', 'conservative',
+                        'governorBalancedMaxFreqPerc',
+                        'wifiTxPowerBalancedDbm'),
+    'saver': Profile('saver', 'powersave', 'governorSaverMaxFreqPerc',
+                     'wifiTxPowerSaverDbm'),
+}
+
+
+class PowerGovernor:
+
+    CPUFREQ_PATH = '/sys/devices/system/cpu/cpufreq/policy0'
+
+    def __init__(self, dryRun=False, cpufreqPath=CPUFREQ_PATH, iface='wlan0'):
+        self.dryRun = dryRun
+        self.cpufreqPath = cpufreqPath
+        self.iface = iface
+        self.profile = None
+        self.profileSince = None
+        # What we last set, so that only changes are written
+        self.applied = {}
+        self.runCommand = subprocess.call
+        self._profileGauge = telemetry.gauge(
+            'connectbox_power_profile',
+            'Power profile in use: 2 performance, 1 balanced, 0 saver')
+
+    def chooseProfile(self, gauge, charging, minutesLeft):
+        """The profile for the battery state, allowing for hysteresis"""
+        if charging or gauge is None or gauge < 0:
+            return PROFILES['performance']
+        cfg = config.current()
+        threshold = cfg.governorSaverBelowPerc
+        minutes = cfg.governorSaverMinutesToEmpty
+        if self.profile is PROFILES['saver']:
+            # Stay put until well clear of the thresholds, and for a while
+            if clock.time() - self.profileSince < cfg.governorMinDwellSecs:
+                return self.profile
+            threshold += cfg.governorHysteresisPerc
+            minutes *= 1.2
+        if gauge < threshold or \
+                (minutesLeft is not None and minutesLeft < minutes):
+            return PROFILES['saver']
+        return PROFILES['balanced']
+
+    def update(self, gauge, charging, minutesLeft, connectedUsers):
+        """Pick and apply a profile for the latest battery check"""
+        profile = self.chooseProfile(gauge, charging, minutesLeft)
+        if profile is not self.profile:
+            logging.info("Power profile: %s (battery %s%%, charging %s, "
+                         "%s minutes left)", profile.name, gauge, charging,
+                         minutesLeft)
+            self.profile = profile
+            self.profileSince = clock.time()
+            self._profileGauge.set(
+                ('saver', 'balanced', 'performance').index(profile.name))
+
+        cfg = config.current()
+        self._setGovernor(profile.governor)
+        self._setMaxFreqPerc(
+            getattr(cfg, profile.maxFreqPercSetting)
+            if profile.maxFreqPercSetting else 100)
+        txPower = getattr(cfg, profile.txPowerSetting) \
+            if profile.txPowerSetting else None
+        if connectedUsers == 0 and not charging:
+            txPower = cfg.wifiTxPowerSaverDbm
+        self._setTxPower(txPower)
+
+    def _changed(self, setting, value):
+        if self.applied.get(setting, object()) == value:
+            return False
+        self.applied[setting] = value
+        if self.dryRun:
+            logging.info("Dry run: would set %s to %s", setting, value)
+            return False
+        logging.debug("Setting %s to %s", setting, value)
+        return True
+
+    def _readCpufreq(self, name):
+        try:
+            with open(os.path.join(self.cpufreqPath, name)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _writeCpufreq(self, name, value):
+        try:
+            with open(os.path.join(self.cpufreqPath, name), 'w') as f:
+                f.write(str(value))
+        except OSError as e:
+            logging.warning("Unable to set %s: %s", name, e)
+
+    def _setGovernor(self, governor):
+        available = self._readCpufreq('scaling_available_governors')
+        if available is not None and governor not in available.split():
+            logging.debug("cpufreq governor %s isn't available", governor)
+            return
+        if self._changed('scaling_governor', governor):
+            self._writeCpufreq('scaling_governor', governor)
+
+    def _setMaxFreqPerc(self, percent):
+        try:
+            lowest = int(self._readCpufreq('cpuinfo_min_freq'))
+            highest = int(self._readCpufreq('cpuinfo_max_freq'))
+        except (TypeError, ValueError):
+            # No cpufreq support
+            return
+        # The kernel rounds to a frequency that the CPU supports
+        freq = max(lowest, highest * percent // 100)
+        if self._changed('scaling_max_freq', freq):
+            self._writeCpufreq('scaling_max_freq', freq)
+
+    def _setTxPower(self, dbm):
+        if self.iface is None or not self._changed('txpower', dbm):
+            return
+        # iw takes mBm
+        args = ['auto'] if dbm is None else ['fixed', str(int(dbm * 100))]
+        with telemetry.timed('subprocess_iw'):
+            try:
+                response = self.runCommand(
+                    ['iw', 'dev', self.iface, 'set', 'txpower'] + args)
+            except OSError as e:
+                response = e
+        if response != 0:
+            logging.warning("Unable to set %s transmit power: %s",
+                            self.iface, response)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hardware abstraction layer
+
+Everything in hats.py talks to the board through the names exported from
+this module (GPIO, AXP209, clock, poweroff, syncFilesystems) rather than
+importing RPi.GPIO and axp209 directly. By default they resolve to the real
+hardware the first time they're used, but a different backend (e.g. the
+one in simulator.py) can be installed with use_backend() before any HAT is
+constructed. That lets hats.py and cli.py be imported and exercised
+off-device.
+"""
+
+import logging
+import os
+import subprocess
+import time
+
+# Fixed I2C address of the AXP209. Duplicated from the axp209 library so that
+#  importing this module doesn't require that library to be installed
+AXP209_ADDRESS = 0x34
+
+
+class RealBackend:
+    """Backend that drives the actual NEO GPIO pins and AXP209 over SMBus"""
+
+    name = 'real'
+    STATE_DIR = '/var/lib/neo_batterylevelshutdown'
+
+    def __init__(self):
+        # Imported here so that the module can be loaded on machines that
+        #  don't have these (hardware specific) libraries installed
+        import axp209
+        import RPi.GPIO  # pylint: disable=import-error
+        from .sensors import SystemSensors
+        self.gpio = RPi.GPIO
+        self._axp209Class = axp209.AXP209
+        self.clock = time
+        self.sensors = SystemSensors()
+
+    def axp209(self, *args, **kwargs):
+        return self._axp209Class(*args, **kwargs)
+
+    # pylint: disable=no-self-use
+    # This is a standard interface - simulated backends need self
+    def poweroff(self):
+        # Straight to systemd; shutdown(8) is a wrapper that may wait
+        try:
+            if subprocess.call(['systemctl', 'poweroff']) == 0:
+                return
+        except OSError as e:
+            logging.warning("Unable to run systemctl: %s", e)
+        os.system("shutdown now")
+
+    def syncFilesystems(self):
+        os.sync()
+
+    def statePath(self, name):
+        try:
+            os.makedirs(self.STATE_DIR, exist_ok=True)
+        except OSError as e:
+            logging.warning("Unable to create %s: %s", self.STATE_DIR, e)
+            return None
+        return os.path.join(self.STATE_DIR, name)
+
+
+_backend = None
+# Devices opened by shared() (e.g. sharedAXP209), keyed by name. Failed
+#  probes are recorded as the exception that they raised
+_sharedHandles = {}
+
+
+def backend():
+    """Return the active backend, creating the real one if none is set"""
+    global _backend  # pylint: disable=global-statement
+    if _backend is None:
+        _backend = RealBackend()
+        logging.debug("Using %s hardware backend", _backend.name)
+    return _backend
+
+
+def use_backend(newBackend):
+    """
+    Install newBackend as the target for GPIO, AXP209, clock etc
+
+    Passing None reverts to the real hardware on next use.
+    """
+    global _backend  # pylint: disable=global-statement
+    _backend = newBackend
+    # Handles opened through the previous backend are no longer valid
+    _sharedHandles.clear()
+    if newBackend is not None:
+        logging.debug("Using %s hardware backend", newBackend.name)
+
+
+class _BackendProxy:
+    """
+    Forwards attribute lookups to an attribute of the active backend
+
+    This means that modules can bind the proxy at import time (as they did
+    with RPi.GPIO) while the backend is chosen later.
+    """
+
+    def __init__(self, attr):
+        self._attr = attr
+
+    def __getattr__(self, name):
+        return getattr(getattr(backend(), self._attr), name)
+
+
+GPIO = _BackendProxy('gpio')
+clock = _BackendProxy('clock')
+sensors = _BackendProxy('sensors')
+
+
+# pylint: disable=invalid-name
+# Named to match the axp209 library class that it stands in for
+def AXP209(*args, **kwargs):
+    return backend().axp209(*args, **kwargs)
+
+
+def poweroff():
+    backend().poweroff()
+
+
+def syncFilesystems():
+    """Commit buffered writes (and filesystem journals) to storage"""
+    backend().syncFilesystems()
+
+
+def statePath(name):
+    """
+    Path of a file for state that's kept between runs (e.g. metrics)
+
+    None if state shouldn't (or can't) be persisted by this backend.
+    """
+    return backend().statePath(name)
+
+
+def shared(name, opener):
+    """
+    The handle opened by opener() under name, opening it on the first call
+
+    An OSError from opener is kept and raised again on later calls. Handles
+    are forgotten when the backend changes.
+    """
+    if name not in _sharedHandles:
+        try:
+            _sharedHandles[name] = opener()
+        except OSError as e:
+            _sharedHandles[name] = e
+    handle = _sharedHandles[name]
+    if isinstance(handle, OSError):
+        raise handle
+    return handle
+
+
+def sharedAXP209():
+    """
+    Return the AXP209, opening it (and its SMBus) on the first call only
+
+    HAT detection and the HAT itself use this, so the I2C bus and the
+    controller are only initialised once. Raises OSError if there is no
+    AXP209, on every call, without probing the bus again.
+    """
+    return shared('axp209', _openCountedAXP209)
+
+
+def _openCountedAXP209():
+    from .telemetry import CountingBus
+    axp = AXP209()
+    # Count every I2C transaction for the metrics exporter
+    axp.bus = CountingBus(axp.bus)
+    return axp
+
+
+def sharedDisplayDevice():
+    """
+    Return the luma OLED device, creating it on the first call only
+
+    Creating a luma device resets and configures the SSD1306, so display
+    detection and the OLED class share one. Raises OSError if there is no
+    display, on every call, without probing the bus again.
+    """
+    return shared('display', _openProfiledDisplayDevice)
+
+
+def _openProfiledDisplayDevice():
+    from .HAT_Utilities import get_device
+    from .telemetry import ProfiledDevice
+    return ProfiledDevice(get_device())
@@ -7,9 +7,18 @@ import os.path
 import subprocess
 import shutil
 import sys
-import time
-from axp209 import AXP209, AXP209_ADDRESS
-import RPi.GPIO as GPIO  # pylint: disable=import-error
+import threading
+from .battery import BatteryEstimator
+from . import config
+from .displays import DummyDisplay
+from .hardware import AXP209_ADDRESS, GPIO, clock, sensors, sharedAXP209, \
+    statePath, syncFilesystems
+from . import interrupts
+from . import navigation
+from .metrics import MetricsStore
+from .sensors import SensorSnapshot
+from . import shutdown
+from . import telemetry
 from .usb import USB
 
 
@@ -21,49 +30,73 @@ def min_execution_time(min_time_secs):
     This function will sleep in order to pad out the execution time if the
     logic within the context handler finishes early
     """
-    start_time = time.monotonic()
+    start_time = clock.monotonic()
     yield
-    duration = time.monotonic() - start_time
+    duration = clock.monotonic() - start_time
     # If the function has run over the min execution time, don't sleep
     period = max(0, min_time_secs - duration)
     logging.debug("sleeping for %.2f secs to guarantee min exec time", period)
-    time.sleep(period)
+    clock.sleep(period)
 
 
 class BasePhysicalHAT:
 
     PIN_LED = PA6 = 12
-    LED_CYCLE_TIME_SECS = 5
+    # How long the power stays on after shutdownDeviceCallback's edge (None
+    #  if there's no hardware deadline)
+    SHUTDOWN_GRACE_SECS = None
 
     # pylint: disable=unused-argument
     # This is a standard interface - it's ok not to use
     def __init__(self, displayClass):
+        # channel -> (edge, callback, bouncetime) for each addEdgeHandler call
+        self.edgeHandlers = {}
         GPIO.setup(self.PIN_LED, GPIO.OUT)
         # All HATs should turn on their LED on startup. Doing it in the base
         #  class constructor allows us the main loop to focus on transitions
         #  and not worry about initial state (and thus be simpler)
         self.solidLED()
+        # Copies would be cut short by the power going anyway; stopping them
+        #  leaves the time for making sure that what was written is kept
+        shutdown.addHook('abort copies', USB.abortCopies, priority=10,
+                         deadlineSecs=1)
+        shutdown.addHook('sync filesystems', syncFilesystems, priority=30,
+                         deadlineSecs=1.5)
 
     @classmethod
-    def shutdownDevice(cls):
+    def shutdownDevice(cls, graceSecs=None, reason='requested'):
         # Turn off the LED, as some people associate that with wifi being
         #  active (the HAT can stay powered after shutdown under some
         #  circumstances)
         GPIO.output(cls.PIN_LED, GPIO.HIGH)
         logging.info("Exiting for Shutdown")
-        os.system("shutdown now")
+        shutdown.shutdown(graceSecs, reason)
 
     def shutdownDeviceCallback(self, channel):
         logging.debug("Triggering device shutdown based on edge detection "
                       "of GPIO %s.", channel)
-        self.shutdownDevice()
+        self.shutdownDevice(self.SHUTDOWN_GRACE_SECS, "GPIO %s" % channel)
+
+    def addEdgeHandler(self, channel, edge, callback, bouncetime=None):
+        """
+        Add GPIO edge detection for channel, remembering the callback
+
+        Recording the handlers lets an alternative event loop (see
+        controller.py) take over edge detection for the HAT's pins.
+        """
+        self.edgeHandlers[channel] = (edge, callback, bouncetime)
+        if bouncetime is None:
+            GPIO.add_event_detect(channel, edge, callback=callback)
+        else:
+            GPIO.add_event_detect(channel, edge, callback=callback,
+                                  bouncetime=bouncetime)
 
     def blinkLED(self, times, flashDelay=0.3):
         for _ in range(0, times):
             GPIO.output(self.PIN_LED, GPIO.HIGH)
-            time.sleep(flashDelay)
+            clock.sleep(flashDelay)
             GPIO.output(self.PIN_LED, GPIO.LOW)
-            time.sleep(flashDelay)
+            clock.sleep(flashDelay)
 
     def solidLED(self):
         GPIO.output(self.PIN_LED, GPIO.LOW)
@@ -87,6 +120,8 @@ class q1y2018HAT(BasePhysicalHAT):
     PIN_VOLT_3_45 = PG7 = 10
     PIN_VOLT_3_71 = PG8 = 16
     PIN_VOLT_3_84 = PG9 = 18
+    # See the PIN_VOLT_3_0 edge detection below
+    SHUTDOWN_GRACE_SECS = 8
 
     def __init__(self, displayClass):
         logging.info("Initializing Pins")
@@ -104,8 +139,8 @@ class q1y2018HAT(BasePhysicalHAT):
         #  period before yanking the power, so if we have a falling edge on
         #  PIN_VOLT_3_0, then we're about to get the power yanked so attempt
         #  a graceful shutdown immediately.
-        GPIO.add_event_detect(self.PIN_VOLT_3_0, GPIO.FALLING,
-                              callback=self.shutdownDeviceCallback)
+        self.addEdgeHandler(self.PIN_VOLT_3_0, GPIO.FALLING,
+                            self.shutdownDeviceCallback)
         # We cannot perform edge detection on PG7, PG8 or PG9 because there
         #  is no hardware hysteresis built into those level detectors, so when
         #  charging, the charger chip causes edge transitions (mostly rising
@@ -119,7 +154,8 @@ class q1y2018HAT(BasePhysicalHAT):
         """
         logging.info("Starting Monitoring")
         while True:
-            with min_execution_time(min_time_secs=self.LED_CYCLE_TIME_SECS):
+            with min_execution_time(
+                    min_time_secs=config.current().ledCycleTimeSecs):
                 if GPIO.input(self.PIN_VOLT_3_84):
                     logging.debug("Battery voltage > 3.84V i.e. > ~63%")
                     self.solidLED()
@@ -146,28 +182,44 @@ class q1y2018HAT(BasePhysicalHAT):
 
 class Axp209HAT(BasePhysicalHAT):
     SHUTDOWN_WARNING_PERIOD_SECS = 60
-    BATTERY_CHECK_FREQUENCY_SECS = 30
-    MIN_BATTERY_THRESHOLD_PERC_SOLID = 63  # Parity with PIN_VOLT_3_84
-    MIN_BATTERY_THRESHOLD_PERC_SINGLE_FLASH = 33  # Parity with PIN_VOLT_3_71
-    MIN_BATTERY_THRESHOLD_PERC_DOUBLE_FLASH = 3  # Parity with PIN_VOLT_3_45
-    BATTERY_WARNING_THRESHOLD_PERC = MIN_BATTERY_THRESHOLD_PERC_DOUBLE_FLASH
-    BATTERY_SHUTDOWN_THRESHOLD_PERC = 1
-    # possibly should be moved elsewhere
-    DISPLAY_TIMEOUT_SECS = 20
+    # The AXP209 shutdown delay (register 0x32, set in the constructor)
+    SHUTDOWN_GRACE_SECS = 3
+    # Battery thresholds and check intervals, the display timeout and the
+    #  long press threshold are deployment settings (see config.py)
+    # How often the metrics history and sensor snapshot are updated
+    METRICS_SAMPLE_SECS = 60
     BUTTON_PRESS_BUSY = False               # Prevent dual usage of the handleButtonPress function
     BUTTON_PRESS_TIMEOUT_SEC = 0.25         # Prevent bouncing of the handleButtonPress function
-    BUTTON_PRESS_CLEARED_TIME = time.time() # When was the handleButtonPress was last cleared
-    CHECK_PRESS_THRESHOLD_SEC = 3           # Threshold for what qualifies as a long press
+    # When was the handleButtonPress was last cleared
+    BUTTON_PRESS_CLEARED_TIME = 0
+    # GPIO wired to the AXP209 IRQ line. Without one, the IRQ status
+    #  registers are polled from the main loop instead
+    PIN_AXP_INTERRUPT_LINE = None
 
     def __init__(self, displayClass):
-        self.axp = AXP209()
-        self.display = displayClass(self.axp)
-        # Blank the screen 3 seconds after showing the logo - that's long
-        #  enough. While displayPowerOffTime is read and written from both
-        #  callback threads and the main loop, there's no TOCTOU race
-        #  condition because we're only ever setting an absolute value rather
-        #  than incrementing i.e. we're not referencing the old value
-        self.displayPowerOffTime = time.time() + 3
+        # Shared with HAT detection so the bus is only initialised once
+        self.axp = sharedAXP209()
+        # The real display is only created when the main loop starts (see
+        #  startDisplay) so that the LED and shutdown detection in this and
+        #  subclass constructors are armed without waiting for the display
+        #  libraries to load. Until then, button presses go to a placeholder
+        self.displayClass = displayClass
+        self.display = DummyDisplay(self.axp)
+        # Display power stages: 'on' until displayDimTime, then 'dim' until
+        #  displayPowerOffTime, then 'off' until the display is used again
+        self.displayState = 'on'
+        self.displayDimTime = sys.maxsize
+        self.displayPowerOffTime = sys.maxsize
+        self.nextDisplayRefreshTime = 0
+        self.displayBrightness = telemetry.gauge(
+            'connectbox_display_brightness',
+            'Display power stage: 2 on, 1 dimmed, 0 off')
+        self.batteryEstimator = BatteryEstimator()
+        # Optional governor.PowerGovernor, updated after each battery check
+        self.powerGovernor = None
+        self.metrics = MetricsStore(statePath('metrics.bin'))
+        self.nextMetricsSampleTime = 0
+        self.snapshot = SensorSnapshot(*[None] * len(SensorSnapshot._fields))
         # If we have a battery, perform a level check at our first chance but
         #  if we don't, never schedule the battery check (this assumes that
         #  the battery will never be plugged in after startup, which is a
@@ -178,13 +230,27 @@ class Axp209HAT(BasePhysicalHAT):
             # Never schedule it...
             self.nextBatteryCheckTime = sys.maxsize
 
-        # Clear all IRQ Enable Control Registers. We may subsequently
-        #  enable interrupts on certain actions below, but let's start
-        #  with a known state for all registers.
-        for ec_reg in (0x40, 0x41, 0x42, 0x43, 0x44):
-            self.axp.bus.write_byte_data(AXP209_ADDRESS, ec_reg, 0x00)
-
-        # Now all interrupts are disabled, clear the previous state
+        # Enable the AXP209 interrupts that we handle and disable the rest
+        # Note that the axp209 will do a shutdown based on register
+        #  0x31[2:0] which is set to 2.9V by default, and as we're
+        #  triggering a shutdown based on LEVEL2 that mechanism should never
+        #  be necessary
+        self.irq = interrupts.IRQDispatcher(self.axp.bus)
+        for cause in (interrupts.LEVEL2, interrupts.POWER_OFF,
+                      interrupts.PEK_LONG):
+            self.irq.addHandler(cause, self.shutdownForInterrupt)
+        for cause in (interrupts.LEVEL1, interrupts.ACIN_PLUGGED,
+                      interrupts.ACIN_REMOVED):
+            self.irq.addHandler(cause, self.requestBatteryCheck)
+        self.irq.addHandler(interrupts.OVER_TEMPERATURE,
+                            self.warnOverTemperature)
+        self.irq.addHandler(interrupts.PEK_SHORT, self.pressPowerKey)
+        self.irq.enable()
+        # Called (from any thread) when a battery check is wanted sooner
+        #  than scheduled
+        self.batteryCheckListener = None
+
+        # Forget anything that was latched before we were listening
         self.clearAllPreviousInterrupts()
 
         # shutdown delay time to 3 secs (they delay before axp209 yanks power
@@ -195,7 +261,22 @@ class Axp209HAT(BasePhysicalHAT):
         # Set LEVEL2 voltage i.e. 3.0V
         self.axp.bus.write_byte_data(AXP209_ADDRESS, 0x3B, 0x18)
         super().__init__(displayClass)
+        # The admin command chosen from the admin pages
         self.command_to_reference = ''
+        # Page stack state; button presses, display timeouts and control
+        #  socket requests are all handled through it, one at a time
+        self.navigator = navigation.Navigator(self)
+        shutdown.addHook('flush metrics', self.metrics.close, priority=20,
+                         deadlineSecs=0.5)
+        # Looked up when it runs, as startDisplay replaces the display
+        shutdown.addHook('final page',
+                         lambda: self.display.showShutdownPage(),
+                         priority=40, deadlineSecs=0.5)
+        # Admin commands can be started from the buttons or the control
+        #  socket (see ipc.py) but only one may run at a time
+        self.commandLock = threading.Lock()
+        # Called with a dict describing each step of an admin command
+        self.progressListener = None
 
     def batteryLevelAbovePercent(self, level):
         # Battery guage of -1 means that the battery is not attached.
@@ -203,107 +284,192 @@ class Axp209HAT(BasePhysicalHAT):
         #  attached, or the device has found a mysterious alternative
         #  power source, let's say that the level is always above if
         #  we have a negative battery_gauge
-        logging.debug("Battery Level: %s%%", self.axp.battery_gauge)
-        return self.axp.battery_gauge < 0 or \
-            self.axp.battery_gauge > level
-
-    def updateLEDState(self):
-        if self.batteryLevelAbovePercent(
-                self.MIN_BATTERY_THRESHOLD_PERC_SOLID):
-            self.solidLED()
-            return
-
-        if self.batteryLevelAbovePercent(
-                self.MIN_BATTERY_THRESHOLD_PERC_SINGLE_FLASH):
-            self.blinkLED(times=1)
-            return
-
-        if self.batteryLevelAbovePercent(
-                self.MIN_BATTERY_THRESHOLD_PERC_DOUBLE_FLASH):
-            self.blinkLED(times=2)
-            return
+        # Read the gauge once; each read is an I2C transaction
+        gauge = self.axp.battery_gauge
+        logging.debug("Battery Level: %s%%", gauge)
+        return gauge < 0 or gauge > level
+
+    def ledFlashCount(self):
+        """Number of LED flashes per cycle for the battery level (0=solid)"""
+        # Use the level from the last battery check if there's been one; it
+        #  is less jittery and saves reading the gauge on every LED cycle
+        gauge = self.batteryEstimator.smoothedGauge
+        if gauge is None:
+            gauge = self.axp.battery_gauge
+        logging.debug("Battery Level: %s%%", gauge)
+        cfg = config.current()
+        if gauge < 0 or gauge > cfg.ledSolidThresholdPerc:
+            return 0
+
+        if gauge > cfg.ledSingleFlashThresholdPerc:
+            return 1
+
+        if gauge > cfg.ledDoubleFlashThresholdPerc:
+            return 2
 
         # If we're here, we're below the double flash threshold and haven't
         #  yet been shutdown, so flash three times
-        self.blinkLED(times=3)
+        return 3
+
+    def updateLEDState(self):
+        flashes = self.ledFlashCount()
+        if flashes:
+            self.blinkLED(times=flashes)
+        else:
+            self.solidLED()
 
     def executeCommands(self, command):
         '''
         This is where we will actually be executing the commands
 
         :param command: the command we want to execute
-        :return: Nothing
+        :return: navigation.SUCCEEDED, FAILED or USB_PRESENT (in which case the
+          remove usb page is showing and remove_usb is the next command)
         '''
 
         logging.debug("Execute Command: {}".format(command))
         usb = USB()
+        progress = self.reportProgress  # shortcut
+        cfg = config.current()
         if command == 'remove_usb':
             logging.debug("In remove usb page")
             if usb.isUsbPresent():                          # check to see if usb is inserted
                 logging.debug("USB still present")
                 self.display.showRemoveUsbPage()            # tell them to remove it if so
-                self.display.pageStack = 'removeUsb'        # let our handleButtonPress know what we want
                 self.command_to_reference = 'remove_usb'    # let out executeCommands know what we want
-            else:                                           # if they were good and followed previous instruction
-                logging.debug("USB removed")
-                self.display.pageStack = 'success'          # let out handleButtonPress know
-                self.display.showSuccessPage()              # display our success page
+                return navigation.USB_PRESENT
+            # if they were good and followed previous instruction
+            logging.debug("USB removed")
+            self.display.showSuccessPage()  # display our success page
+            return navigation.SUCCEEDED
 
         if command == 'copy_from_usb':
             if not usb.isUsbPresent():                  # check to see if usb is inserted
                 self.display.showNoUsbPage()            # if not, alert use as this is an important piece of the puzzle
-                self.display.pageStack = 'error'
-                return                                  # cycle back to menu
+                return navigation.FAILED                # cycle back to menu
+            progress(command, 'mounting')
             if not usb.moveMount():             # see if our remount (from /media/usb0 -> /media/usb1) was successful
                 self.display.showErrorPage()    # if not generate error page and exit
-                self.display.pageStack = 'error'
-                return
+                return navigation.FAILED
+            progress(command, 'checking_space')
             if not usb.checkSpace():            # verify that the usb size is smaller than the available space
                 self.display.showNoSpacePage()  # if not, alert as this is a problem
-                usb.moveMount(curMount='/media/usb1', destMount='/media/usb0')
-                self.display.pageStack = 'error'
-                return
-            if not usb.copyFiles():                 # see if we were able to copy the files successfully
+                usb.moveMount(curMount=cfg.usbMountPath,
+                              destMount=cfg.contentPath)
+                return navigation.FAILED
+            progress(command, 'copying', files=len(usb.plan.files),
+                     skipped=len(usb.plan.skipped))
+            # see if we were able to copy the files successfully (showing
+            #  the limit on its rate, if it's throttled)
+            if not usb.copyFiles(
+                    rateListener=self.display.showCopyRateLimit):
                 self.display.showErrorPage()        # if not generate error page and exit
-                self.display.pageStack = 'error'
-                return
-            if not usb.unmount('/media/usb1'):      # see if we were able to unmount /media/usb1
+                return navigation.FAILED
+            progress(command, 'unmounting')
+            # see if we were able to unmount /media/usb1
+            if not usb.unmount(cfg.usbMountPath):
                 self.display.showErrorPage()        # if not generate error page and exit
-                self.display.pageStack = 'error'
-                return
+                return navigation.FAILED
             else:   # if we did successfully unmount /media/usb1
                 if usb.isUsbPresent():  # see if usb is still physically installed, if so, have them remove it
                     self.display.showRemoveUsbPage()           # if so show the remove usb page
-                    self.display.pageStack = 'removeUsb'       # set this so our handleButtonPress knows what to do
                     self.command_to_reference = 'remove_usb'   # set this so it will be checked again after button press
-                    return
-                self.display.pageStack = 'success'  # if the usb were removed prior to last usb present check
-                self.display.showSuccessPage()      # display success page
+                    return navigation.USB_PRESENT
+                # if the usb were removed prior to last usb present check
+                self.display.showSuccessPage()
+                return navigation.SUCCEEDED
 
         elif command == 'erase_folder':
             file_exists = False  # in regards to README.txt file
             if usb.isUsbPresent():
-                self.display.pageStack = 'error'
                 self.display.showRemoveUsbPage()
-                return
-            if os.path.isfile('/media/usb0/README.txt'):  # keep the default README if possible
+                return navigation.FAILED
+            progress(command, 'erasing')
+            readme = os.path.join(cfg.contentPath, 'README.txt')
+            if os.path.isfile(readme):  # keep the default README if possible
                 file_exists = True
-                subprocess.call(['cp', '/media/usb0/README.txt', '/tmp/README.txt'])
+                with telemetry.timed('subprocess_cp'):
+                    subprocess.call(['cp', readme, '/tmp/README.txt'])
                 logging.debug("README.txt moved")
-            for file_object in os.listdir('/media/usb0'):
-                file_object_path = os.path.join('/media/usb0', file_object)
+            for file_object in os.listdir(cfg.contentPath):
+                file_object_path = os.path.join(cfg.contentPath, file_object)
                 if os.path.isfile(file_object_path):
                     os.unlink(file_object_path)
                 else:
                     shutil.rmtree(file_object_path)
+            # The dedup store is kept beside the content, not in it
+            shutil.rmtree(config.dedupStorePath(cfg), ignore_errors=True)
             logging.debug("FILES NUKED!!!")
             if file_exists:
-                subprocess.call(['mv', '/tmp/README.txt', '/media/usb0/README.txt'])  # move the README back
+                with telemetry.timed('subprocess_mv'):
+                    # move the README back
+                    subprocess.call(['mv', '/tmp/README.txt', readme])
                 logging.debug("README.txt returned")
             logging.debug("Life is good!")
-            self.display.pageStack = 'success'
             self.display.showSuccessPage()
+            return navigation.SUCCEEDED
+        return navigation.FAILED
+
+    def reportProgress(self, command, stage, **details):
+        """Tell the progress listener (if any) about a step of command"""
+        logging.debug("%s: %s", command, stage)
+        if self.progressListener is not None:
+            details.update(command=command, stage=stage, time=clock.time())
+            self.progressListener(details)
+
+    def runCommand(self, command, wait=True):
+        """
+        Run an admin command from wherever the pages are (e.g. on request
+        from the control socket)
+
+        Only one command runs at a time. If wait is False and another
+        command is running, returns False without doing anything.
+        """
+        if not self.navigator.handle(navigation.RUN, command, blocking=wait):
+            return False
+        # Like every change to the display, made while no other event is
+        #  being handled
+        self.navigator.exclusive(self.wakeDisplay)
+        return True
+
+    def runCommandNow(self, command):
+        """Show the wait page and execute an admin command"""
+        with self.commandLock:
+            self.command_to_reference = command
+            self.display.showWaitPage()
+            logging.debug("Waiting Page shown")
+            self.reportProgress(command, 'started')
+            outcome = self.executeCommands(command)
+            # Where the outcome leads says how it went: success, error or
+            #  removeUsb
+            self.reportProgress(command, 'finished',
+                                result=self.navigator.lookup(outcome)[0])
+        return outcome
+
+    def runChosenCommand(self):
+        logging.debug("Choice confirmed")
+        return self.runCommandNow(self.command_to_reference)
+
+    def showStatusPage(self, index):
+        """
+        Show a status page on request, as if it was navigated to
 
+        Returns False if a command is running.
+        """
+        if not self.navigator.handle(navigation.SHOW_STATUS, index,
+                                     blocking=False):
+            return False
+        self.navigator.exclusive(self.wakeDisplay)
+        return True
+
+    def usbRemoved(self):
+        """Carry on from the remove usb page once the USB stick is gone"""
+        if self.navigator.handle(navigation.USB_REMOVED):
+            self.navigator.exclusive(self.wakeDisplay)
+
+    def goToStatusPage(self, index):
+        self.command_to_reference = ''
+        self.display.showStatusPage(index)
 
     def handleButtonPress(self, channel):
         '''
@@ -320,7 +486,8 @@ class Axp209HAT(BasePhysicalHAT):
         else:
             # check the amount of time that has passed since this function has been cleared and see if it
             # exceeds the timeout set.  This avoids buttons bouncing triggering this function
-            if time.time() - self.BUTTON_PRESS_CLEARED_TIME > self.BUTTON_PRESS_TIMEOUT_SEC:
+            if clock.time() - self.BUTTON_PRESS_CLEARED_TIME > \
+                    self.BUTTON_PRESS_TIMEOUT_SEC:
                 self.BUTTON_PRESS_BUSY = True  # if enough time, proceed and set the BUSY flag
 
             else:  # if not enough time, pass
@@ -328,43 +495,52 @@ class Axp209HAT(BasePhysicalHAT):
 
         logging.debug("Handle button press")
         # get time single button was pressed along with the amount of time both buttons were pressed
-        channelTime, dualTime = self.checkPressTime(channel)
+        with telemetry.timed('button_hold'):
+            channelTime, dualTime = self.checkPressTime(channel)
 
         # clear the CHECK_PRESS_BUSY flag
         self.BUTTON_PRESS_BUSY = False
 
         # reset the CHECK_PRESS_CLEARED_TIME to now
-        self.BUTTON_PRESS_CLEARED_TIME = time.time()
+        self.BUTTON_PRESS_CLEARED_TIME = clock.time()
+
+        # From button release to the result being on the display
+        with telemetry.timed('button_action'):
+            self.actOnButtonPress(channel, channelTime, dualTime)
 
-        pageStack = self.display.pageStack  # shortcut
-        logging.debug("PAGESTACK: {}".format(pageStack))
+    def actOnButtonPress(self, channel, channelTime, dualTime):
+        '''
+        Decide what a (measured) button press means for the current page
+        stack and do it
+
+        :param channel: The pin number that was pressed
+        :param channelTime: how long that button was held
+        :param dualTime: how long both buttons were held together
+        :return: nothing
+        '''
+        longPress = config.current().checkPressThresholdSec
+        logging.debug("PAGESTACK: {}".format(self.navigator.state))
         logging.debug("COMMAND: {}".format(self.command_to_reference))
 
-        # this is where we decide what to do with the button press.  ChanelTime is the first button pushed,
-        # dualTime is the amount of time both buttons were pushed.
+        # this is where we decide what to do with the button press.
+        # ChanelTime is the first button pushed, dualTime is the amount of
+        # time both buttons were pushed.  What the press then does depends
+        # on the page stack (see navigation.TRANSITIONS)
         if channelTime < .1:  # Ignore noise
-            pass
+            return
 
         # if either button is below the press threshold, treat as normal
-        elif channelTime < self.CHECK_PRESS_THRESHOLD_SEC or dualTime < self.CHECK_PRESS_THRESHOLD_SEC:
-            if channel == self.USABLE_BUTTONS[0]:  # this is the left button
-                if pageStack in ['confirm', 'error', 'success']: # these conditions return to admin stack
-                    self.chooseCancel()
-                elif pageStack in ['removeUsb']: # gonna keep going until they remove the USB stick
-                    self.chooseEnter(pageStack)
-                else: # anything else, we treat as a moveForward (default) function
-                    self.moveForward(channel)
-            else:  # right button
-                if pageStack == 'status':  # standard behavior
-                    self.moveBackward(channel)
-                elif pageStack in ['error', 'success']:  # both conditions return to admin stack
-                    self.chooseCancel()
-                else:  # this is an enter key
-                    self.chooseEnter(pageStack)
-
-        # if we have a long press (both are equal or greater than threshold) call switch pages
-        elif channelTime >= self.CHECK_PRESS_THRESHOLD_SEC: # dual long push
-            self.switchPages()
+        if channelTime < longPress or dualTime < longPress:
+            event = (navigation.LEFT if channel == self.USABLE_BUTTONS[0]
+                     else navigation.RIGHT)
+        else:  # dual long push
+            event = navigation.LONG_PRESS
+
+        # A press while a command runs is dropped rather than acting on
+        #  whatever page follows it
+        if self.navigator.handle(event, blocking=False):
+            # reset the display power off time
+            self.navigator.exclusive(self.wakeDisplay)
 
     def checkPressTime(self, channel):
         '''
@@ -391,67 +567,69 @@ class Axp209HAT(BasePhysicalHAT):
         # the second button was pushed.  The timer gets restarted if the button is not pressed or is released.  The
         # reason for the recorder is that if it is not kept, then when you let off the second button it will bounce
         # and give a false reading.  Here we keep the highest consecutive time it was pushed.
-        startTime = time.time()     # time original button is pushed
-        dualStartTime = time.time() # time both buttons were pushed.
+        startTime = clock.time()     # time original button is pushed
+        dualStartTime = clock.time()  # time both buttons were pushed.
         dualTimeRecorded = 0        # to prevent time being reset when letting off of buttons
 
         while GPIO.input(channel) == 0:         # While original button is being pressed
             if GPIO.input(otherChannel) == 1:   # move start time up if not pressing other button
-                dualButtonTime = time.time() - dualStartTime # How long were both buttons down?
+                # How long were both buttons down?
+                dualButtonTime = clock.time() - dualStartTime
                 dualTimeRecorded = dualButtonTime if dualButtonTime > dualTimeRecorded else dualTimeRecorded
-                dualStartTime = time.time()     # reset start time to now
+                dualStartTime = clock.time()     # reset start time to now
 
-        buttonTime = time.time() - startTime    # How long was the original button down?
+        # How long was the original button down?
+        buttonTime = clock.time() - startTime
         return buttonTime, dualTimeRecorded
 
+    # The methods below are navigation actions (see navigation.TRANSITIONS),
+    #  which the navigator runs one at a time
+
     def chooseCancel(self):
         """ method for use when cancelling a choice"""
         logging.debug("Choice cancelled")
         self.command_to_reference = ''  # really don't want to leave this one loaded
-        self.display.switchPages()      # drops back to the admin pages
-        # reset the display power off time
-        self.displayPowerOffTime = time.time() + self.DISPLAY_TIMEOUT_SECS
+        self.display.showAdminPages()   # drops back to the admin pages
 
-    def chooseEnter(self, pageStack):
-        """ method for use when enter selected"""
+    def chooseAdminPage(self):
+        """ method for use when enter selected on an admin page"""
         logging.debug("Enter pressed.")
-        if pageStack == 'admin':
-            if self.display.checkIfLastPage():  # this is the exit page so, go back to admin pageStack
-                self.display.switchPages()      # swap to status pages
-            else:
-                self.command_to_reference = self.display.getAdminPageName()  # find page name before we change it
-                logging.debug("Leaving admin page: {}".format(self.command_to_reference))
-                logging.debug("Confirmed Page shown")
-                self.display.showConfirmPage()
-        else:
-            logging.debug("Choice confirmed")
-            self.display.showWaitPage()
-            logging.debug("Waiting Page shown")
-            self.executeCommands(self.command_to_reference)
-
-        # reset the display power off time
-        self.displayPowerOffTime = time.time() + self.DISPLAY_TIMEOUT_SECS
-
-    def switchPages(self):
-        """method for use on button press to change display options"""
-        logging.debug("You have now entered, the SwitchPages")
-        self.display.switchPages()
-        # reset the display power off time
-        self.displayPowerOffTime = time.time() + self.DISPLAY_TIMEOUT_SECS
+        # this is the exit page so, go back to the status pages
+        if self.display.checkIfLastPage():
+            return navigation.EXIT_CHOSEN
+        # find page name before we change it
+        self.command_to_reference = self.display.getAdminPageName()
+        logging.debug("Leaving admin page: {}".format(
+            self.command_to_reference))
+        return navigation.COMMAND_CHOSEN
+
+    def showConfirmPage(self):
+        logging.debug("Confirmed Page shown")
+        self.display.showConfirmPage()
+
+    def showAdminPages(self):
+        self.display.showAdminPages()
+
+    def showStatusPages(self):
+        self.display.showStatusPages()
+
+    def showSuccessPage(self):
+        self.display.showSuccessPage()
+
+    def resetPages(self):
+        """Start from the status pages next time the display is used"""
+        self.command_to_reference = ''
+        self.display.resetPages()
 
-    def moveForward(self, channel):
+    def moveForward(self):
         """method for use on button press to cycle display"""
-        logging.debug("Processing press on GPIO %s (move forward)", channel)
+        logging.debug("Processing press (move forward)")
         self.display.moveForward()
-        # reset the display power off time
-        self.displayPowerOffTime = time.time() + self.DISPLAY_TIMEOUT_SECS
 
-    def moveBackward(self, channel):
+    def moveBackward(self):
         """method for use on button press to cycle display"""
-        logging.debug("Processing press on GPIO %s (move backward)", channel)
+        logging.debug("Processing press (move backward)")
         self.display.moveBackward()
-        # reset the display power off time
-        self.displayPowerOffTime = time.time() + self.DISPLAY_TIMEOUT_SECS
 
     def clearAllPreviousInterrupts(self):
         """
@@ -464,24 +642,261 @@ class Axp209HAT(BasePhysicalHAT):
         and REG4CH). The interrupt can be cleared by writing 1 to corresponding
         state register bit.
 
-        Note that 0x4B is the only one that's enabled at this stage, but let's
-        be thorough so that we don't need to change this if we start using the
-        others.
+        Interrupts that arrive later are read and cleared by self.irq
         """
         # (IRQ status register 1-5)
         for stat_reg in (0x48, 0x49, 0x4A, 0x4B, 0x4C):
             self.axp.bus.write_byte_data(AXP209_ADDRESS, stat_reg, 0xFF)
         logging.debug("IRQ records cleared")
 
+    def shutdownForInterrupt(self, cause):
+        """LEVEL2, the power switch or a long press of the power key"""
+        graceSecs = None if cause == interrupts.PEK_LONG \
+            else self.SHUTDOWN_GRACE_SECS
+        self.shutdownDevice(graceSecs, "AXP209 %s" % cause)
+
+    def requestBatteryCheck(self, cause=None):
+        """Check the battery at the next opportunity e.g. on plugging in"""
+        if self.nextBatteryCheckTime == sys.maxsize:
+            # No battery
+            return
+        logging.debug("Battery check requested (%s)", cause)
+        self.nextBatteryCheckTime = 0
+        if self.batteryCheckListener is not None:
+            self.batteryCheckListener()
+
+    # pylint: disable=no-self-use
+    # This is a standard interface - it's ok not to use self
+    def warnOverTemperature(self, cause):
+        logging.warning("AXP209 over temperature (%s)", cause)
+
+    def pressPowerKey(self, cause):
+        """A short press of the power key wakes the display"""
+        logging.debug("Power key pressed (%s)", cause)
+        self.showStatusPage(0)
+
+    def startDisplay(self):
+        """
+        Create the display (which draws the logo) and schedule its blanking
+
+        displayClass can be a display class or any callable that takes the
+        AXP209 and metrics store and returns a display.
+        """
+        self.display = self.displayClass(self.axp, self.metrics)
+        # Blank the screen 3 seconds after showing the logo - that's long
+        #  enough. While displayPowerOffTime is read and written from both
+        #  callback threads and the main loop, there's no TOCTOU race
+        #  condition because we're only ever setting an absolute value rather
+        #  than incrementing i.e. we're not referencing the old value
+        self.displayState = 'on'
+        self.displayDimTime = self.displayPowerOffTime = clock.time() + 3
+
+    def displayEconomy(self):
+        """True when on a low battery, so the display should save power"""
+        gauge = self.batteryEstimator.smoothedGauge
+        return not self.batteryEstimator.charging and gauge is not None \
+            and 0 <= gauge < config.current().displayEconomyBelowPerc
+
+    def wakeDisplay(self):
+        """Full brightness, then restart the dim and blank timers"""
+        cfg = config.current()
+        if self.displayState != 'on':
+            self.display.setContrast(cfg.displayContrast)
+            self.displayState = 'on'
+            self.displayBrightness.set(2)
+        scale = 0.5 if self.displayEconomy() else 1
+        now = clock.time()
+        self.displayDimTime = now + cfg.displayDimSecs * scale
+        self.displayPowerOffTime = now + cfg.displayTimeoutSecs * scale
+
+    def nextDisplayEventTime(self):
+        """When checkDisplayTimeout next has work to do, or None"""
+        nextTime = {'on': self.displayDimTime,
+                    'dim': self.displayPowerOffTime}.get(self.displayState)
+        return None if nextTime in (None, sys.maxsize) else nextTime
+
+    def checkDisplayTimeout(self):
+        """Dim, then power off, the display once it's been idle long enough"""
+        now = clock.time()
+        if self.displayState != 'off' and now > self.displayPowerOffTime:
+            self.display.powerOffDisplay()
+            self.displayState = 'off'
+            self.displayBrightness.set(0)
+            # Return to the status stack from anywhere else we are (unless
+            #  a command is running, which will wake the display when done)
+            self.navigator.handle(navigation.TIMEOUT, blocking=False)
+        elif self.displayState == 'on' and now > self.displayDimTime:
+            self.display.setContrast(config.current().displayDimContrast)
+            self.displayState = 'dim'
+            self.displayBrightness.set(1)
+
+    def displayRefreshInterval(self):
+        cfg = config.current()
+        if self.batteryEstimator.charging or \
+                self.batteryEstimator.smoothedGauge is None:
+            return cfg.displayRefreshSecs
+        return cfg.displayRefreshOnBatterySecs
+
+    def refreshDisplay(self):
+        """
+        Redraw the status page being shown, at a rate set by the power
+        source
+        """
+        now = clock.time()
+        if now < self.nextDisplayRefreshTime:
+            return
+        if self.displayState != 'off' and not self.displayEconomy():
+            self.display.refreshPage()
+        self.nextDisplayRefreshTime = now + self.displayRefreshInterval()
+
+    def sampleBattery(self):
+        """Take a reading of the battery state for the estimator"""
+        charging = self.axp.power_input_status.acin_present
+        if charging:
+            current = -self.axp.battery_charge_current
+        else:
+            current = self.axp.battery_discharge_current
+        self.batteryEstimator.addSample(
+            clock.time(), self.axp.battery_voltage, current,
+            self.axp.battery_gauge, charging)
+
+    def sampleMetrics(self):
+        """
+        Update the sensor snapshot and record it in the metrics history
+
+        Battery readings are taken from the last battery check rather than
+        read again.
+        """
+        now = clock.time()
+        battery = self.batteryEstimator.samples[-1] \
+            if self.batteryEstimator.samples else None
+        netBytes = sensors.networkBytes()
+        throughput = None
+        previous = self.snapshot
+        if netBytes and previous.bytesSent is not None and \
+                now > previous.time:
+            throughput = (sum(netBytes) - previous.bytesSent -
+                          previous.bytesRecv) / (now - previous.time)
+        self.snapshot = SensorSnapshot(
+            time=now,
+            batteryGauge=battery.gauge if battery else None,
+            batteryVoltage=battery.voltage if battery else None,
+            batteryCurrent=battery.current if battery else None,
+            charging=self.axp.power_input_status.acin_present,
+            axpTemperature=self.axp.internal_temperature,
+            cpuTemperature=sensors.cpuTemperature(),
+            connectedUsers=sensors.connectedUsers(),
+            bytesSent=netBytes[0] if netBytes else None,
+            bytesRecv=netBytes[1] if netBytes else None,
+            throughput=throughput,
+        )
+        self.metrics.record(
+            now,
+            battery=self.snapshot.batteryGauge,
+            current=self.snapshot.batteryCurrent,
+            cpu_temp=self.snapshot.cpuTemperature,
+            clients=self.snapshot.connectedUsers,
+            throughput=throughput,
+        )
+        self.metrics.maybeFlush(now)
+        self.nextMetricsSampleTime = now + self.METRICS_SAMPLE_SECS
+
+    def batteryCheckInterval(self, gauge, minutesLeft):
+        """Seconds until the next battery check"""
+        cfg = config.current()
+        if self.batteryEstimator.charging:
+            return cfg.batteryCheckMaxSecs
+        interval = cfg.batteryCheckMinSecs + \
+            (gauge - cfg.batteryWarningThresholdPerc) * \
+            cfg.batteryCheckSecsPerPerc
+        if minutesLeft is not None:
+            # Check at least ten times before we're predicted to run out
+            interval = min(interval, minutesLeft * 6)
+        return max(cfg.batteryCheckMinSecs,
+                   min(cfg.batteryCheckMaxSecs, interval))
+
+    def updateLowBatteryWarning(self, gauge, warn):
+        """
+        Show the low battery warning page if warn, or hide it once the
+        battery has recovered
+        """
+        cfg = config.current()
+        if warn:
+            logging.debug("Battery below warning level")
+            # show (or keep showing) the low battery warning page
+            self.display.showLowBatteryWarning()
+            # Don't dim or blank the display while we're in the
+            #  warning period so the low battery warning shows
+            #  to the end
+            self.wakeDisplay()
+            self.displayDimTime = self.displayPowerOffTime = sys.maxsize
+        elif gauge > cfg.batteryWarningThresholdPerc + \
+                cfg.batteryWarningHysteresisPerc:
+            logging.debug("Battery above warning level")
+            # Hide the low battery warning, if we're currently
+            #  showing it
+            self.display.hideLowBatteryWarning()
+
+    def checkBattery(self, updateDisplay=True):
+        """
+        Possibly shutdown or show low battery page, then schedule the next
+        check
+
+        :param updateDisplay: False to leave the display (and the low battery
+          warning) alone, e.g. while another thread has it
+        """
+        self.sampleBattery()
+        cfg = config.current()
+        gauge = self.batteryEstimator.smoothedGauge
+        if gauge is None:
+            # No battery reading (the gauge reads -1 without a battery) so
+            #  there's nothing to decide
+            self.nextBatteryCheckTime = \
+                clock.time() + cfg.batteryCheckMaxSecs
+            return
+
+        minutesLeft = self.batteryEstimator.minutesToEmpty(
+            cfg.batteryShutdownThresholdPerc)
+        logging.debug("Smoothed battery level: %.1f%%, minutes left: %s",
+                      gauge, minutesLeft)
+        belowWarningLevel = gauge <= cfg.batteryWarningThresholdPerc
+        runningOut = minutesLeft is not None and \
+            minutesLeft <= cfg.batteryWarningMinutesToEmpty
+
+        if gauge <= cfg.batteryShutdownThresholdPerc or \
+                (belowWarningLevel and minutesLeft is not None and
+                 minutesLeft <= cfg.batteryShutdownMinutesToEmpty):
+            self.shutdownDevice(reason="battery at %.1f%%" % gauge)
+            # Leave the final page up; there's nothing more to check
+            self.nextBatteryCheckTime = \
+                clock.time() + cfg.batteryCheckMaxSecs
+            return
+
+        if updateDisplay:
+            self.updateLowBatteryWarning(gauge,
+                                         belowWarningLevel or runningOut)
+
+        if self.powerGovernor is not None:
+            self.powerGovernor.update(
+                gauge, self.batteryEstimator.charging, minutesLeft,
+                self.snapshot.connectedUsers)
+
+        self.nextBatteryCheckTime = \
+            clock.time() + self.batteryCheckInterval(gauge, minutesLeft)
+
     def mainLoop(self):
+        self.startDisplay()
         while True:
-            with min_execution_time(min_time_secs=self.LED_CYCLE_TIME_SECS):
-                # Perhaps power off the display
-                if time.time() > self.displayPowerOffTime:
-                    self.display.powerOffDisplay()
-                    if self.display.pageStack != 'status':  # if we're not on the default status pages
-                        self.display.pageStack = 'admin'    # this is to prep to return to the status pages
-                        self.display.switchPages()      # switch to the status stack from anywhere else we are
+            with min_execution_time(
+                    min_time_secs=config.current().ledCycleTimeSecs):
+                # Perhaps dim or power off the display, or bring the page
+                #  that it's showing up to date
+                self.checkDisplayTimeout()
+                self.refreshDisplay()
+
+                if self.PIN_AXP_INTERRUPT_LINE is None:
+                    # A single I2C read when there's nothing pending
+                    self.irq.dispatch()
 
                 # Check battery and possibly shutdown or show low battery page
                 # Do this less frequently than updating LEDs. We could do
@@ -489,28 +904,11 @@ class Axp209HAT(BasePhysicalHAT):
                 #  impact is probably minimal but that would mean we need to
                 #  check for whether the battery is connected on each loop so
                 #  readability doesn't necessarily improve
-                if time.time() > self.nextBatteryCheckTime:
-                    if not self.batteryLevelAbovePercent(
-                            self.BATTERY_SHUTDOWN_THRESHOLD_PERC):
-                        self.shutdownDevice()
-
-                    if self.batteryLevelAbovePercent(
-                            self.BATTERY_WARNING_THRESHOLD_PERC):
-                        logging.debug("Battery above warning level")
-                        # Hide the low battery warning, if we're currently
-                        #  showing it
-                        self.display.hideLowBatteryWarning()
-                    else:
-                        logging.debug("Battery below warning level")
-                        # show (or keep showing) the low battery warning page
-                        self.display.showLowBatteryWarning()
-                        # Don't blank the display while we're in the
-                        #  warning period so the low battery warning shows
-                        #  to the end
-                        self.displayPowerOffTime = sys.maxsize
-
-                    self.nextBatteryCheckTime = \
-                        time.time() + self.BATTERY_CHECK_FREQUENCY_SECS
+                if clock.time() > self.nextBatteryCheckTime:
+                    self.checkBattery()
+
+                if clock.time() > self.nextMetricsSampleTime:
+                    self.sampleMetrics()
 
                 # Give a rough idea of battery capacity based on the LEDs
                 self.updateLEDState()
@@ -532,15 +930,12 @@ class q3y2018HAT(Axp209HAT):
         #  as some callbacks require objects only initialised
         #  in parent constructors
         super().__init__(displayClass)
-        GPIO.add_event_detect(self.PIN_L_BUTTON, GPIO.FALLING,
-                              callback=self.handleButtonPress,
-                              bouncetime=125)
-        GPIO.add_event_detect(self.PIN_M_BUTTON, GPIO.FALLING,
-                              callback=self.handleButtonPress,
-                              bouncetime=125)
-        GPIO.add_event_detect(self.PIN_R_BUTTON, GPIO.FALLING,
-                              callback=self.powerOffDisplay,
-                              bouncetime=125)
+        self.addEdgeHandler(self.PIN_L_BUTTON, GPIO.FALLING,
+                            self.handleButtonPress, bouncetime=125)
+        self.addEdgeHandler(self.PIN_M_BUTTON, GPIO.FALLING,
+                            self.handleButtonPress, bouncetime=125)
+        self.addEdgeHandler(self.PIN_R_BUTTON, GPIO.FALLING,
+                            self.powerOffDisplay, bouncetime=125)
 
     def powerOffDisplay(self, channel):
         """Turn off the display"""
@@ -567,23 +962,12 @@ class q4y2018HAT(Axp209HAT):
         #  as some callbacks require objects only initialised
         #  in parent constructors
         super().__init__(displayClass)
-        GPIO.add_event_detect(self.PIN_L_BUTTON, GPIO.FALLING,
-                              callback=self.handleButtonPress,
-                              bouncetime=125)
-        GPIO.add_event_detect(self.PIN_R_BUTTON, GPIO.FALLING,
-                              callback=self.handleButtonPress,
-                              bouncetime=125)
-
-        # We only enable interrupts on this HAT, rather than in the superclass
-        #  because not all HATs with AXP209s have a line that we can use to
-        #  detect the interrupt
-        # Enable interrupts when battery goes below LEVEL2 or when
-        #  N_OE (the power switch) goes high
-        # Note that the axp209 will do a shutdown based on register 0x31[2:0]
-        #  which is set to 2.9V by default, and as we're triggering a shutdown
-        #  based on LEVEL2 that mechanism should never be necessary
-        self.axp.bus.write_byte_data(AXP209_ADDRESS, 0x43, 0x41)
-        # We've masked all other interrupt sources for the AXP interrupt line
-        #  so the desired action here is always to shutdown
-        GPIO.add_event_detect(self.PIN_AXP_INTERRUPT_LINE, GPIO.FALLING,
-                              callback=self.shutdownDeviceCallback)
+        self.addEdgeHandler(self.PIN_L_BUTTON, GPIO.FALLING,
+                            self.handleButtonPress, bouncetime=125)
+        self.addEdgeHandler(self.PIN_R_BUTTON, GPIO.FALLING,
+                            self.handleButtonPress, bouncetime=125)
+
+        # The interrupts themselves are enabled in the superclass; this HAT
+        #  can react to them as they happen rather than by polling
+        self.addEdgeHandler(self.PIN_AXP_INTERRUPT_LINE, GPIO.FALLING,
+                            self.irq.dispatch)
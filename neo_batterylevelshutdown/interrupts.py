@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoding and dispatch of AXP209 interrupts
+
+The AXP209 latches each event that it has been told to report (IRQ enable
+registers 0x40-0x44) in a bit of the IRQ status registers 0x48-0x4C and
+pulls its IRQ line low until the bits are cleared by writing 1s back to
+them. IRQDispatcher reads all five status registers in one block read,
+clears just the bits that were set (so an event that arrives in between
+isn't lost) and calls the handler registered for each cause.
+
+Where the HAT wires the IRQ line to a GPIO, dispatch() is the edge
+callback. Where it doesn't, calling dispatch() periodically costs a single
+I2C transaction when nothing has happened.
+"""
+
+import logging
+import threading
+
+from .hardware import AXP209_ADDRESS
+from . import telemetry
+
+IRQ_ENABLE_REGISTER = 0x40
+IRQ_STATUS_REGISTER = 0x48
+IRQ_REGISTER_COUNT = 5
+
+# Causes, in the order that they're handled when several arrive together
+LEVEL2 = 'level2'                       # battery below LEVEL2 (0x3B)
+POWER_OFF = 'power_off'                 # N_OE (the power switch) high
+OVER_TEMPERATURE = 'over_temperature'   # AXP209 internal over-temperature
+LEVEL1 = 'level1'                       # battery below LEVEL1 (0x3A)
+ACIN_PLUGGED = 'acin_plugged'
+ACIN_REMOVED = 'acin_removed'
+PEK_LONG = 'pek_long'                   # power key long press
+PEK_SHORT = 'pek_short'                 # power key short press
+
+# cause -> (offset from the enable/status register, bit) per the datasheet
+CAUSES = (
+    (LEVEL2, 3, 0x01),
+    (POWER_OFF, 3, 0x40),
+    (OVER_TEMPERATURE, 2, 0x80),
+    (LEVEL1, 3, 0x02),
+    (ACIN_PLUGGED, 0, 0x40),
+    (ACIN_REMOVED, 0, 0x20),
+    (PEK_LONG, 2, 0x01),
+    (PEK_SHORT, 2, 0x02),
+)
+
+
+def decode(status, enabled=None):
+    """The causes flagged in the status register values, in CAUSES order"""
+    return [cause for cause, offset, bit in CAUSES
+            if status[offset] & bit and
+            (enabled is None or cause in enabled)]
+
+
+class IRQDispatcher:
+
+    def __init__(self, bus, address=AXP209_ADDRESS):
+        self.bus = bus
+        self.address = address
+        # cause -> callable taking the cause
+        self.handlers = {}
+        # The IRQ line callback and polling may otherwise race to clear
+        self._lock = threading.Lock()
+        self._interrupts = telemetry.counter(
+            'connectbox_axp_interrupts', 'AXP209 interrupts handled')
+
+    def addHandler(self, cause, handler):
+        """Call handler(cause) when cause is reported (once enabled)"""
+        if cause not in [name for name, _, _ in CAUSES]:
+            raise ValueError("unknown AXP209 interrupt cause %r" % (cause,))
+        self.handlers[cause] = handler
+
+    def enableMasks(self):
+        """Values for the IRQ enable registers that report handled causes"""
+        masks = [0] * IRQ_REGISTER_COUNT
+        for cause, offset, bit in CAUSES:
+            if cause in self.handlers:
+                masks[offset] |= bit
+        return masks
+
+    def enable(self):
+        """Enable the interrupts with handlers and disable all others"""
+        for offset, mask in enumerate(self.enableMasks()):
+            self.bus.write_byte_data(self.address,
+                                     IRQ_ENABLE_REGISTER + offset, mask)
+
+    def readAndClear(self):
+        """The IRQ status registers, clearing the bits that were set"""
+        with self._lock:
+            status = self.bus.read_i2c_block_data(
+                self.address, IRQ_STATUS_REGISTER, IRQ_REGISTER_COUNT)
+            # Written back one at a time: the AXP209 only auto-increments
+            #  the register address for reads
+            for offset, bits in enumerate(status):
+                if bits:
+                    self.bus.write_byte_data(
+                        self.address, IRQ_STATUS_REGISTER + offset, bits)
+        return status
+
+    def dispatch(self, channel=None):
+        """Handle any pending interrupts, returning their causes"""
+        causes = decode(self.readAndClear(), self.handlers)
+        if channel is not None and not causes:
+            logging.debug("AXP209 IRQ line (GPIO %s) fell with no enabled "
+                          "cause pending", channel)
+        for cause in causes:
+            logging.info("AXP209 interrupt: %s", cause)
+            self._interrupts.inc()
+            self.handlers[cause](cause)
+        return causes
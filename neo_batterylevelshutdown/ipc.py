@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Control socket for the daemon
+
+A Unix domain socket that lets local programs (e.g. the admin web UI) do
+what the buttons do, without running their own iw or psutil processes.
+Requests and replies are JSON objects, one per line:
+
+    {"cmd": "snapshot"}
+        -> {"ok": true, "snapshot": {...}, "pageStack": "status",
+            "busy": false, "copyRateLimit": null}
+        copyRateLimit is the bytes a second that the copy from USB in
+        progress is limited to (see throttle.py): null if there's no
+        throttled copy, 0 if only its operations are limited
+    {"cmd": "run", "command": "copy_from_usb"}   (or "erase_folder")
+        -> {"ok": true, "job": 1}
+    {"cmd": "job", "job": 1, "follow": true}
+        -> one {"job": 1, "command": ..., "stage": ..., "time": ...} line per
+           step; the last has stage "finished" and a "result". Without
+           follow, a single {"ok": true, "events": [...], "done": ...}
+    {"cmd": "page", "index": 2}
+        -> {"ok": true} once statusPages[2] is on the display
+
+Failures are {"ok": false, "error": "..."}. Commands started with the
+buttons show up as jobs too, so their progress can be followed.
+
+The server runs its own asyncio loop in a daemon thread, so it works with
+both the callback based main loop and controller.py. Commands run in the
+HAT's commandLock, one at a time, whoever started them.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import threading
+
+from .usb import USB
+
+DEFAULT_SOCKET_PATH = '/run/neo_batterylevelshutdown.sock'
+
+
+class Job:
+
+    def __init__(self, jobId, command, source):
+        self.id = jobId
+        self.command = command
+        self.source = source
+        self.events = []
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        if event['stage'] == 'finished':
+            self.done = True
+        # Wake everyone following the job; later waits use a fresh event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class ControlServer:
+
+    COMMANDS = ('copy_from_usb', 'erase_folder')
+    # Finished jobs that are remembered for clients that ask about them late
+    MAX_JOBS = 20
+    # How long start() waits for the socket to be listening
+    START_TIMEOUT_SECS = 10
+
+    def __init__(self, hat, path=DEFAULT_SOCKET_PATH):
+        self.hat = hat
+        self.path = path
+        self.loop = asyncio.new_event_loop()
+        # Commands run one at a time anyway
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = {}
+        self.nextJobId = 1
+        self.currentJob = None
+        self.server = None
+        self.thread = None
+        # Why the server couldn't listen, if it couldn't
+        self.startError = None
+        self.hat.progressListener = self._onProgress
+
+    def _onProgress(self, event):
+        # Called from whichever thread is running the command
+        self.loop.call_soon_threadsafe(self._publish, event)
+
+    def _publish(self, event):
+        job = self.currentJob
+        if job is None or job.done:
+            # Started with the buttons
+            job = self._newJob(event['command'], 'button')
+        event['job'] = job.id
+        job.publish(event)
+
+    def _newJob(self, command, source):
+        job = Job(self.nextJobId, command, source)
+        self.nextJobId += 1
+        self.jobs[job.id] = job
+        self.currentJob = job
+        for jobId in sorted(self.jobs)[:-self.MAX_JOBS]:
+            del self.jobs[jobId]
+        return job
+
+    async def _runJob(self, job):
+        started = await self.loop.run_in_executor(
+            self.executor, self.hat.runCommand, job.command, False)
+        if not started:
+            # A button press got there first
+            job.publish({'job': job.id, 'command': job.command,
+                         'stage': 'finished', 'result': 'busy'})
+
+    @staticmethod
+    async def _send(writer, message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def _snapshot(self, request, writer):
+        snapshot = self.hat.snapshot
+        throttle = USB.activeThrottle
+        await self._send(writer, {
+            'ok': True,
+            'snapshot': snapshot._asdict() if snapshot else None,
+            'pageStack': self.hat.navigator.state,
+            'busy': self.hat.commandLock.locked(),
+            'copyRateLimit': throttle.rateLimit if throttle else None,
+        })
+
+    async def _run(self, request, writer):
+        command = request.get('command')
+        if command not in self.COMMANDS:
+            raise ValueError("unknown command %r" % (command,))
+        if self.hat.commandLock.locked():
+            raise ValueError("a command is already running")
+        job = self._newJob(command, 'socket')
+        asyncio.ensure_future(self._runJob(job))
+        await self._send(writer, {'ok': True, 'job': job.id})
+
+    async def _job(self, request, writer):
+        job = self.jobs.get(request.get('job'))
+        if job is None:
+            raise ValueError("unknown job %r" % (request.get('job'),))
+        if not request.get('follow'):
+            await self._send(writer, {'ok': True, 'events': job.events,
+                                      'done': job.done})
+            return
+        sent = 0
+        while True:
+            changed = job._changed  # pylint: disable=protected-access
+            for event in job.events[sent:]:
+                await self._send(writer, event)
+            sent = len(job.events)
+            if job.done:
+                return
+            await changed.wait()
+
+    async def _page(self, request, writer):
+        index = request.get('index')
+        if not isinstance(index, int):
+            raise ValueError("index must be an integer")
+        # true is 1 to Python, and negative indexes would count back from
+        #  the last page
+        if isinstance(index, bool) or index < 0:
+            raise ValueError("no status page %s" % json.dumps(index))
+        if self.hat.commandLock.locked():
+            raise ValueError("a command is already running")
+        try:
+            shown = await self.loop.run_in_executor(
+                None, self.hat.showStatusPage, index)
+        except IndexError:
+            raise ValueError("no status page %s" % json.dumps(index))
+        if not shown:
+            raise ValueError("a command is already running")
+        await self._send(writer, {'ok': True})
+
+    async def _handleClient(self, reader, writer):
+        handlers = {
+            'snapshot': self._snapshot,
+            'run': self._run,
+            'job': self._job,
+            'page': self._page,
+        }
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if not isinstance(request, dict):
+                        raise ValueError("requests must be JSON objects")
+                    handler = handlers.get(request.get('cmd'))
+                    if handler is None:
+                        raise ValueError("unknown cmd %r" %
+                                         (request.get('cmd'),))
+                    await handler(request, writer)
+                except ValueError as e:
+                    await self._send(writer, {'ok': False, 'error': str(e)})
+        except ConnectionError:
+            logging.debug("Control socket client went away")
+        finally:
+            writer.close()
+
+    def _serve(self, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_unix_server(self._handleClient, path=self.path))
+            # Only local admin tools (running as root or in the owning
+            #  group)
+            os.chmod(self.path, 0o660)
+        except Exception as e:  # pylint: disable=broad-except
+            # For start() to raise
+            self.startError = e
+            if self.server is not None:
+                self.server.close()
+            self.loop.close()
+            started.set()
+            return
+        started.set()
+        self.loop.run_forever()
+        # Stopped: drop any clients that are still connected
+        self.server.close()
+        tasks = asyncio.all_tasks(self.loop) \
+            if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks()
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def start(self):
+        """Serve from a daemon thread, so it never blocks shutdown"""
+        if os.path.exists(self.path):
+            # Left behind by a previous run
+            os.unlink(self.path)
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(started,),
+                                       name='control-socket', daemon=True)
+        self.thread.start()
+        if not started.wait(self.START_TIMEOUT_SECS):
+            self.startError = OSError("timed out listening on %s" % self.path)
+        if self.startError is not None:
+            # Commands mustn't report progress to a server that isn't there
+            self.hat.progressListener = None
+            self.executor.shutdown(wait=False)
+            raise self.startError
+        logging.info("Control socket listening on %s", self.path)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact on-device history of battery, temperature and network metrics
+
+Each metric is kept at three resolutions (1 minute, 1 hour and 1 day) in
+fixed size float32 ring buffers, with the value in each slot being the mean
+of the samples taken during that period. The whole store is about 5KB.
+
+The store is persisted to a memory-mapped file so that history survives a
+restart. The ring buffers themselves live in ordinary memory and are only
+copied into the mapping by flush(), which maybeFlush() rate limits. Writing
+straight into the mapping would let the kernel write the pages back to the
+SD card every few seconds, so this bounds SD writes to one ~5KB write per
+flush interval.
+"""
+
+from array import array
+import logging
+import math
+import mmap
+import os
+import struct
+
+NAN = float('nan')
+
+
+class _Ring:
+    """One resolution of one metric"""
+
+    def __init__(self, size):
+        self.values = array('f', [NAN] * size)
+        # Samples that make up the current (newest) slot's mean
+        self.count = 0
+
+
+class MetricsStore:
+
+    METRICS = ('battery', 'current', 'cpu_temp', 'clients', 'throughput')
+    # (name, seconds per slot, number of slots)
+    RESOLUTIONS = (
+        ('minute', 60, 120),    # 2 hours
+        ('hour', 3600, 72),     # 3 days
+        ('day', 86400, 60),     # 2 months
+    )
+    FLUSH_INTERVAL_SECS = 15 * 60
+
+    _MAGIC = b'CBMS'
+    _VERSION = 1
+    _HEADER = struct.Struct('<4sHH')
+    _SLOT = struct.Struct('<q')
+
+    def __init__(self, path=None, flushIntervalSecs=FLUSH_INTERVAL_SECS):
+        self.path = path
+        self.flushIntervalSecs = flushIntervalSecs
+        self.nextFlushTime = 0
+        self._mmap = None
+        # resolution name -> slot number (time // slot secs) of newest slot
+        self._newestSlot = {name: None for name, _, _ in self.RESOLUTIONS}
+        self._rings = {
+            (metric, name): _Ring(size)
+            for metric in self.METRICS
+            for name, _, size in self.RESOLUTIONS
+        }
+        if path:
+            self._load()
+
+    def record(self, time, **values):
+        """
+        Add a sample taken at time for some or all metrics
+
+        Metrics that are missing or None are left as gaps for this sample.
+        """
+        for name, step, size in self.RESOLUTIONS:
+            slot = int(time // step)
+            newest = self._newestSlot[name]
+            if newest is not None and slot < newest:
+                # Clock went backwards (e.g. NTP sync after boot). Rather
+                #  than corrupting history, drop the sample
+                continue
+            if newest is None or slot > newest:
+                self._advance(name, size, newest, slot)
+            for metric in self.METRICS:
+                value = values.get(metric)
+                if value is None:
+                    continue
+                ring = self._rings[(metric, name)]
+                index = slot % size
+                ring.count += 1
+                if ring.count == 1:
+                    ring.values[index] = value
+                else:
+                    # running mean
+                    ring.values[index] += \
+                        (value - ring.values[index]) / ring.count
+
+    def _advance(self, name, size, newest, slot):
+        # Blank every slot between the old newest and the new one (all of
+        #  them if we've been away for longer than the ring covers)
+        skipped = size if newest is None else min(size, slot - newest)
+        for metric in self.METRICS:
+            ring = self._rings[(metric, name)]
+            for i in range(skipped):
+                ring.values[(slot - i) % size] = NAN
+            ring.count = 0
+        self._newestSlot[name] = slot
+
+    def series(self, metric, resolution, count=None):
+        """
+        Values for metric, oldest first, ending with the newest slot
+
+        Gaps are NaN. count limits the result to the newest count slots.
+        """
+        size = dict((n, s) for n, _, s in self.RESOLUTIONS)[resolution]
+        count = size if count is None else min(count, size)
+        newest = self._newestSlot[resolution]
+        if newest is None:
+            return [NAN] * count
+        values = self._rings[(metric, resolution)].values
+        start = (newest + 1 - count) % size
+        if start + count <= size:
+            return values[start:start + count].tolist()
+        return (values[start:] + values[:start + count - size]).tolist()
+
+    def latest(self, metric, resolution='minute'):
+        """Newest value (mean of the current slot) or None"""
+        value = self.series(metric, resolution, 1)[0]
+        return None if math.isnan(value) else value
+
+    def _blobSize(self):
+        slots = sum(size for _, _, size in self.RESOLUTIONS)
+        return self._HEADER.size + len(self.RESOLUTIONS) * self._SLOT.size + \
+            len(self.METRICS) * (slots * 4 + len(self.RESOLUTIONS) * 4)
+
+    def _serialise(self):
+        parts = [self._HEADER.pack(self._MAGIC, self._VERSION,
+                                   len(self.METRICS))]
+        for name, _, _ in self.RESOLUTIONS:
+            newest = self._newestSlot[name]
+            parts.append(self._SLOT.pack(-1 if newest is None else newest))
+            for metric in self.METRICS:
+                ring = self._rings[(metric, name)]
+                parts.append(struct.pack('<I', ring.count))
+                parts.append(ring.values.tobytes())
+        return b''.join(parts)
+
+    def _load(self):
+        size = self._blobSize()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            logging.warning("Unable to open metrics file %s: %s. "
+                            "Metrics will not be persisted", self.path, e)
+            self.path = None
+            return
+        try:
+            if os.fstat(fd).st_size != size:
+                # New, or written by a different version: start again
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        blob = self._mmap[:]
+        magic, version, metricCount = self._HEADER.unpack_from(blob)
+        if magic != self._MAGIC or version != self._VERSION or \
+                metricCount != len(self.METRICS):
+            return
+        offset = self._HEADER.size
+        for name, _, slots in self.RESOLUTIONS:
+            newest, = self._SLOT.unpack_from(blob, offset)
+            offset += self._SLOT.size
+            self._newestSlot[name] = None if newest < 0 else newest
+            for metric in self.METRICS:
+                ring = self._rings[(metric, name)]
+                ring.count, = struct.unpack_from('<I', blob, offset)
+                offset += 4
+                ring.values = array('f')
+                ring.values.frombytes(blob[offset:offset + slots * 4])
+                offset += slots * 4
+        logging.debug("Loaded metrics history from %s", self.path)
+
+    def flush(self):
+        """Write the store to its file, if it has one"""
+        if self._mmap is None:
+            return
+        self._mmap[:] = self._serialise()
+        self._mmap.flush()
+
+    def maybeFlush(self, now):
+        """flush(), at most once every flushIntervalSecs"""
+        if now >= self.nextFlushTime:
+            self.flush()
+            self.nextFlushTime = now + self.flushIntervalSecs
+
+    def close(self):
+        if self._mmap is not None:
+            self.flush()
+            self._mmap.close()
+            self._mmap = None
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional HTTP mirror of what the display shows
+
+For supporting remote sites. Each frame the display backend sends (after
+frames identical to the one shown have been dropped) is published here and
+served from a background thread:
+
+    GET /                   a page that draws the stream below
+    GET /frame.png          the current frame (?scale=N to enlarge it)
+    GET /frames?since=SEQ   long poll: waits (up to ?timeout=secs) for a
+                            frame newer than SEQ and returns its diff
+    GET /events             Server-Sent Events: a diff per frame
+
+Diffs are JSON: {"seq": n, "width": w, "height": h, "full": bool,
+"rows": [[y, hex], ...]}, where each changed row is hex of its pixels
+packed 8 to a byte, leftmost in the top bit, 1 lit. A page flip is a few
+hundred bytes and a changing value a few dozen. A diff is full (every row)
+when the client's SEQ is too old to diff against.
+
+PNGs are encoded here (1-bit greyscale) so that serving them needs no PIL.
+"""
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from socketserver import ThreadingMixIn
+import struct
+import threading
+from urllib.parse import parse_qs, urlsplit
+import zlib
+
+from .framebuffer import BLACK, FrameBuffer
+
+# Frames kept to diff against, so that slightly behind clients get a diff
+HISTORY_FRAMES = 16
+LONG_POLL_MAX_SECS = 60
+SSE_KEEPALIVE_SECS = 15
+MAX_PNG_SCALE = 8
+
+INDEX_HTML = b"""<!DOCTYPE html>
+<html><head><title>ConnectBox display</title></head>
+<body style="background:#333">
+<canvas id="d" style="image-rendering:pixelated;width:512px"></canvas>
+<script>
+var c = document.getElementById('d'), x = c.getContext('2d');
+new EventSource('events').addEventListener('frame', function (e) {
+  var f = JSON.parse(e.data);
+  if (c.width != f.width || c.height != f.height) {
+    c.width = f.width; c.height = f.height;
+  }
+  f.rows.forEach(function (r) {
+    for (var i = 0; i < f.width; i++) {
+      var on = parseInt(r[1].substr(i >> 2, 1), 16) >> (3 - (i & 3)) & 1;
+      x.fillStyle = on ? '#fff' : '#000';
+      x.fillRect(i, r[0], 1, 1);
+    }
+  });
+});
+</script></body></html>
+"""
+
+
+def encodePNG(bitmap):
+    """bitmap as a 1-bit greyscale PNG"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    stride = (bitmap.width + 7) // 8
+    packed = bitmap.toBytes()
+    # Each row is preceded by its filter type (0: none)
+    raw = b''.join(b'\0' + packed[y * stride:(y + 1) * stride]
+                   for y in range(bitmap.height))
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', bitmap.width, bitmap.height,
+                                   1, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 9)) + \
+        chunk(b'IEND', b'')
+
+
+class FrameMirror:
+    """The latest frames shown, for clients to catch up from"""
+
+    def __init__(self):
+        self.seq = 0
+        self.width = self.height = 0
+        # seq -> frame rows, oldest first
+        self._history = OrderedDict()
+        self._changed = threading.Condition()
+
+    def attach(self, backend):
+        """Publish the frames that backend (see backends.py) shows"""
+        backend.listeners.append(self.publish)
+
+    def publish(self, frame):
+        with self._changed:
+            self.seq += 1
+            self.width, self.height = frame.width, frame.height
+            self._history[self.seq] = tuple(frame.rows)
+            if len(self._history) > HISTORY_FRAMES:
+                self._history.popitem(last=False)
+            self._changed.notify_all()
+
+    def current(self):
+        """The latest frame as a FrameBuffer, or None before the first"""
+        with self._changed:
+            if not self._history:
+                return None
+            return FrameBuffer(self.width, self.height,
+                               self._history[self.seq])
+
+    def wait(self, since, timeout):
+        """
+        Wait up to timeout secs for a frame other than since, returning the
+        latest seq
+
+        A since from the future (e.g. from before a restart) doesn't wait.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.seq != since, timeout)
+            return self.seq
+
+    def diff(self, since):
+        """The diff (a dict) from frame since to the latest"""
+        with self._changed:
+            rows = self._history.get(self.seq, ())
+            old = self._history.get(since)
+            full = old is None or len(old) != len(rows)
+            stride = (self.width + 7) // 8
+            pad = stride * 8 - self.width
+            changed = [
+                [y, (row << pad).to_bytes(stride, 'big').hex()]
+                for y, row in enumerate(rows) if full or row != old[y]]
+            return {'seq': self.seq, 'width': self.width,
+                    'height': self.height, 'full': full, 'rows': changed}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Event streams last as long as the client watches
+    daemon_threads = True
+
+
+class MirrorServer:
+
+    def __init__(self, mirror, port, address='127.0.0.1'):
+        """
+        :param address: the address to listen on; by default, only this
+          machine (a tunnel or proxy is to be used to reach it remotely)
+        """
+        self.mirror = mirror
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                handler = {
+                    '/': server.index,
+                    '/frame.png': server.png,
+                    '/frames': server.longPoll,
+                    '/events': server.events,
+                }.get(url.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    handler(self, query)
+                except ValueError:
+                    self.send_error(400)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                # pylint: disable=redefined-builtin
+                logging.debug("mirror: " + format, *args)
+
+        self.server = _ThreadingHTTPServer((address, port), Handler)
+
+    @staticmethod
+    def _reply(request, contentType, body):
+        request.send_response(200)
+        request.send_header('Content-Type', contentType)
+        request.send_header('Content-Length', str(len(body)))
+        request.send_header('Cache-Control', 'no-store')
+        request.end_headers()
+        request.wfile.write(body)
+
+    def index(self, request, query):
+        # pylint: disable=unused-argument
+        self._reply(request, 'text/html; charset=utf-8', INDEX_HTML)
+
+    def png(self, request, query):
+        scale = int(query.get('scale', ['1'])[0])
+        if not 1 <= scale <= MAX_PNG_SCALE:
+            raise ValueError(scale)
+        frame = self.mirror.current()
+        if frame is None:
+            # Nothing shown yet
+            frame = FrameBuffer(128, 64)
+            frame.fill(BLACK)
+        self._reply(request, 'image/png', encodePNG(frame.scaled(scale)))
+
+    def longPoll(self, request, query):
+        since = int(query.get('since', ['0'])[0])
+        timeout = max(0, min(float(query.get('timeout', ['30'])[0]),
+                             LONG_POLL_MAX_SECS))
+        self.mirror.wait(since, timeout)
+        self._reply(request, 'application/json',
+                    json.dumps(self.mirror.diff(since)).encode('utf-8'))
+
+    def events(self, request, query):
+        # EventSource reconnects with the id of the last event it had
+        since = int(request.headers.get('Last-Event-ID') or
+                    query.get('since', ['0'])[0])
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Cache-Control', 'no-store')
+        request.end_headers()
+        while True:
+            if self.mirror.wait(since, SSE_KEEPALIVE_SECS) != since:
+                diff = self.mirror.diff(since)
+                since = diff['seq']
+                request.wfile.write(b'event: frame\nid: %d\ndata: %s\n\n' % (
+                    since, json.dumps(diff).encode('utf-8')))
+            else:
+                request.wfile.write(b': keepalive\n\n')
+            request.wfile.flush()
+
+    def start(self):
+        """Serve from a daemon thread, so it never blocks shutdown"""
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='display-mirror', daemon=True)
+        thread.start()
+        logging.info("Mirroring the display on %s port %s",
+                     *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Which page stack the display is on and what each input does there
+
+Navigation is a table mapping (state, event) to (next state, action).
+Actions are method names on the target (the HAT) and may return a follow
+up event, which is looked up from the next state. For example, pressing
+the right button on an admin page runs chooseAdminPage, which returns
+EXIT_CHOSEN or COMMAND_CHOSEN, leading to the status pages or the confirm
+page respectively. Transitions for ANY state apply where there's no more
+specific one, and a next state of None means staying put.
+
+Events are handled one at a time. Those from the buttons are dropped
+rather than queued while another is being handled (e.g. while a copy
+runs) so that a press can never act on a page that has since changed.
+"""
+
+import logging
+import threading
+
+# States. The values are reported over the control socket (see ipc.py)
+STATUS = 'status'
+ADMIN = 'admin'
+CONFIRM = 'confirm'
+ERROR = 'error'
+SUCCESS = 'success'
+REMOVE_USB = 'removeUsb'
+ANY = None
+
+# Inputs
+LEFT = 'left'                   # short press of the left button
+RIGHT = 'right'                 # short press of the right button
+LONG_PRESS = 'long_press'       # long press of both buttons
+TIMEOUT = 'timeout'             # the display was blanked after being idle
+USB_REMOVED = 'usb_removed'
+RUN = 'run'                     # run a command (args: the command)
+SHOW_STATUS = 'show_status'     # show a status page (args: its index)
+# Returned by actions
+EXIT_CHOSEN = 'exit_chosen'
+COMMAND_CHOSEN = 'command_chosen'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+USB_PRESENT = 'usb_present'
+
+TRANSITIONS = {
+    (STATUS, LEFT): (STATUS, 'moveForward'),
+    (STATUS, RIGHT): (STATUS, 'moveBackward'),
+    (STATUS, LONG_PRESS): (ADMIN, 'showAdminPages'),
+
+    (ADMIN, LEFT): (ADMIN, 'moveForward'),
+    (ADMIN, RIGHT): (ADMIN, 'chooseAdminPage'),
+    (ADMIN, LONG_PRESS): (STATUS, 'showStatusPages'),
+    (ADMIN, EXIT_CHOSEN): (STATUS, 'showStatusPages'),
+    (ADMIN, COMMAND_CHOSEN): (CONFIRM, 'showConfirmPage'),
+
+    (CONFIRM, LEFT): (ADMIN, 'chooseCancel'),
+    (CONFIRM, RIGHT): (CONFIRM, 'runChosenCommand'),
+    (CONFIRM, LONG_PRESS): (ADMIN, 'chooseCancel'),
+
+    (ERROR, LEFT): (ADMIN, 'chooseCancel'),
+    (ERROR, RIGHT): (ADMIN, 'chooseCancel'),
+    (ERROR, LONG_PRESS): (ADMIN, 'chooseCancel'),
+
+    (SUCCESS, LEFT): (ADMIN, 'chooseCancel'),
+    (SUCCESS, RIGHT): (ADMIN, 'chooseCancel'),
+    (SUCCESS, LONG_PRESS): (ADMIN, 'chooseCancel'),
+
+    # Either button checks again whether the USB stick has been removed
+    (REMOVE_USB, LEFT): (REMOVE_USB, 'runChosenCommand'),
+    (REMOVE_USB, RIGHT): (REMOVE_USB, 'runChosenCommand'),
+    (REMOVE_USB, LONG_PRESS): (ADMIN, 'chooseCancel'),
+    (REMOVE_USB, USB_REMOVED): (SUCCESS, 'showSuccessPage'),
+
+    # Command outcomes; the command has already shown the page to go with
+    #  them
+    (ANY, SUCCEEDED): (SUCCESS, None),
+    (ANY, FAILED): (ERROR, None),
+    (ANY, USB_PRESENT): (REMOVE_USB, None),
+
+    (ANY, TIMEOUT): (STATUS, 'resetPages'),
+    (ANY, RUN): (None, 'runCommandNow'),
+    (ANY, SHOW_STATUS): (STATUS, 'goToStatusPage'),
+}
+
+
+class Navigator:
+
+    def __init__(self, target, transitions=None, state=STATUS):
+        self.target = target
+        self.transitions = TRANSITIONS if transitions is None \
+            else transitions
+        self.state = state
+        # Held while an event is handled. Re-entrant so that an action can
+        #  report progress that results in another event
+        self._lock = threading.RLock()
+
+    def lookup(self, event, state=None):
+        """(next state, action) for event in state (default: the current)"""
+        state = self.state if state is None else state
+        return self.transitions.get((state, event)) or \
+            self.transitions.get((ANY, event))
+
+    def busy(self):
+        """True while an event is being handled by another thread"""
+        if not self._lock.acquire(False):
+            return True
+        self._lock.release()
+        return False
+
+    def exclusive(self, func, *args, blocking=True):
+        """
+        Run func(*args) (e.g. a display refresh) while no event is handled,
+        so that it can't interleave with an action
+
+        Returns False (without running func) if blocking is False and an
+        event is being handled by another thread.
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            func(*args)
+            return True
+        finally:
+            self._lock.release()
+
+    def handle(self, event, *args, blocking=True):
+        """
+        Run the transition for event, passing args to its action
+
+        Returns False (doing nothing) if there's no transition for event in
+        the current state or if blocking is False and another event is being
+        handled.
+        """
+        if not self._lock.acquire(blocking):
+            logging.debug("Busy; ignoring %s in %s", event, self.state)
+            return False
+        try:
+            while event is not None:
+                transition = self.lookup(event)
+                if transition is None:
+                    logging.debug("Nothing to do for %s in %s", event,
+                                  self.state)
+                    return False
+                nextState, action = transition
+                logging.debug("%s in %s: %s", event, self.state, action)
+                # The state only changes once the action has succeeded
+                event = getattr(self.target, action)(*args) \
+                    if action else None
+                args = ()
+                if nextState is not None:
+                    self.state = nextState
+            return True
+        finally:
+            self._lock.release()
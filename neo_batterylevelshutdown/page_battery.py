@@ -10,11 +10,9 @@
 ===========================================
 """
 
-import os.path
-from PIL import Image
-from PIL import ImageFont
-from PIL import ImageDraw
 import axp209
+from . import framebuffer
+from .framebuffer import WHITE
 from .HAT_Utilities import get_device
 
 
@@ -24,71 +22,52 @@ class PageBattery:
         self.axp = axp
 
     def draw_page(self):
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        # find out if the unit is charging or not
         # get an image
-        img_path = dir_path + '/assets/battery_page.png'
-
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        # make a blank image for the text, initialized as transparent
-        txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
+        d = framebuffer.background('battery_page.png')
 
         # get a font
-        font_path = dir_path + '/assets/connectbox.ttf'
-        font18 = ImageFont.truetype(font_path, 18)
-        font14 = ImageFont.truetype(font_path, 14)
-        # get a drawing context
-        d = ImageDraw.Draw(txt)
+        font18 = framebuffer.font(18)
+        font14 = framebuffer.font(14)
 
-        # draw text, full opacity
-        d.text((5, 42), "%.0f" %
-               int(self.axp.battery_voltage), font=font18, fill="black")
-        d.text((52, 42), "%.1f" %
-               self.axp.internal_temperature, font=font18, fill="black")
+        # draw text
+        d.text((5, 42), "%.0f" % int(self.axp.battery_voltage), font18)
+        d.text((52, 42), "%.1f" % self.axp.internal_temperature, font18)
 
+        # find out if the unit is charging or not
         if self.axp.power_input_status.acin_present:
             # charging
             # cover the out arrow
-            d.rectangle((47, 4, 62, 14), fill="white")  # out arrow
+            d.rectangle((47, 4, 62, 14), WHITE)  # out arrow
             # percent charge left
-            d.text((50, 1), "%.0f%%" %
-                   self.axp.battery_gauge, font=font18, fill="black")
-            d.text((94, 42), "%.0f" %
-                   self.axp.battery_charge_current, font=font18, fill="black")
+            d.text((50, 1), "%.0f%%" % self.axp.battery_gauge, font18)
+            d.text((94, 42), "%.0f" % self.axp.battery_charge_current, font18)
         else:
             # discharging
             # cover the charging symbol & in arrow
-            d.rectangle((119, 0, 127, 16), fill="white")  # charge symbol
-            d.rectangle((0, 4, 14, 14), fill="white")  # in arrow
+            d.rectangle((119, 0, 127, 16), WHITE)  # charge symbol
+            d.rectangle((0, 4, 14, 14), WHITE)  # in arrow
             # percent charge left
-            d.text((63, 1), "%.0f%%" %
-                   self.axp.battery_gauge, font=font18, fill="black")
-            d.text((94, 42), "%.0f" %
-                   self.axp.battery_discharge_current,
-                   font=font18, fill="black")
+            d.text((63, 1), "%.0f%%" % self.axp.battery_gauge, font18)
+            d.text((94, 42), "%.0f" % self.axp.battery_discharge_current,
+                   font18)
 
         # draw battery fill lines
         if not self.axp.battery_exists:
             # cross out the battery
-            d.line((20, 5, 38, 12), fill="black", width=2)
-            d.line((20, 12, 38, 5), fill="black", width=2)
+            d.line((20, 5, 38, 12), width=2)
+            d.line((20, 12, 38, 5), width=2)
         else:
             # get the percent filled and draw a rectangle
             percent = self.axp.battery_gauge
             if percent < 10:
-                d.rectangle((20, 5, 22, 12), fill="black")
-                d.text((15, 2), "!", font=font14, fill="black")
+                d.rectangle((20, 5, 22, 12))
+                d.text((15, 2), "!", font14)
             else:
                 # start of battery level= 20px, end = 38px
                 x = int((38 - 20) * (percent / 100)) + 20
                 # print("X:" + str(x))
-                d.rectangle((20, 5, x, 12), fill="black")
-        out = Image.alpha_composite(img, txt)
-        self.device.display(out.convert(self.device.mode))
-        self.device.show()
+                d.rectangle((20, 5, x, 12))
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
@@ -10,8 +10,7 @@
 ===========================================
 """
 
-import os.path
-from PIL import Image
+from . import framebuffer
 from .HAT_Utilities import get_device
 
 
@@ -20,16 +19,7 @@ class PageBatteryLow:
         self.device = device
 
     def draw_page(self):
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-
-        img_path = dir_path + '/assets/battery_low.png'
-
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        self.device.display(img.convert(self.device.mode))
-        self.device.show()
+        framebuffer.showAsset(self.device, 'battery_low.png')
 
 
 if __name__ == "__main__":
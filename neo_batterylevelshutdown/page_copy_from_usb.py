@@ -11,10 +11,9 @@
 """
 
 from datetime import datetime
-import os.path
 import subprocess
 import sys
-from PIL import Image, ImageFont, ImageDraw
+from . import framebuffer
 from .HAT_Utilities import get_device
 
 
@@ -33,11 +32,7 @@ class PageCopyFromUsb:
 
     def draw_page(self):
         # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/copy_from_usb.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
+        img = framebuffer.background('copy_from_usb.png')
 
         # # make a blank image for the text, initialized as transparent
         # txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
@@ -68,8 +63,7 @@ class PageCopyFromUsb:
         #     pass
 
         # out = Image.alpha_composite(img, txt)
-        self.device.display(img.convert(self.device.mode))
-        self.device.show()
+        framebuffer.show(self.device, img)
 
 
 if __name__ == "__main__":
@@ -10,12 +10,9 @@
 ===========================================
 """
 
-from datetime import datetime
-import os.path
-import subprocess
 import logging
 import sys
-from PIL import Image, ImageFont, ImageDraw
+from . import framebuffer
 from .HAT_Utilities import get_device
 
 
@@ -33,19 +30,9 @@ class PageDisplayImage:
         self.imageName = imageName
 
     def draw_page(self):
-        # display a specified impage
+        # display a specified impage (error.png if there's no such image)
         logging.debug("Showing {}".format(self.imageName))
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/' + self.imageName
-        if not os.path.isfile(img_path):
-            img_path = dir_path + '/assets/error.png'
-
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        self.device.display(img.convert(self.device.mode))
-        self.device.show()
+        framebuffer.showAsset(self.device, self.imageName)
 
 
 if __name__ == "__main__":
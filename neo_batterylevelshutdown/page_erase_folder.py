@@ -11,10 +11,9 @@
 """
 
 from datetime import datetime
-import os.path
 import subprocess
 import sys
-from PIL import Image, ImageFont, ImageDraw
+from . import framebuffer
 from .HAT_Utilities import get_device
 
 
@@ -31,15 +30,7 @@ class PageEraseFolder:
         self.device = device
 
     def draw_page(self):
-        # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/erase_folder.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        self.device.display(img.convert(self.device.mode))
-        self.device.show()
+        framebuffer.showAsset(self.device, 'erase_folder.png')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+===========================================
+  page_history.py
+  https://github.com/ConnectBox/NEO_BatteryLevelShutdown
+  License: MIT
+  Version 1.0
+===========================================
+
+Sparklines of the last hour and day of a metric from the metrics store
+"""
+
+import math
+from . import framebuffer
+from .hardware import statePath
+from .metrics import MetricsStore
+from .HAT_Utilities import get_device
+
+
+def downsample(values, width):
+    """
+    Reduce (or stretch) values to width columns of (min, max)
+
+    NaN values are ignored and columns without any values are None. Each
+    column is the min and max of a slice of the series, which keeps spikes
+    visible. Slices are passed to the builtin min and max as they are; only
+    those that contain a NaN (which their sum shows) are filtered first.
+    """
+    count = len(values)
+    columns = []
+    for column in range(width):
+        start = column * count // width
+        end = max(start + 1, (column + 1) * count // width)
+        bucket = values[start:end]
+        if math.isnan(sum(bucket)):
+            bucket = [v for v in bucket if not math.isnan(v)]
+        columns.append((min(bucket), max(bucket)) if bucket else None)
+    return columns
+
+
+class PageHistory:
+
+    # (resolution, number of slots, label) for the top and bottom plots
+    SPANS = (('minute', 60, '1h'), ('hour', 24, '1d'))
+    PLOT_LEFT = 16
+
+    def __init__(self, device, metrics, metric, title, valueFormat='%.0f'):
+        self.device = device
+        self.metrics = metrics
+        self.metric = metric
+        self.title = title
+        self.valueFormat = valueFormat
+
+    def draw_sparkline(self, d, font, series, top, bottom):
+        width = self.device.width - self.PLOT_LEFT
+        columns = downsample(series, width)
+        finite = [c for c in columns if c is not None]
+        if not finite:
+            d.text((self.PLOT_LEFT + 4, top), "no data", font)
+            return
+        low = min(c[0] for c in finite)
+        high = max(c[1] for c in finite)
+        if high - low < 1e-6:
+            low, high = low - 1, high + 1
+        scale = (bottom - top) / (high - low)
+        for x, column in enumerate(columns, start=self.PLOT_LEFT):
+            if column is None:
+                continue
+            d.line((x, bottom - int((column[0] - low) * scale),
+                    x, bottom - int((column[1] - low) * scale)))
+
+    def draw_page(self):
+        # There's no background image
+        d = framebuffer.blank(self.device)
+        font14 = framebuffer.font(14)
+
+        latest = self.metrics.latest(self.metric)
+        d.text((0, 0), self.title, font14)
+        if latest is not None:
+            value = self.valueFormat % latest
+            d.text((self.device.width - font14.textsize(value)[0], 0),
+                   value, font14)
+
+        plotHeight = (self.device.height - 16) // len(self.SPANS)
+        for i, (resolution, slots, label) in enumerate(self.SPANS):
+            top = 16 + i * plotHeight
+            d.text((0, top), label, font14)
+            self.draw_sparkline(
+                d, font14, self.metrics.series(self.metric, resolution, slots),
+                top + 1, top + plotHeight - 2)
+
+        framebuffer.show(self.device, d)
+
+
+if __name__ == "__main__":
+    try:
+        PageHistory(get_device(), MetricsStore(statePath('metrics.bin')),
+                    'battery', 'Battery %').draw_page()
+    except KeyboardInterrupt:
+        pass
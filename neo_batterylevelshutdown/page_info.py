@@ -11,11 +11,11 @@
 """
 
 from datetime import datetime
-import os.path
 import subprocess
 import sys
-from PIL import Image, ImageFont, ImageDraw
+from . import framebuffer
 from .HAT_Utilities import get_device
+from . import telemetry
 
 
 try:
@@ -56,8 +56,9 @@ class PageInfo:
 
     @staticmethod
     def get_connected_users():
-        c = subprocess.run(['iw', 'dev', 'wlan0', 'station',
-                            'dump'], stdout=subprocess.PIPE)
+        with telemetry.timed('subprocess_iw'):
+            c = subprocess.run(['iw', 'dev', 'wlan0', 'station',
+                                'dump'], stdout=subprocess.PIPE)
         connected_user_count = len([line for line in c.stdout.decode(
             "utf-8").split('\n') if line.startswith("Station")])
         return "%s" % connected_user_count
@@ -68,43 +69,30 @@ class PageInfo:
 
     def draw_page(self):
         # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/info_page.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        # make a blank image for the text, initialized as transparent
-        txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
+        d = framebuffer.background('info_page.png')
 
         # get a font
-        font_path = dir_path + '/assets/connectbox.ttf'
-        font20 = ImageFont.truetype(font_path, 26)
-        font18 = ImageFont.truetype(font_path, 18)
-        # get a drawing context
-        d = ImageDraw.Draw(txt)
+        font20 = framebuffer.font(26)
+        font18 = framebuffer.font(18)
 
         # uptime
-        d.text((50, 0), PageInfo.uptime(), font=font18, fill="black")
+        d.text((50, 0), PageInfo.uptime(), font18)
 
         # connected users
-        d.text((20, 30), PageInfo.get_connected_users(),
-               font=font20, fill="black")
+        d.text((20, 30), PageInfo.get_connected_users(), font20)
 
         # network stats
         try:
             stat = PageInfo.network('wlan0')
             d.text((58, 35), "Tx: %s" % PageInfo.bytes2human(
-                stat.bytes_sent), font=font18, fill="black")
+                stat.bytes_sent), font18)
             d.text((58, 47), "Rx: %s" % PageInfo.bytes2human(
-                stat.bytes_recv), font=font18, fill="black")
+                stat.bytes_recv), font18)
         except KeyError:
             # no wifi enabled/available
             pass
 
-        out = Image.alpha_composite(img, txt)
-        self.device.display(out.convert(self.device.mode))
-        self.device.show()
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
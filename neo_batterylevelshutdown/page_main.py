@@ -10,11 +10,12 @@
 ===========================================
 """
 
-import os.path
 import subprocess
-from PIL import Image, ImageFont, ImageDraw
 import axp209
+from . import framebuffer
+from .framebuffer import WHITE
 from .HAT_Utilities import get_device, GetReleaseVersion
+from . import telemetry
 
 
 class PageMain:
@@ -24,8 +25,9 @@ class PageMain:
 
     @staticmethod
     def get_connected_users():
-        c = subprocess.run(['iw', 'dev', 'wlan0', 'station',
-                            'dump'], stdout=subprocess.PIPE)
+        with telemetry.timed('subprocess_iw'):
+            c = subprocess.run(['iw', 'dev', 'wlan0', 'station',
+                                'dump'], stdout=subprocess.PIPE)
         connected_user_count = len([line for line in c.stdout.decode(
             "utf-8").split('\n') if line.startswith("Station")])
         return "%s" % connected_user_count
@@ -38,62 +40,46 @@ class PageMain:
 
     def draw_page(self):
         # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/main_page.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        # make a blank image for the text, initialized as transparent
-        txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
+        d = framebuffer.background('main_page.png')
 
         # get a font
-        font_path = dir_path + '/assets/connectbox.ttf'
-        font30 = ImageFont.truetype(font_path, 30)
-        font20 = ImageFont.truetype(font_path, 20)
-        font14 = ImageFont.truetype(font_path, 14)
-
-        # get a drawing context
-        d = ImageDraw.Draw(txt)
+        font30 = framebuffer.font(30)
+        font20 = framebuffer.font(20)
+        font14 = framebuffer.font(14)
 
         # ConnectBox Banner
-        d.text((2, 0), 'ConnectBox', font=font30, fill="black")
+        d.text((2, 0), 'ConnectBox', font30)
         # Image version name/number
-        d.text((38, 32), GetReleaseVersion(), font=font14, fill="black")
+        d.text((38, 32), GetReleaseVersion(), font14)
 
         # connected users
-        d.text((13, 35), PageMain.get_connected_users(),
-               font=font20, fill="black")
+        d.text((13, 35), PageMain.get_connected_users(), font20)
 
         if not self.axp.power_input_status.acin_present:
             # not charging - cover up symbol
-            d.rectangle((64, 48, 71, 61), fill="white")  # charge symbol
+            d.rectangle((64, 48, 71, 61), WHITE)  # charge symbol
 
         # draw battery fill lines
         if not self.axp.battery_exists:
             # cross out the battery
-            d.line((37, 51, 57, 58), fill="black", width=2)
-            d.line((37, 58, 57, 51), fill="black", width=2)
+            d.line((37, 51, 57, 58), width=2)
+            d.line((37, 58, 57, 51), width=2)
         else:
             # get the percent filled and draw a rectangle
             if self.axp.battery_gauge < 10:
-                d.rectangle((37, 51, 39, 58), fill="black")
-                d.text((43, 51), "!", font=font14, fill="black")
+                d.rectangle((37, 51, 39, 58))
+                d.text((43, 51), "!", font14)
             else:
                 # start of battery level= 37px, end = 57px
                 x = int((57 - 37) * (self.axp.battery_gauge / 100)) + 37
-                d.rectangle((37, 51, x, 58), fill="black")
+                d.rectangle((37, 51, x, 58))
 
         # percent charge left
-        d.text((75, 49), "%.0f%%" % self.axp.battery_gauge,
-               font=font14, fill="black")
+        d.text((75, 49), "%.0f%%" % self.axp.battery_gauge, font14)
         # cpu temp
-        d.text((105, 49), "%.0fC" % PageMain.get_cpu_temp(),
-               font=font14, fill="black")
+        d.text((105, 49), "%.0fC" % PageMain.get_cpu_temp(), font14)
 
-        out = Image.alpha_composite(img, txt)
-        self.device.display(out.convert(self.device.mode))
-        self.device.show()
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
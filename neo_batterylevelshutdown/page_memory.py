@@ -11,9 +11,9 @@
 """
 
 import sys
-import os.path
-from PIL import Image, ImageFont, ImageDraw
 
+from . import config
+from . import framebuffer
 from .HAT_Utilities import get_device
 
 
@@ -65,41 +65,25 @@ class PageMemory:
 
     def draw_page(self):
         # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/memory_page.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        # make a blank image for the text, initialized as transparent
-        txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
+        d = framebuffer.background('memory_page.png')
 
         # get a font
-        font_path = dir_path + '/assets/connectbox.ttf'
-        font18 = ImageFont.truetype(font_path, 18)
-        # get a drawing context
-        d = ImageDraw.Draw(txt)
+        font18 = framebuffer.font(18)
 
         # cpu usage
-        d.text((50, 1), "%.0f%%" % PageMemory.cpu_usage(),
-               font=font18, fill="black")
+        d.text((50, 1), "%.0f%%" % PageMemory.cpu_usage(), font18)
 
         # memory usage
         usage = PageMemory.mem_usage()
-        d.text((50, 21), "%.0f%%" %
-               (100 - usage.percent), font=font18, fill="black")
-        d.text((85, 21), "%s" % PageMemory.bytes2human(usage.used),
-               font=font18, fill="black")
+        d.text((50, 21), "%.0f%%" % (100 - usage.percent), font18)
+        d.text((85, 21), "%s" % PageMemory.bytes2human(usage.used), font18)
 
         # disk usage
-        usage = PageMemory.disk_usage('/media/usb0')
-        d.text((50, 42), "%.0f%%" % usage.percent, font=font18, fill="black")
-        d.text((85, 42), "%s" % PageMemory.bytes2human(usage.used),
-               font=font18, fill="black")
-
-        out = Image.alpha_composite(img, txt)
-        self.device.display(out.convert(self.device.mode))
-        self.device.show()
+        usage = PageMemory.disk_usage(config.current().contentPath)
+        d.text((50, 42), "%.0f%%" % usage.percent, font18)
+        d.text((85, 42), "%s" % PageMemory.bytes2human(usage.used), font18)
+
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""
+===========================================
+  page_shutdown.py
+  https://github.com/ConnectBox/NEO_BatteryLevelShutdown
+  License: MIT
+  Version 1.0
+===========================================
+
+The last thing shown before the power goes
+"""
+
+from . import framebuffer
+from .HAT_Utilities import get_device
+
+
+class PageShutdown:
+    def __init__(self, device):
+        self.device = device
+
+    def draw_page(self):
+        d = framebuffer.blank(self.device)
+        font18 = framebuffer.font(18)
+        for line, text in enumerate(("Shutting", "down...")):
+            width, height = font18.textsize(text)
+            d.text(((self.device.width - width) // 2,
+                    self.device.height // 2 - height + line * height),
+                   text, font18)
+        framebuffer.show(self.device, d)
+
+
+if __name__ == "__main__":
+    try:
+        PageShutdown(get_device()).draw_page()
+    except KeyboardInterrupt:
+        pass
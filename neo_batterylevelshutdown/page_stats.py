@@ -13,7 +13,9 @@ sudo logrotate /etc/logrotate.hourly.conf
 
 import json
 import os.path
-from PIL import Image, ImageFont, ImageDraw
+from . import config
+from . import framebuffer
+from .framebuffer import WHITE
 from .HAT_Utilities import get_device
 
 
@@ -24,8 +26,7 @@ class PageStats:
         self.page_num = page_num
 
     def readStatsJSON(self):
-        STATS_FILE = '/var/www/connectbox/connectbox_default/stats.top10.json'
-        with open(STATS_FILE) as json_file:
+        with open(config.current().statsFilePath) as json_file:
             data = json.load(json_file)
             print('============================')
             print('     ' + self.dt_range)
@@ -37,34 +38,25 @@ class PageStats:
 
     def draw_page(self):
         # get an image
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/stats_h_page.png'
+        img_name = 'stats_h_page.png'
         if self.dt_range == 'hour':
-            img_path = dir_path + '/assets/stats_h_page.png'
+            img_name = 'stats_h_page.png'
         elif self.dt_range == 'day':
-            img_path = dir_path + '/assets/stats_d_page.png'
+            img_name = 'stats_d_page.png'
         elif self.dt_range == 'week':
-            img_path = dir_path + '/assets/stats_w_page.png'
+            img_name = 'stats_w_page.png'
         elif self.dt_range == 'month':
-            img_path = dir_path + '/assets/stats_m_page.png'
+            img_name = 'stats_m_page.png'
         elif self.dt_range == 'year':
-            img_path = dir_path + '/assets/stats_y_page.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        # make a blank image for the text, initialized as transparent
-        txt = Image.new('RGBA', base.size, (255, 255, 255, 0))
+            img_name = 'stats_y_page.png'
+        d = framebuffer.background(img_name)
 
         # get a font
-        font_path = dir_path + '/assets/connectbox.ttf'
-        font20 = ImageFont.truetype(font_path, 22)
-        font10 = ImageFont.truetype(font_path, 12)
-        # get a drawing context
-        d = ImageDraw.Draw(txt)
+        font20 = framebuffer.font(22)
+        font10 = framebuffer.font(12)
 
         # draw text, full opacity
-        fname = '/var/www/connectbox/connectbox_default/stats.top10.json'
+        fname = config.current().statsFilePath
         if os.path.isfile(fname):
             # file exists continue
             with open(fname) as json_file:
@@ -73,23 +65,22 @@ class PageStats:
                 count = 0
 
                 if self.page_num == 1:
-                    d.text((107, 18), 'p1', font=font20, fill="black")
+                    d.text((107, 18), 'p1', font20)
                 else:
-                    d.text((107, 18), 'p2', font=font20, fill="black")
+                    d.text((107, 18), 'p2', font20)
 
                 # check to see if we have data or not
                 for p in data[self.dt_range]:
                     if 'resource' in p.keys():
                         # cover up the unhappy face
-                        d.rectangle((25, 1, 75, 128), fill="white")
+                        d.rectangle((25, 1, 75, 128), WHITE)
 
                 for p in data[self.dt_range]:
                     media = p['resource'].rsplit('/', 1)[1]
                     if self.page_num == 1:
                         # trim out directories
                         d.text((2, y), '(%s) %s' %
-                               (str(p['count']), media),
-                               font=font10, fill="black")
+                               (str(p['count']), media), font10)
                         y += 12
                         count += 1
                         if count == 5:
@@ -99,13 +90,10 @@ class PageStats:
                         count += 1
                         if count > 5:
                             d.text((2, y), '(%s) %s' %
-                                   (str(p['count']), media),
-                                   font=font10, fill="black")
+                                   (str(p['count']), media), font10)
                             y += 12
 
-        out = Image.alpha_composite(img, txt)
-        self.device.display(out.convert(self.device.mode))
-        self.device.show()
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
@@ -11,11 +11,11 @@
 """
 
 from datetime import datetime
-import os.path
 import subprocess
 import sys
-from PIL import Image, ImageFont, ImageDraw
+from . import framebuffer
 from .HAT_Utilities import get_device
+from .page_memory import PageMemory
 
 
 try:
@@ -27,21 +27,23 @@ except ImportError:
 
 
 class PageWait:
-    def __init__(self, device):
+    def __init__(self, device, rateLimit=0):
         self.device = device
-
+        # Bytes a second that the copy being waited for is limited to
+        #  (0 for none)
+        self.rateLimit = rateLimit
 
     def draw_page(self):
-        # get an image
-        return
-        dir_path = os.path.dirname(os.path.abspath(__file__))
-        img_path = dir_path + '/assets/wait.png'
-        base = Image.open(img_path).convert('RGBA')
-        fff = Image.new(base.mode, base.size, (255,) * 4)
-        img = Image.composite(base, fff, base)
-
-        self.device.display(img.convert(self.device.mode))
-        self.device.show()
+        if not self.rateLimit:
+            framebuffer.showAsset(self.device, 'wait.png')
+            return
+        d = framebuffer.background('wait.png')
+        font14 = framebuffer.font(14)
+        # beside the hourglass
+        d.text((84, 18), "Max", font14)
+        d.text((84, 36), "%s/s" % PageMemory.bytes2human(int(self.rateLimit)),
+               font14)
+        framebuffer.show(self.device, d)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Readings that come from the operating system rather than the HAT, and the
+snapshot of all sensor readings that the HAT keeps up to date
+"""
+
+from collections import namedtuple
+import logging
+import subprocess
+
+from . import telemetry
+
+# The most recent value of everything that the HAT samples. Fields are None
+#  when the reading isn't available (e.g. no battery or no wifi interface)
+SensorSnapshot = namedtuple(
+    'SensorSnapshot',
+    'time batteryGauge batteryVoltage batteryCurrent charging '
+    'axpTemperature cpuTemperature connectedUsers bytesSent bytesRecv '
+    'throughput')
+
+
+class SystemSensors:
+
+    THERMAL_ZONE_PATH = '/sys/devices/virtual/thermal/thermal_zone0/temp'
+    NET_DEV_PATH = '/proc/net/dev'
+
+    def cpuTemperature(self):
+        """CPU temperature in degrees C, or None"""
+        try:
+            with open(self.THERMAL_ZONE_PATH) as f:
+                return int(f.readline()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    # pylint: disable=no-self-use
+    # This is a standard interface - simulated sensors need self
+    def connectedUsers(self, iface='wlan0'):
+        """Number of stations associated with iface, or None"""
+        try:
+            with telemetry.timed('subprocess_iw'):
+                c = subprocess.run(['iw', 'dev', iface, 'station', 'dump'],
+                                   stdout=subprocess.PIPE)
+        except OSError as e:
+            logging.debug("Unable to count stations: %s", e)
+            return None
+        return len([line for line in c.stdout.decode("utf-8").split('\n')
+                    if line.startswith("Station")])
+
+    def networkBytes(self, iface='wlan0'):
+        """(bytes sent, bytes received) on iface, or None"""
+        try:
+            with open(self.NET_DEV_PATH) as f:
+                for line in f:
+                    name, sep, counters = line.partition(':')
+                    if sep and name.strip() == iface:
+                        fields = counters.split()
+                        return int(fields[8]), int(fields[0])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
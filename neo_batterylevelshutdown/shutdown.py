@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ordered, time limited work to do before powering off
+
+Shutdowns are usually triggered because the power is about to go: the
+AXP209 cuts it a few seconds after a LEVEL2 interrupt and the q1y2018 HAT
+8 seconds after its 3.0V line falls. Hooks registered here (abort copies,
+flush metrics, sync filesystems, show a final page) are run in priority
+order, each in its own thread and given at most its deadline (and never
+more than what's left of the grace period, less a reserve for the
+poweroff itself). A hook that overruns is left behind rather than holding
+up the rest. How much of the grace period was used is logged.
+"""
+
+from collections import namedtuple
+import logging
+import threading
+
+from .hardware import clock, poweroff
+
+ShutdownHook = namedtuple('ShutdownHook', 'priority name deadlineSecs func')
+
+# Used when the shutdown doesn't come with a hardware deadline (e.g. from
+#  a battery check)
+DEFAULT_GRACE_SECS = 10
+# Kept back from the hooks for the poweroff call itself
+POWEROFF_RESERVE_SECS = 0.5
+
+_hooks = {}
+_hooksLock = threading.Lock()
+_shutdownStarted = threading.Event()
+
+
+def addHook(name, func, priority=50, deadlineSecs=1.0):
+    """
+    Run func (with no arguments) when shutting down
+
+    Lower priorities run first. A hook with the same name as an existing
+    one replaces it.
+    """
+    with _hooksLock:
+        _hooks[name] = ShutdownHook(priority, name, deadlineSecs, func)
+
+
+def removeHook(name):
+    with _hooksLock:
+        _hooks.pop(name, None)
+
+
+def _runHook(hook, timeout):
+    """True if hook finished within timeout secs"""
+    def target():
+        try:
+            hook.func()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Shutdown hook %s failed", hook.name)
+    thread = threading.Thread(target=target, name='shutdown-' + hook.name,
+                              daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def shutdown(graceSecs=None, reason=''):
+    """Run the shutdown hooks, then power off. Only the first call does so"""
+    if _shutdownStarted.is_set():
+        logging.debug("Shutdown already in progress")
+        return
+    _shutdownStarted.set()
+    graceSecs = DEFAULT_GRACE_SECS if graceSecs is None else graceSecs
+    logging.info("Shutting down (%s) with a %.1fs grace period", reason,
+                 graceSecs)
+    startTime = clock.monotonic()
+    budgetEnd = startTime + graceSecs - POWEROFF_RESERVE_SECS
+    with _hooksLock:
+        hooks = sorted(_hooks.values())
+    for hook in hooks:
+        hookStart = clock.monotonic()
+        timeout = min(hook.deadlineSecs, budgetEnd - hookStart)
+        if timeout <= 0:
+            logging.warning("No time left for shutdown hook %s", hook.name)
+            continue
+        finished = _runHook(hook, timeout)
+        logging.info("Shutdown hook %s %s in %.3fs", hook.name,
+                     "finished" if finished else "abandoned",
+                     clock.monotonic() - hookStart)
+    used = clock.monotonic() - startTime
+    logging.info("Shutdown hooks used %.2fs of the %.1fs grace period",
+                 used, graceSecs)
+    poweroff()
+
+
+def _reset():
+    """Forget that a shutdown happened (for simulations and tests)"""
+    _shutdownStarted.clear()
@@ -0,0 +1,585 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulated hardware backend
+
+Stands in for RPi.GPIO, the AXP209 (and the SMBus it sits on) and the
+system clock so that the HAT classes can be run off-device. Time is virtual,
+so a week of battery discharge, button presses and interrupt line activity
+can be replayed through a HAT's mainLoop in seconds while counting the
+wakeups, I2C transactions and CPU time that it would have cost on the NEO.
+
+Example::
+
+    scenario = Scenario(durationSecs=7 * 24 * 3600)
+    scenario.pressButton(3600, q4y2018HAT.PIN_L_BUTTON)
+    print(simulate(q4y2018HAT, scenario))
+"""
+
+from collections import namedtuple
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from . import hardware
+from . import interrupts
+from . import shutdown
+from .usb import USB
+
+DAY_SECS = 24 * 3600
+
+
+class SimulationFinished(Exception):
+    """Raised from within the simulated clock to unwind the HAT main loop"""
+
+
+class SimulatedClock:
+    """
+    Virtual replacement for the time module
+
+    Time only moves forward when something sleeps (or explicitly advances
+    the clock), and any events scheduled for the interval that is skipped
+    over are run in order along the way.
+    """
+
+    def __init__(self, endTime=float('inf')):
+        self.now = 0.0
+        self.endTime = endTime
+        self.wakeups = 0
+        self._events = []
+        self._sequence = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.wakeups += 1
+        self.advance(secs)
+
+    def schedule(self, at, func, *args):
+        heapq.heappush(self._events, (at, next(self._sequence), func, args))
+
+    def advance(self, secs):
+        target = self.now + secs
+        while self._events and self._events[0][0] <= target:
+            at, _, func, args = heapq.heappop(self._events)
+            self.now = max(self.now, at)
+            func(*args)
+        # Events may have advanced the clock themselves (e.g. a button
+        #  callback polling the pin) so never move time backwards
+        self.now = max(self.now, target)
+        if self.now >= self.endTime:
+            raise SimulationFinished()
+
+
+class SimulatedGPIO:
+    """Drop-in for the subset of the RPi.GPIO API used in this package"""
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    # Virtual time that passes for each read of an input. Without this, code
+    #  that busy-waits on a pin (e.g. Axp209HAT.checkPressTime) would never
+    #  see the pin change
+    READ_COST_SECS = 0.001
+
+    def __init__(self, clock, levels=None):
+        self.clock = clock
+        self.levels = dict(levels or {})
+        self.mode = None
+        self.reads = 0
+        self.callbacks = 0
+        self._detectors = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        # pylint: disable=unused-argument
+        if initial is not None:
+            self.levels[channel] = initial
+        # Inputs float high unless told otherwise. The buttons on the HATs
+        #  are active low, so this means "not pressed"
+        self.levels.setdefault(channel, self.HIGH)
+
+    def input(self, channel):
+        self.reads += 1
+        self.clock.advance(self.READ_COST_SECS)
+        return self.levels.get(channel, self.HIGH)
+
+    def output(self, channel, value):
+        self.levels[channel] = value
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        # pylint: disable=unused-argument
+        self._detectors[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel):
+        self._detectors.pop(channel, None)
+
+    def cleanup(self):
+        self._detectors.clear()
+
+    def drive(self, channel, value):
+        """Change the level of an input, firing any matching edge callback"""
+        previous = self.levels.get(channel, self.HIGH)
+        self.levels[channel] = value
+        if previous == value or channel not in self._detectors:
+            return
+        edge, callback = self._detectors[channel]
+        rising = value == self.HIGH
+        if edge in (self.BOTH, self.RISING if rising else self.FALLING):
+            if callback:
+                self.callbacks += 1
+                callback(channel)
+
+
+class SimulatedSMBus:
+    """Register file for a single device that counts every transaction"""
+
+    def __init__(self):
+        self.registers = bytearray(256)
+        self.transactions = 0
+        # Registers where writing a 1 clears the bit (e.g. IRQ status)
+        self.writeOneToClear = set()
+        # Hook that is run before each read so that the owner of the
+        #  registers can bring them up to date
+        self.beforeRead = None
+
+    def read_byte_data(self, i2c_addr, register):
+        # pylint: disable=unused-argument
+        self.transactions += 1
+        if self.beforeRead:
+            self.beforeRead()
+        return self.registers[register]
+
+    def write_byte_data(self, i2c_addr, register, value):
+        # pylint: disable=unused-argument
+        self.transactions += 1
+        if register in self.writeOneToClear:
+            self.registers[register] &= ~value & 0xFF
+        else:
+            self.registers[register] = value & 0xFF
+
+    def read_i2c_block_data(self, i2c_addr, register, length):
+        # pylint: disable=unused-argument
+        self.transactions += 1
+        if self.beforeRead:
+            self.beforeRead()
+        return list(self.registers[register:register + length])
+
+    def write_i2c_block_data(self, i2c_addr, register, data):
+        # pylint: disable=unused-argument
+        self.transactions += 1
+        self.registers[register:register + len(data)] = bytes(data)
+
+    def close(self):
+        pass
+
+
+PowerInputStatus = namedtuple(
+    'PowerInputStatus',
+    'acin_present acin_available vbus_present vbus_usable battery_direction')
+
+
+class BatteryModel:
+    """
+    Battery and charger behaviour as a function of (virtual) time
+
+    dischargeCurve is a list of (secs, gauge percent) points which are
+    linearly interpolated. Charging periods are given as (start, end) secs.
+    Pass batteryExists=False to model a unit running from the charger alone.
+    gaugeJitterPerc adds (reproducible) noise to gauge readings, like that
+    seen on the device under varying wifi load.
+    """
+
+    def __init__(self, dischargeCurve=((0, 100), (7 * DAY_SECS, 0)),
+                 chargingPeriods=(), batteryExists=True,
+                 dischargeCurrentMA=350, chargeCurrentMA=800,
+                 temperatureC=45.0, gaugeJitterPerc=0, seed=0):
+        self.gaugeJitterPerc = gaugeJitterPerc
+        self._random = random.Random(seed)
+        self.dischargeCurve = sorted(dischargeCurve)
+        self.chargingPeriods = chargingPeriods
+        self.batteryExists = batteryExists
+        self.dischargeCurrentMA = dischargeCurrentMA
+        self.chargeCurrentMA = chargeCurrentMA
+        self.temperatureC = temperatureC
+
+    def gauge(self, now):
+        jitter = self._random.uniform(-1, 1) * self.gaugeJitterPerc \
+            if self.gaugeJitterPerc else 0
+        return max(0, min(100, self._trueGauge(now) + jitter))
+
+    def _trueGauge(self, now):
+        points = self.dischargeCurve
+        if now <= points[0][0]:
+            return points[0][1]
+        for (t0, g0), (t1, g1) in zip(points, points[1:]):
+            if now <= t1:
+                return g0 + (g1 - g0) * (now - t0) / (t1 - t0)
+        return points[-1][1]
+
+    def charging(self, now):
+        return any(start <= now < end for start, end in self.chargingPeriods)
+
+    def voltage(self, now):
+        # Rough single cell LiPo curve: 3.0V empty to 4.2V full
+        return 3000 + 12 * self.gauge(now)
+
+
+class SimulatedAXP209:
+    """
+    Stand-in for axp209.AXP209 backed by a SimulatedSMBus
+
+    Registers are refreshed from the BatteryModel before each read and
+    decoded the same way as the real library, so reads cost the same number
+    of I2C transactions as they do on the device.
+    """
+
+    def __init__(self, bus, clock, battery):
+        self.bus = bus
+        self.clock = clock
+        self.battery = battery
+        self.bus.beforeRead = self._syncRegisters
+        self.bus.writeOneToClear.update(range(
+            interrupts.IRQ_STATUS_REGISTER,
+            interrupts.IRQ_STATUS_REGISTER + interrupts.IRQ_REGISTER_COUNT))
+
+    def _syncRegisters(self):
+        now = self.clock.time()
+        regs = self.bus.registers
+        charging = self.battery.charging(now)
+        regs[0x00] = 0xC0 if charging else 0x00
+        regs[0x01] = 0x20 if self.battery.batteryExists else 0x00
+        if self.battery.batteryExists:
+            regs[0xB9] = max(0, min(100, int(self.battery.gauge(now))))
+            voltage = int(self.battery.voltage(now) / 1.1)
+        else:
+            regs[0xB9] = 0x7F
+            voltage = 0
+        regs[0x78], regs[0x79] = voltage >> 4, voltage & 0x0F
+        chargeBin = int(self.battery.chargeCurrentMA / 0.5) if charging else 0
+        regs[0x7A], regs[0x7B] = chargeBin >> 4, chargeBin & 0x0F
+        dischargeBin = 0 if charging else \
+            int(self.battery.dischargeCurrentMA / 0.5)
+        regs[0x7C], regs[0x7D] = dischargeBin >> 5, dischargeBin & 0x1F
+        tempBin = int((self.battery.temperatureC + 144.7) / 0.1)
+        regs[0x5E], regs[0x5F] = tempBin >> 4, tempBin & 0x0F
+
+    def _read(self, register):
+        return self.bus.read_byte_data(hardware.AXP209_ADDRESS, register)
+
+    @property
+    def power_input_status(self):
+        value = self._read(0x00)
+        return PowerInputStatus(
+            bool(value & 0x80), bool(value & 0x40), bool(value & 0x20),
+            bool(value & 0x10), bool(value & 0x04))
+
+    @property
+    def battery_exists(self):
+        return bool(self._read(0x01) & 0x20)
+
+    @property
+    def battery_gauge(self):
+        gauge = self._read(0xB9) & 0x7F
+        return -1 if gauge > 100 else gauge
+
+    @property
+    def battery_voltage(self):
+        return (self._read(0x78) << 4 | self._read(0x79) & 0x0F) * 1.1
+
+    @property
+    def battery_charge_current(self):
+        return (self._read(0x7A) << 4 | self._read(0x7B) & 0x0F) * 0.5
+
+    @property
+    def battery_discharge_current(self):
+        return (self._read(0x7C) << 5 | self._read(0x7D) & 0x1F) * 0.5
+
+    @property
+    def internal_temperature(self):
+        return (self._read(0x5E) << 4 | self._read(0x5F) & 0x0F) * 0.1 - 144.7
+
+    def close(self):
+        self.bus.close()
+
+
+class SimulatedSensors:
+    """Operating system readings driven by the scenario"""
+
+    # Traffic generated by each connected user
+    BYTES_PER_USER_SECS = 20000
+
+    def __init__(self, clock, scenario):
+        self.clock = clock
+        self.scenario = scenario
+        self.temperatureC = 50.0
+        self._bytes = 0
+        self._bytesTime = 0
+
+    def cpuTemperature(self):
+        return self.temperatureC
+
+    def connectedUsers(self, iface='wlan0'):
+        # pylint: disable=unused-argument
+        return self.scenario.usersAt(self.clock.time())
+
+    def networkBytes(self, iface='wlan0'):
+        # pylint: disable=unused-argument
+        now = self.clock.time()
+        self._bytes += int((now - self._bytesTime) *
+                           self.BYTES_PER_USER_SECS *
+                           self.scenario.usersAt(now))
+        self._bytesTime = now
+        # Mostly downloads
+        return self._bytes // 10, self._bytes - self._bytes // 10
+
+
+class SimulatedDisplay:
+    """Display that records the calls made by the HAT instead of drawing"""
+
+    def __init__(self, powerManagementDevice, metrics=None):
+        # pylint: disable=unused-argument
+        self.calls = []
+
+    def _record(self, name):
+        self.calls.append(name)
+
+    def moveForward(self):
+        self._record('moveForward')
+
+    def moveBackward(self):
+        self._record('moveBackward')
+
+    def showStatusPages(self):
+        self._record('showStatusPages')
+
+    def showAdminPages(self):
+        self._record('showAdminPages')
+
+    def resetPages(self):
+        self._record('resetPages')
+
+    def checkIfLastPage(self):
+        return False
+
+    def getAdminPageName(self):
+        return ''
+
+    def powerOffDisplay(self):
+        self._record('powerOffDisplay')
+
+    def showStatusPage(self, index):
+        self._record('showStatusPage')
+
+    def setContrast(self, level):
+        self._record('setContrast')
+
+    def refreshPage(self):
+        self._record('refreshPage')
+
+    def showLowBatteryWarning(self):
+        self._record('showLowBatteryWarning')
+
+    def hideLowBatteryWarning(self):
+        self._record('hideLowBatteryWarning')
+
+    def showConfirmPage(self):
+        self._record('showConfirmPage')
+
+    def showWaitPage(self):
+        self._record('showWaitPage')
+
+    def showCopyRateLimit(self, rateLimit):
+        self._record('showCopyRateLimit')
+
+    def showRemoveUsbPage(self):
+        self._record('showRemoveUsbPage')
+
+    def showNoUsbPage(self):
+        self._record('showNoUsbPage')
+
+    def showNoSpacePage(self):
+        self._record('showNoSpacePage')
+
+    def showSuccessPage(self):
+        self._record('showSuccessPage')
+
+    def showErrorPage(self):
+        self._record('showErrorPage')
+
+    def showShutdownPage(self):
+        self._record('showShutdownPage')
+
+    def drawLogo(self):
+        self._record('drawLogo')
+
+
+class SimulatedBackend:
+    """Backend for hardware.use_backend() built from a Scenario"""
+
+    name = 'simulated'
+
+    def __init__(self, scenario):
+        self.clock = SimulatedClock(endTime=scenario.durationSecs)
+        self.gpio = SimulatedGPIO(self.clock, scenario.pinLevels)
+        self.sensors = SimulatedSensors(self.clock, scenario)
+        self.bus = SimulatedSMBus()
+        self.battery = scenario.battery
+        self.shutdownTime = None
+        # Where the AXP209 IRQ line is wired, if it is (set by simulate())
+        self.axpInterruptLine = None
+        for at, channel, value in scenario.pinEvents:
+            self.clock.schedule(at, self.gpio.drive, channel, value)
+        for start, end in self.battery.chargingPeriods:
+            self.clock.schedule(start, self.raiseAxpInterrupt,
+                                interrupts.ACIN_PLUGGED)
+            self.clock.schedule(end, self.raiseAxpInterrupt,
+                                interrupts.ACIN_REMOVED)
+        for at, cause in scenario.axpInterrupts:
+            self.clock.schedule(at, self.raiseAxpInterrupt, cause)
+
+    def raiseAxpInterrupt(self, cause):
+        """Latch cause, if enabled, and pulse the IRQ line (if wired)"""
+        regs = self.bus.registers
+        for name, offset, bit in interrupts.CAUSES:
+            if name != cause or \
+                    not regs[interrupts.IRQ_ENABLE_REGISTER + offset] & bit:
+                continue
+            regs[interrupts.IRQ_STATUS_REGISTER + offset] |= bit
+            if self.axpInterruptLine is not None:
+                # The line is released once the status is cleared, which
+                #  the handler does straight away
+                self.gpio.drive(self.axpInterruptLine, 0)
+                self.gpio.drive(self.axpInterruptLine, 1)
+
+    def axp209(self, *args, **kwargs):
+        # pylint: disable=unused-argument
+        return SimulatedAXP209(self.bus, self.clock, self.battery)
+
+    def poweroff(self):
+        self.shutdownTime = self.clock.time()
+        raise SimulationFinished()
+
+    def syncFilesystems(self):
+        pass
+
+    # pylint: disable=no-self-use,unused-argument
+    def statePath(self, name):
+        # Simulations shouldn't touch the real state on disk
+        return None
+
+
+class Scenario:
+    """Script of what happens to the hardware over a simulation run"""
+
+    def __init__(self, durationSecs=7 * DAY_SECS, battery=None,
+                 pinLevels=None):
+        self.durationSecs = durationSecs
+        self.battery = battery or BatteryModel()
+        # Default levels represent a Q4Y2018 HAT: PA6 (HAT present) high and
+        #  PA1 low
+        self.pinLevels = {12: 1, 22: 0}
+        self.pinLevels.update(pinLevels or {})
+        self.pinEvents = []
+        # (secs, interrupts cause) in addition to the charger's
+        self.axpInterrupts = []
+        # (secs, connected users) in time order
+        self.users = [(0, 0)]
+
+    def pressButton(self, at, channel, holdSecs=0.5):
+        """Active-low button press on channel starting at 'at' secs"""
+        self.pinEvents.append((at, channel, 0))
+        self.pinEvents.append((at + holdSecs, channel, 1))
+
+    def setUsers(self, at, count):
+        """From 'at' secs, count users are connected to the wifi"""
+        self.users.append((at, count))
+        self.users.sort()
+
+    def usersAt(self, now):
+        count = 0
+        for at, users in self.users:
+            if at > now:
+                break
+            count = users
+        return count
+
+    def pulseLine(self, at, channel, widthSecs=0.01):
+        """Falling edge on an interrupt line (e.g. the AXP209 IRQ)"""
+        self.pressButton(at, channel, widthSecs)
+
+    def axpInterrupt(self, at, cause):
+        """The AXP209 reports cause (see interrupts.py) at 'at' secs"""
+        self.axpInterrupts.append((at, cause))
+
+
+SimulationResult = namedtuple(
+    'SimulationResult',
+    'virtualSecs wallSecs cpuSecs wakeups i2cTransactions gpioReads '
+    'callbacks shutdownTime displayCalls')
+
+
+def simulate(hatClass, scenario, displayClass=SimulatedDisplay):
+    """
+    Run hatClass's mainLoop against a simulated backend for the scenario
+
+    The previously active backend is restored afterwards.
+    """
+    previousBackend = hardware._backend  # pylint: disable=protected-access
+    backend = SimulatedBackend(scenario)
+    backend.axpInterruptLine = getattr(hatClass, 'PIN_AXP_INTERRUPT_LINE',
+                                       None)
+    hardware.use_backend(backend)
+    # Each simulation gets to shut down (and copy)
+    shutdown._reset()  # pylint: disable=protected-access
+    USB.abortCopy.clear()
+    wallStart = time.monotonic()
+    cpuStart = time.process_time()
+    hat = None
+    try:
+        hat = hatClass(displayClass)
+        hat.mainLoop()
+    except SimulationFinished:
+        pass
+    finally:
+        hardware.use_backend(previousBackend)
+    display = getattr(hat, 'display', None)
+    return SimulationResult(
+        virtualSecs=backend.clock.time(),
+        wallSecs=time.monotonic() - wallStart,
+        cpuSecs=time.process_time() - cpuStart,
+        wakeups=backend.clock.wakeups,
+        i2cTransactions=backend.bus.transactions,
+        gpioReads=backend.gpio.reads,
+        callbacks=backend.gpio.callbacks,
+        shutdownTime=backend.shutdownTime,
+        displayCalls=len(getattr(display, 'calls', ())),
+    )
+
+
+if __name__ == "__main__":
+    from . import hats
+    logging.basicConfig(level=logging.INFO)
+    weekScenario = Scenario()
+    for day in range(7):
+        weekScenario.pressButton(day * DAY_SECS + 9 * 3600,
+                                 hats.q4y2018HAT.PIN_L_BUTTON)
+    print(simulate(hats.q4y2018HAT, weekScenario))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process counters and histograms describing what the daemon is doing
+
+These are cheap to update from any thread and are rendered in OpenMetrics
+text format by exporter.py alongside the HAT's sensor snapshot.
+
+Hot paths (page draws, display pushes, I2C transfers, subprocesses and
+button handling) are also wrapped in timed() blocks. Those are only
+recorded once profiling is enabled (the --profile option); until then
+timed() returns a shared do-nothing context manager, so the cost is a
+function call and a flag check.
+"""
+
+from bisect import bisect_left
+import logging
+import threading
+import time
+
+# Latency buckets (seconds) suitable for I2C transfers and page redraws
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+# Finer grained than the defaults, down to the cost of a single I2C read
+PROFILE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROFILE_PREFIX = 'connectbox_profile_'
+
+_registry = {}
+_registryLock = threading.Lock()
+_profiling = False
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name + '_total', '', self.value
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, '', self.value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # Non-cumulative counts per bucket, with a final +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the q quantile, or None"""
+        with self._lock:
+            counts = list(self.counts)
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return bound
+        return None
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield self.name + '_bucket', '{le="%s"}' % le, cumulative
+        yield self.name + '_count', '', cumulative
+        yield self.name + '_sum', '', total
+
+
+def _getOrCreate(cls, name, *args):
+    with _registryLock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args)
+        return _registry[name]
+
+
+def counter(name, documentation):
+    """The registered Counter called name, created if necessary"""
+    return _getOrCreate(Counter, name, documentation)
+
+
+def gauge(name, documentation):
+    """The registered Gauge called name, created if necessary"""
+    return _getOrCreate(Gauge, name, documentation)
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    """The registered Histogram called name, created if necessary"""
+    return _getOrCreate(Histogram, name, documentation, buckets)
+
+
+def registered():
+    """All registered metrics, sorted by name"""
+    with _registryLock:
+        return [_registry[name] for name in sorted(_registry)]
+
+
+def enableProfiling(enabled=True):
+    global _profiling  # pylint: disable=global-statement
+    _profiling = enabled
+
+
+class _Timer:
+
+    __slots__ = ('histogram', 'startTime')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.startTime = None
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.startTime)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(operation):
+    """
+    Context manager that records the duration of operation when profiling
+
+    The duration goes into the connectbox_profile_<operation>_seconds
+    histogram.
+    """
+    if not _profiling:
+        return _NULL_TIMER
+    return _Timer(histogram(PROFILE_PREFIX + operation + '_seconds',
+                            'Time spent in ' + operation, PROFILE_BUCKETS))
+
+
+def dumpProfile():
+    """Log a summary of every profiled operation"""
+    logging.info("%-40s %8s %10s %10s %10s", "operation", "count",
+                 "mean ms", "p50 ms", "p95 ms")
+    for metric in registered():
+        if not metric.name.startswith(PROFILE_PREFIX) or not metric.count:
+            continue
+        operation = metric.name[len(PROFILE_PREFIX):-len('_seconds')]
+        logging.info("%-40s %8d %10.2f %10s %10s", operation, metric.count,
+                     metric.sum / metric.count * 1000,
+                     _formatBound(metric.quantile(0.5)),
+                     _formatBound(metric.quantile(0.95)))
+
+
+def _formatBound(bound):
+    return '>%g' % (PROFILE_BUCKETS[-1] * 1000) if bound == float('inf') \
+        else '<=%g' % (bound * 1000)
+
+
+class CountingBus:
+    """
+    Wraps an SMBus so that every transaction is counted
+
+    The axp209 library does all of its I/O through its bus attribute, so
+    replacing that attribute with one of these counts every register access.
+    """
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._transactions = counter(
+            'connectbox_i2c_transactions', 'I2C transactions with the AXP209')
+
+    def __getattr__(self, name):
+        attr = getattr(self._bus, name)
+        if not callable(attr) or name == 'close':
+            return attr
+
+        def counted(*args, **kwargs):
+            self._transactions.inc()
+            with timed('i2c_' + name):
+                return attr(*args, **kwargs)
+        return counted
+
+
+class ProfiledDevice:
+    """Wraps a luma device so that each push to the display is timed"""
+
+    def __init__(self, device):
+        self._device = device
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def display(self, image):
+        with timed('device_display'):
+            self._device.display(image)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throttling of copies from USB, so that content keeps being served
+
+Copying a stick flat out saturates the SD card that content is streamed
+from, and clients on the Wi-Fi buffer constantly. A CopyThrottle paces the
+copy with two token buckets, one for bytes and one for operations (a read
+and a write per chunk), and the copying thread is put in the idle I/O
+class (as by ionice -c 3) so that anything else reading the card goes
+first.
+
+The byte rate adapts to what's being served. Every copyBackoffSampleSecs
+the station count and the Wi-Fi traffic are sampled: when either has
+risen (traffic by more than a quarter), the rate is halved (down to
+copyMinBytesPerSec); when nobody is connected, or traffic has fallen
+(by more than a quarter, or to almost nothing), it climbs back by an
+eighth of copyMaxBytesPerSec at a time. Otherwise it's left alone.
+
+The current limit is published as the
+connectbox_copy_rate_limit_bytes_per_second gauge and in the control
+socket's snapshot (copyRateLimit), as the display shows the wait page
+while copying.
+"""
+
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import threading
+
+from . import config
+from . import telemetry
+from .hardware import clock, sensors
+
+# Longest sleep between checks for an aborted copy
+MAX_SLEEP_SECS = 0.25
+# The fraction of copyMaxBytesPerSec that the rate climbs back by
+RECOVERY_STEPS = 8
+# Changes in traffic smaller than this are noise
+TRAFFIC_CHANGE_PERC = 25
+# Traffic below this (e.g. DHCP and beacons) is as good as none
+QUIET_TRAFFIC_BYTES_PER_SEC = 16 * 1024
+
+# From <linux/ioprio.h>
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+# (ioprio_set, ioprio_get) syscall numbers, by platform.machine()
+IOPRIO_SYSCALLS = {
+    'x86_64': (251, 252),
+    'i386': (289, 290),
+    'i686': (289, 290),
+    'armv6l': (314, 315),
+    'armv7l': (314, 315),
+    'aarch64': (30, 31),
+}
+
+
+class TokenBucket:
+    """rate tokens a second, up to burst saved up"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = clock.monotonic()
+
+    def take(self, count):
+        """
+        Take count tokens, returning how many seconds to wait for them
+
+        Tokens can be taken on credit (e.g. a chunk bigger than the
+        burst), and the wait pays the debt back.
+        """
+        now = clock.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        return max(0, -self.tokens / self.rate)
+
+    def setRate(self, rate):
+        # Refilled at the old rate up to now
+        self.take(0)
+        self.rate = self.burst = rate
+        self.tokens = min(self.tokens, self.burst)
+
+
+class CopyThrottle:
+
+    def __init__(self, maxBytesPerSec, minBytesPerSec=None, maxOpsPerSec=0,
+                 sampleSecs=2, abort=None):
+        """
+        :param maxBytesPerSec: 0 for no limit on bytes (or backing off)
+        :param minBytesPerSec: how far to back off (by default, to an
+          eighth of maxBytesPerSec)
+        :param maxOpsPerSec: 0 for no limit on operations
+        """
+        self.maxBytesPerSec = maxBytesPerSec
+        if minBytesPerSec is None:
+            minBytesPerSec = maxBytesPerSec / RECOVERY_STEPS
+        self.minBytesPerSec = min(minBytesPerSec, maxBytesPerSec)
+        self.sampleSecs = sampleSecs
+        # An Event that cuts waits short
+        self.abort = abort or threading.Event()
+        self.bytes = TokenBucket(maxBytesPerSec) if maxBytesPerSec else None
+        self.ops = TokenBucket(maxOpsPerSec) if maxOpsPerSec else None
+        self._users = None
+        self._traffic = None
+        self._netBytes = None
+        self._sampled = None
+        self._rateGauge = telemetry.gauge(
+            'connectbox_copy_rate_limit_bytes_per_second',
+            'Current limit on the rate of copying from USB (0 is none)')
+        self._rateGauge.set(self.rateLimit)
+        # Called with the new rateLimit whenever it changes
+        self.listener = None
+
+    @classmethod
+    def fromConfig(cls, abort=None):
+        """A CopyThrottle for the throttle settings, or None if unlimited"""
+        cfg = config.current()
+        if not cfg.copyMaxBytesPerSec and not cfg.copyMaxOpsPerSec:
+            return None
+        return cls(cfg.copyMaxBytesPerSec, cfg.copyMinBytesPerSec,
+                   cfg.copyMaxOpsPerSec, cfg.copyBackoffSampleSecs, abort)
+
+    @property
+    def rateLimit(self):
+        """Bytes a second that copying is limited to (0 for no limit)"""
+        return self.bytes.rate if self.bytes is not None else 0
+
+    def pace(self, count, ops=2):
+        """Account for count bytes copied in ops operations, waiting if due"""
+        now = clock.monotonic()
+        if self.bytes is not None and \
+                (self._sampled is None or
+                 now - self._sampled >= self.sampleSecs):
+            self._sampled = now
+            self.adapt(sensors.connectedUsers(), sensors.networkBytes(), now)
+        delay = 0
+        if self.bytes is not None:
+            delay = self.bytes.take(count)
+        if self.ops is not None:
+            delay = max(delay, self.ops.take(ops))
+        while delay > 0 and not self.abort.is_set():
+            clock.sleep(min(delay, MAX_SLEEP_SECS))
+            delay -= MAX_SLEEP_SECS
+
+    def adapt(self, users, netBytes, now):
+        """
+        Back off if the station count or Wi-Fi traffic has risen since the
+        last sample, recover if they've fallen or nobody's connected
+
+        :param netBytes: (sent, received) totals, or None if unavailable
+        """
+        traffic = None
+        if netBytes is not None and self._netBytes is not None and \
+                now > self._netBytes[0]:
+            traffic = (sum(netBytes) - self._netBytes[1]) / \
+                (now - self._netBytes[0])
+        if netBytes is not None:
+            self._netBytes = (now, sum(netBytes))
+        change = None
+        if traffic is not None and self._traffic is not None:
+            change = (traffic - self._traffic) * 100 / \
+                max(self._traffic, QUIET_TRAFFIC_BYTES_PER_SEC)
+        rising = (users is not None and self._users is not None and
+                  users > self._users) or \
+            (change is not None and change > TRAFFIC_CHANGE_PERC)
+        falling = users == 0 or \
+            (traffic is not None and
+             traffic < QUIET_TRAFFIC_BYTES_PER_SEC) or \
+            (change is not None and change < -TRAFFIC_CHANGE_PERC)
+        self._users = users
+        if traffic is not None:
+            self._traffic = traffic
+        rate = self.bytes.rate
+        if rising:
+            rate = max(self.minBytesPerSec, rate / 2)
+        elif falling:
+            rate = min(self.maxBytesPerSec,
+                       rate + self.maxBytesPerSec / RECOVERY_STEPS)
+        if rate != self.bytes.rate:
+            logging.debug("Copy rate limit now %d bytes/s (%s users, %s "
+                          "bytes/s of traffic)", rate, users, traffic)
+            self.bytes.setRate(rate)
+            self._rateGauge.set(rate)
+            if self.listener is not None:
+                self.listener(rate)
+
+
+def _ioprio(call, *args):
+    """
+    Make an ioprio_set (call 0) or ioprio_get (call 1) syscall for this
+    thread, returning its result or None if it failed
+    """
+    numbers = IOPRIO_SYSCALLS.get(platform.machine())
+    if numbers is None:
+        logging.debug("No ioprio syscalls known for %s", platform.machine())
+        return None
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # Who 0 is the calling thread (each has its own I/O priority), where
+    #  ionice would need the thread's id
+    result = libc.syscall(numbers[call], IOPRIO_WHO_PROCESS, 0, *args)
+    if result < 0:
+        logging.debug("Unable to %s the I/O priority: %s",
+                      ('set', 'get')[call], os.strerror(ctypes.get_errno()))
+        return None
+    return result
+
+
+def ioPriority():
+    """This thread's I/O priority (class << 13 | data), or None if unknown"""
+    return _ioprio(1)
+
+
+def setIOPriority(priority):
+    """Set this thread's I/O priority, returning whether that worked"""
+    return _ioprio(0, priority) is not None
+
+
+@contextmanager
+def idleIO(enabled=True):
+    """Run this thread in the idle I/O class for the duration, if enabled"""
+    previous = ioPriority() if enabled else None
+    active = previous is not None and \
+        setIOPriority(IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+    try:
+        yield
+    finally:
+        if active:
+            setIOPriority(previous)
@@ -2,101 +2,252 @@
 
 import logging
 import os
+import shutil
 import subprocess
 import threading
-from distutils.dir_util import copy_tree
+import time
+from . import config
+from . import telemetry
+from .throttle import CopyThrottle, idleIO
 
+# Small enough that a throttled copy is paced smoothly, and that an aborted
+#  copy stops well within the shutdown hook's deadline
+COPY_CHUNK_SIZE = 256 * 1024
 
 
 class USB:
 
+    # Set to stop copies in progress (e.g. when shutting down)
+    abortCopy = threading.Event()
+    # The CopyThrottle (see throttle.py) of the copy in progress, if any
+    activeThrottle = None
+
     def __init__(self):
-        pass
+        self._dedupStore = None
+        # What checkSpace planned, for copyFiles
+        self.plan = None
+
+    @classmethod
+    def abortCopies(cls):
+        cls.abortCopy.set()
 
-    def isUsbPresent(self, devPath = '/dev/sda1'):
+    def isUsbPresent(self, devPath = None):
         '''
         Returns if there is a USB plugged into specified devPath
         :return: True / False
         '''
+        devPath = devPath or config.current().usbDevicePath
         logging.debug("Checking to see if usb is mounted")
         return os.path.exists(devPath)
 
 
-    def unmount(self, curPath = '/media/usb0'):
+    def unmount(self, curPath = None):
         '''
         Unmount the USB drive from curPath
         :return:  True / False
         '''
+        curPath = curPath or config.current().contentPath
         try:
             logging.debug("Unmounting file at location {}".format(curPath))
-            response = subprocess.call(['umount', curPath])  # unmount drive
+            with telemetry.timed('subprocess_umount'):
+                response = subprocess.call(['umount', curPath])  # unmount drive
             return True if response == 0 else False
         except:
             return False
 
-    def mount(self, devPath = '/dev/sda1', newPath = '/media/usb1'):
+    def mount(self, devPath = None, newPath = None):
         '''
         Mount the USB drive at the devPath to the specified newPath location
 
         :return: True / False
         '''
+        devPath = devPath or config.current().usbDevicePath
+        newPath = newPath or config.current().usbMountPath
 
         # try:
         logging.debug("Mounting USB at {} to {}".format(devPath, newPath))
         if not os.path.exists(newPath):  # see if desired mounting directory exists
             os.makedirs(newPath)  # if not, make it, and all of the intermediary directories if needed
-        response = subprocess.call(['mount','-o', 'sync,noexec,nodev,noatime,nodiratime,utf8', devPath, newPath])
+        with telemetry.timed('subprocess_mount'):
+            response = subprocess.call(['mount','-o', 'sync,noexec,nodev,noatime,nodiratime,utf8', devPath, newPath])
         logging.debug("Response: {}".format(response))
         return True if response == 0 else False
         # except:
         #     return False
 
-    def copyFiles(self, sourcePath = '/media/usb1', destPath = '/media/usb0'):
+    def copyFiles(self, sourcePath = None, destPath = None, rateListener = None):
         '''
         Move files from sourcePath to destPath recursively
         :param sourcePath: place where files are
         :param destPath:  where we want to copy them to
+        :param rateListener: called with the bytes a second that the copy is limited to, at the start and whenever
+          that changes (only if the copy is throttled)
         :return:  True / False
         '''
+        sourcePath = sourcePath or config.current().usbMountPath
+        destPath = destPath or config.current().contentPath
 
         if os.path.exists(sourcePath) and os.path.exists(destPath):
             logging.debug("Copying tree")
             try:
-                copy_tree(sourcePath, destPath)
+                startTime = time.monotonic()
+                plan = self.plan
+                if plan is None or (plan.sourcePath, plan.destPath) != (sourcePath, destPath):
+                    # checkSpace wasn't called for these paths
+                    plan = self.planCopy(sourcePath, destPath, limited=False)
+                copyThrottle = USB.activeThrottle = CopyThrottle.fromConfig(self.abortCopy)
+                if copyThrottle is not None and rateListener is not None:
+                    copyThrottle.listener = rateListener
+                    rateListener(copyThrottle.rateLimit)
+                try:
+                    with idleIO(config.current().copyIdleIO):
+                        copiedBytes = self.copyTree(sourcePath, destPath, plan, copyThrottle)
+                finally:
+                    USB.activeThrottle = None
+                self.recordCopyThroughput(
+                    copiedBytes, time.monotonic() - startTime)
+                if self.abortCopy.is_set():
+                    logging.warning("Copy aborted")
+                    return False
                 logging.debug("Done copying")
                 return True
-            except:
+            except OSError:
+                logging.exception("Copying %s to %s failed", sourcePath, destPath)
                 return False
         else:
             return False
 
-    def checkSpace(self, sourcePath = '/media/usb1', destPath = '/media/usb0'):
+    def copyTree(self, sourcePath, destPath, plan=None, throttle=None):
+        '''
+        Copy the files under sourcePath to destPath, like distutils' copy_tree, stopping early if abortCopy is set
+
+        With copyDedup set, files go through the dedup store (see dedup.py) and only content it didn't
+        already have is written
+
+        :param plan: the CopyPlan to follow (see copyplan.py); by default, everything is copied
+        :param throttle: a CopyThrottle (see throttle.py) to pace the copy with; by default, it's unthrottled
+        :return: number of bytes copied
+        '''
+        store = self.dedupStore()
+        if plan is None:
+            plan = self.planCopy(sourcePath, destPath, limited=False)
+        for destDir in plan.dirs:
+            os.makedirs(destDir, exist_ok=True)
+        copiedBytes = 0
+        for planned in plan.files:
+            if self.abortCopy.is_set():
+                return copiedBytes
+            if store is not None:
+                copiedBytes += store.copy(planned.source, planned.dest, throttle, self.abortCopy)
+                continue
+            if os.path.lexists(planned.dest):
+                # Replaced, not written over, as it may be a hard link (e.g. of a dedup store object)
+                os.unlink(planned.dest)
+            if self.copyFile(planned.source, planned.dest, throttle):
+                copiedBytes += os.path.getsize(planned.dest)
+        if store is not None:
+            logging.info("Dedup saved %d bytes", store.savedBytes)
+        return copiedBytes
+
+    @classmethod
+    def copyFile(cls, source, dest, throttle=None):
+        '''
+        Copy source to dest (with its permissions and times, like shutil.copy2) a chunk at a time, so that
+        setting abortCopy stops it part way through a big file
+
+        :param throttle: a CopyThrottle (see throttle.py) to pace the copy with, if any
+        :return: True if it was copied, or False if aborted (when dest is removed rather than left half copied)
+        '''
+        aborted = False
+        with open(source, 'rb') as s, open(dest, 'wb') as d:
+            for chunk in iter(lambda: s.read(COPY_CHUNK_SIZE), b''):
+                if cls.abortCopy.is_set():
+                    aborted = True
+                    break
+                d.write(chunk)
+                if throttle is not None:
+                    throttle.pace(len(chunk))
+        if aborted:
+            os.unlink(dest)
+            return False
+        shutil.copystat(source, dest)
+        return True
+
+    def dedupStore(self):
+        '''
+        The dedup store to copy through, if copyDedup is set (opened once per USB)
+
+        :return: a DedupStore or None
+        '''
+        cfg = config.current()
+        if not cfg.copyDedup:
+            return None
+        storePath = config.dedupStorePath(cfg)
+        if self._dedupStore is None or self._dedupStore.root != storePath:
+            from .dedup import DedupStore
+            self._dedupStore = DedupStore(storePath)
+        return self._dedupStore
+
+    @staticmethod
+    def recordCopyThroughput(copiedBytes, seconds):
+        telemetry.counter('connectbox_copy_bytes',
+                          'Bytes copied from USB').inc(copiedBytes)
+        telemetry.counter('connectbox_copy_seconds',
+                          'Time spent copying from USB').inc(seconds)
+        if seconds > 0:
+            telemetry.gauge(
+                'connectbox_copy_last_throughput_bytes_per_second',
+                'Throughput of the most recent copy from USB'
+            ).set(copiedBytes / seconds)
+
+    def planCopy(self, sourcePath = None, destPath = None, limited = True):
+        '''
+        Work out what copying sourcePath to destPath will take (see copyplan.py)
+
+        :param limited: whether to leave out what won't fit
+        :return: a CopyPlan
+        '''
+        from . import copyplan
+        store = self.dedupStore()
+        if store is not None:
+            # So that what it frees is planned with
+            store.prune()
+        return copyplan.plan(sourcePath or config.current().usbMountPath,
+                             destPath or config.current().contentPath,
+                             store, limited)
+
+    def checkSpace(self, sourcePath = None, destPath = None):
         '''
         Function to make sure there is space on destination for source materials
 
+        Block rounding, inodes, reserved blocks, overwritten files and (with copyDedup) content that's
+        already stored are all accounted for. The plan is kept for copyFiles, so with copyPartial set it
+        copies what fits
+
         :param sourcePath: path to the source material
         :param destPath:  path to the destination
         :return: True / False
         '''
+        sourcePath = sourcePath or config.current().usbMountPath
+        destPath = destPath or config.current().contentPath
+        self.plan = None
         if os.path.exists(sourcePath) and os.path.exists(destPath):
-            sourceSize = self.getSize(sourcePath)
-            destSize = self.getFreeSpace(destPath)
-            logging.debug("Source size: {} bytes, destination size: {} bytes".format(sourceSize, destSize))
-            # if destSize >= sourceSize :
-            if destSize < sourceSize :    # test check
+            self.plan = self.planCopy(sourcePath, destPath)
+            if self.plan.complete:
                 return True
-            else:
-                return False
+            # Something doesn't fit
+            return bool(config.current().copyPartial and self.plan.files)
         else:
             return False
 
-    def getSize(self, startPath='/media/usb1'):
+    def getSize(self, startPath=None):
         '''
         Recursively get the size of a folder structure
 
         :param startPath: which folder structure
         :return: size in bytes of the folder structure
         '''
+        startPath = startPath or config.current().usbMountPath
         total_size = 0
         for dirpath, dirnames, filenames in os.walk(startPath):
             for f in filenames:
@@ -104,22 +255,24 @@ class USB:
                 total_size += os.path.getsize(fp)
         return total_size
 
-    def getFreeSpace(self, path='/media/usb0'):
+    def getFreeSpace(self, path=None):
         '''
         Determines how much free space in available for copying
 
         :param path: a path to put us in the right partition
         :return:  size in bytes of free space
         '''
+        path = path or config.current().contentPath
 
         # this is the cushion of space we want to leave free on our internal card
-        freeSpaceCushion = 1073741824  # 1 GiB
+        freeSpaceCushion = config.current().freeSpaceCushionBytes
         stat = os.statvfs(path)
-        free = stat.f_bfree * stat.f_bsize
+        # Blocks reserved for root aren't ours to fill
+        free = stat.f_bavail * (stat.f_frsize or stat.f_bsize)
         adjustedFree = free - freeSpaceCushion
         return adjustedFree
 
-    def moveMount(self, devMount = '/dev/sda1', curMount = '/media/usb0', destMount = '/media/usb1'):
+    def moveMount(self, devMount = None, curMount = None, destMount = None):
         '''
         This is a wrapper for umount, mount.  This is simple and works.
         we could use mount --move  if the mount points are not within a mount point that is marked as shared,
@@ -131,5 +284,5 @@ class USB:
         :return: True / False
         '''
 
-        self.unmount(curMount)
+        self.unmount(curMount or config.current().contentPath)
         return self.mount(devMount, destMount)
@@ -3,7 +3,10 @@
 
 """The setup script."""
 
+import os
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 with open('README.rst') as readme_file:
     readme = readme_file.read()
@@ -31,6 +34,26 @@ test_requirements = [
     'flake8==3.5.0',
 ]
 
+
+class BuildPyWithAssetPack(build_py):
+    """build_py that also converts the PNG assets for the display"""
+
+    def run(self):
+        super().run()
+        if self.dry_run:
+            return
+        try:
+            from neo_batterylevelshutdown import assetpack
+            count = assetpack.packAssets(path=os.path.join(
+                self.build_lib, 'neo_batterylevelshutdown', 'assets',
+                assetpack.PACK_NAME))
+        except ImportError as e:
+            # The daemon falls back to decoding the PNGs
+            self.warn("not packing assets: %s" % (e,))
+        else:
+            self.announce("packed %d assets" % (count,), level=2)
+
+
 setup(
     name='neo_batterylevelshutdown',
     version='0.12.0',
@@ -42,13 +65,16 @@ setup(
     url='https://github.com/ConnectBox/neo_batterylevelshutdown',
     packages=['neo_batterylevelshutdown'],
     package_data={'neo_batterylevelshutdown': ['assets/*.png',
-                                               'assets/connectbox.ttf',]},
+                                               'assets/connectbox.ttf',
+                                               'assets/*.pack']},
     entry_points={
         'console_scripts': [
             'neo_batterylevelshutdown=neo_batterylevelshutdown.cli:main'
         ]
     },
     install_requires=requirements,
+    python_requires='>=3.5',
+    cmdclass={'build_py': BuildPyWithAssetPack},
     license="MIT license",
     zip_safe=False,
     keywords='neo_batterylevelshutdown',
@@ -58,7 +84,6 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],
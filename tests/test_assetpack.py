@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.assetpack`."""
+
+
+import os
+import struct
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown import assetpack, framebuffer
+from neo_batterylevelshutdown.framebuffer import WHITE, FrameBuffer
+
+
+class FakeSSD1306:
+    """Records what would be sent to a luma ssd1306 device"""
+
+    class _const:
+        COLUMNADDR = 0x21
+        PAGEADDR = 0x22
+
+    mode = '1'
+    rotate = 0
+    _colstart = 0
+
+    def __init__(self, width=16, height=8):
+        self.width = width
+        self.height = height
+        self._colend = width
+        self._pages = height // 8
+        self.sent = []
+
+    def command(self, *cmd):
+        self.sent.append(('command', cmd))
+
+    def data(self, data):
+        self.sent.append(('data', data))
+
+    def show(self):
+        self.sent.append(('show',))
+
+
+class TestAssetPack(unittest.TestCase):
+    """Writing, mapping and pushing packed assets."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, assetpack.PACK_NAME)
+        self.logo = FrameBuffer(16, 8)
+        self.logo.rectangle((0, 0, 3, 7), WHITE)
+        self.icon = FrameBuffer(5, 3)
+        self.icon.rectangle((4, 2, 4, 2), WHITE)
+        assetpack.writePack(self.path, {'logo.png': self.logo,
+                                        'icon.png': self.icon})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        pack = assetpack.AssetPack.open(self.path)
+        self.assertEqual(pack.names(), ['icon.png', 'logo.png'])
+        self.assertEqual(pack.bitmap('logo.png'), self.logo)
+        self.assertEqual(pack.bitmap('icon.png'), self.icon)
+        self.assertIsNone(pack.get('missing.png'))
+
+    def test_other_versions_are_rejected(self):
+        with open(self.path, 'rb') as f:
+            blob = bytearray(f.read())
+        struct.pack_into('<H', blob, 4, assetpack.FORMAT_VERSION + 1)
+        with self.assertRaises(ValueError):
+            assetpack.AssetPack(bytes(blob))
+        with self.assertRaises(ValueError):
+            assetpack.AssetPack(bytes(blob[:-1]))
+
+    def test_pushes_pages_to_matching_device(self):
+        pack = assetpack.AssetPack.open(self.path)
+        device = FakeSSD1306()
+        self.assertTrue(
+            framebuffer._pushPages(device, *pack.get('logo.png')))
+        self.assertEqual(device.sent, [
+            ('command', (0x21, 0, 15, 0x22, 0, 0)),
+            ('data', [0xff] * 4 + [0] * 12),
+            ('show',)])
+        # Anything luma would have to rework is left to it
+        self.assertFalse(
+            framebuffer._pushPages(device, *pack.get('icon.png')))
+        device.rotate = 1
+        self.assertFalse(
+            framebuffer._pushPages(device, *pack.get('logo.png')))
+
+
+if __name__ == '__main__':
+    unittest.main()
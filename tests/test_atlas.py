@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.atlas`."""
+
+
+import os
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown.atlas import GlyphAtlas
+from neo_batterylevelshutdown.framebuffer import Bitmap
+
+
+def rasterise(char):
+    # A stand in for FreeType: glyphs whose shape depends on the char
+    width = ord(char) % 9 + 1
+    return Bitmap(width, 3, [ord(char) & ((1 << width) - 1)] * 3), width + 1
+
+
+class TestGlyphAtlas(unittest.TestCase):
+    """Saving and loading pre-rasterised glyphs."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fontPath = os.path.join(self.tmp.name, 'font.ttf')
+        with open(self.fontPath, 'wb') as f:
+            f.write(b'not really a font')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        atlas = GlyphAtlas.build(self.fontPath, 12, rasterise)
+        self.assertEqual(len(atlas.glyphs), 95)
+        loaded = GlyphAtlas.deserialise(atlas.serialise(), self.fontPath, 12)
+        self.assertEqual(loaded.glyphs, atlas.glyphs)
+
+    def test_save_writes_a_loadable_file(self):
+        path = os.path.join(self.tmp.name, 'atlas.bin')
+        GlyphAtlas.build(self.fontPath, 12, rasterise, 'ab').save(path)
+        with open(path, 'rb') as f:
+            loaded = GlyphAtlas.deserialise(f.read(), self.fontPath, 12)
+        self.assertEqual(sorted(loaded.glyphs), ['a', 'b'])
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_stale_atlases_are_rejected(self):
+        blob = GlyphAtlas.build(self.fontPath, 12, rasterise, 'ab').serialise()
+        self.assertIsNone(
+            GlyphAtlas.deserialise(blob, self.fontPath, 14))
+        self.assertIsNone(
+            GlyphAtlas.deserialise(blob[:10], self.fontPath, 12))
+        with open(self.fontPath, 'ab') as f:
+            f.write(b' (changed)')
+        self.assertIsNone(
+            GlyphAtlas.deserialise(blob, self.fontPath, 12))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.backends`."""
+
+
+import threading
+import unittest
+
+from neo_batterylevelshutdown import backends, config, displays, hardware
+from neo_batterylevelshutdown.framebuffer import WHITE, Bitmap, FrameBuffer
+from neo_batterylevelshutdown.simulator import Scenario, SimulatedBackend
+
+
+class RecordingBackend(backends.DisplayBackend):
+    """Keeps what would have gone to the panel"""
+
+    def __init__(self, panelWidth=128, panelHeight=64):
+        super().__init__(panelWidth, panelHeight)
+        self.rendered = 0
+        self.sent = []
+
+    def render(self, panelFrame):
+        self.rendered += 1
+        return panelFrame
+
+    def send(self, payload, box):
+        self.sent.append((payload, box))
+
+
+def logicalFrame():
+    frame = FrameBuffer(backends.LOGICAL_WIDTH, backends.LOGICAL_HEIGHT)
+    frame.rectangle((0, 0, 1, 0), WHITE)
+    return frame
+
+
+class TestDisplayBackend(unittest.TestCase):
+    """Scaling, skipping and caching of frames."""
+
+    def test_scaled_doubles_pixels(self):
+        bitmap = Bitmap(3, 1, [0b101]).scaled(2)
+        self.assertEqual(bitmap.size, (6, 2))
+        self.assertEqual(bitmap.rows, [0b110011, 0b110011])
+
+    def test_frames_are_scaled_and_centred(self):
+        backend = RecordingBackend(296, 128)
+        self.assertEqual((backend.scale, backend.offset), (2, (20, 0)))
+        backend.pushFrame(logicalFrame())
+        panelFrame, box = backend.sent[0]
+        self.assertEqual(panelFrame.size, (296, 128))
+        self.assertEqual(box, (0, 0, 295, 127))
+        self.assertEqual([panelFrame.getpixel(x, 1) for x in (19, 20, 23, 24)],
+                         [0, 1, 1, 0])
+
+    def test_unchanged_frames_are_not_sent(self):
+        backend = RecordingBackend(256, 128)
+        published = []
+        backend.listeners.append(published.append)
+        frame = logicalFrame()
+        backend.pushFrame(frame)
+        backend.pushFrame(frame.copy())
+        self.assertEqual(len(backend.sent), 1)
+        self.assertEqual(published, [frame])
+        # The changed box is in panel coordinates
+        frame.rectangle((10, 5, 11, 5), WHITE)
+        backend.pushFrame(frame)
+        self.assertEqual(backend.sent[-1][1], (20, 10, 23, 11))
+
+    def test_render_cache(self):
+        backend = RecordingBackend()
+        first, second = logicalFrame(), FrameBuffer(128, 64)
+        for frame in (first, second, first, second):
+            backend.pushFrame(frame)
+        self.assertEqual(len(backend.sent), 4)
+        self.assertEqual(backend.rendered, 2)
+        # A blanked panel is sent the frame again
+        backend.forget()
+        backend.pushFrame(second)
+        self.assertEqual(len(backend.sent), 5)
+
+    def test_unknown_backends_are_absent_displays(self):
+        with self.assertRaises(OSError):
+            backends.create('nonesuch')
+
+
+class TestSharedBackend(unittest.TestCase):
+    """Display detection and the display sharing one probe."""
+
+    def setUp(self):
+        hardware.use_backend(SimulatedBackend(Scenario()))
+        self.opened = []
+
+    def tearDown(self):
+        # pylint: disable=protected-access
+        backends._registry.pop('counting', None)
+        config.use(config.DEFAULTS)
+        hardware.use_backend(None)
+
+    def register(self, factory):
+        def opener():
+            self.opened.append(factory)
+            return factory()
+        backends.register('counting', opener)
+        config.use(config.DEFAULTS._replace(displayBackend='counting'))
+
+    def test_panel_is_set_up_once(self):
+        from neo_batterylevelshutdown import cli
+        self.register(RecordingBackend)
+        self.assertIsNot(cli.getDisplayClass(), displays.DummyDisplay)
+        backend = backends.sharedBackend()
+        self.assertIs(backends.sharedBackend(), backend)
+        self.assertEqual(len(self.opened), 1)
+        # A new backend (e.g. another simulation) probes again
+        hardware.use_backend(SimulatedBackend(Scenario()))
+        self.assertIsNot(backends.sharedBackend(), backend)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_missing_panel_is_probed_once(self):
+        from neo_batterylevelshutdown import cli
+
+        def missing():
+            raise OSError("no panel")
+        self.register(missing)
+        self.assertIs(cli.getDisplayClass(), displays.DummyDisplay)
+        with self.assertRaises(OSError):
+            backends.sharedBackend()
+        self.assertEqual(len(self.opened), 1)
+
+
+class TestRefreshScheduler(unittest.TestCase):
+    """E-paper refresh pacing and full/partial choice."""
+
+    def setUp(self):
+        hardware.use_backend(SimulatedBackend(Scenario()))
+        config.use(config.DEFAULTS._replace(
+            epaperMinRefreshSecs=0, epaperFullRefreshEvery=2,
+            epaperFullRefreshAbovePerc=50))
+        self.refreshes = []
+        self.scheduler = backends.RefreshScheduler(
+            lambda payload, full: self.refreshes.append((payload, full)),
+            100)
+
+    def tearDown(self):
+        config.use(config.DEFAULTS)
+        hardware.use_backend(None)
+
+    def test_full_refresh_first_periodically_and_when_mostly_changed(self):
+        small = (0, 0, 1, 1)
+        for payload in 'abcd':
+            self.scheduler.submit(payload, small)
+        self.scheduler.submit('e', (0, 0, 9, 5))
+        self.assertEqual(self.refreshes, [
+            ('a', True), ('b', False), ('c', False), ('d', True),
+            ('e', True)])
+
+    def test_frames_within_min_interval_are_coalesced(self):
+        config.use(config.current()._replace(epaperMinRefreshSecs=3600))
+        timers = []
+        self.scheduler._startTimer = \
+            lambda delay, func: timers.append(func) or \
+            threading.Timer(delay, func)
+        self.scheduler.submit('a', (0, 0, 0, 0))
+        self.scheduler.submit('b', (0, 0, 0, 0))
+        self.scheduler.submit('c', (5, 5, 5, 5))
+        self.assertEqual(self.refreshes, [('a', True)])
+        self.assertEqual(len(timers), 1)
+        timers[0]()
+        self.assertEqual(self.refreshes[-1], ('c', False))
+        self.assertEqual(self.scheduler._pendingBox, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
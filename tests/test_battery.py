@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.battery`."""
+
+
+import unittest
+
+from neo_batterylevelshutdown import hardware, hats
+from neo_batterylevelshutdown.battery import BatteryEstimator
+from neo_batterylevelshutdown.simulator import (
+    BatteryModel, Scenario, SimulatedDisplay, simulate)
+
+
+class TestBatteryEstimator(unittest.TestCase):
+    """Smoothing and time to empty prediction."""
+
+    def test_no_prediction_without_history(self):
+        estimator = BatteryEstimator()
+        estimator.addSample(0, 3700, 300, 50, False)
+        self.assertEqual(estimator.smoothedGauge, 50)
+        self.assertIsNone(estimator.minutesToEmpty())
+
+    def test_predicts_linear_discharge(self):
+        estimator = BatteryEstimator()
+        # 1% per minute, with alternating +/-2% jitter
+        for minute in range(16):
+            jitter = 2 if minute % 2 else -2
+            estimator.addSample(minute * 60, 3700, 300,
+                                50 - minute + jitter, False)
+        self.assertAlmostEqual(estimator.minutesToEmpty(), 35, delta=3)
+
+    def test_no_prediction_while_charging(self):
+        estimator = BatteryEstimator()
+        for minute in range(10):
+            estimator.addSample(minute * 60, 3700, -500, 50 - minute, True)
+        self.assertIsNone(estimator.minutesToEmpty())
+
+    def test_ignores_missing_battery(self):
+        estimator = BatteryEstimator()
+        estimator.addSample(0, 0, 0, -1, False)
+        self.assertIsNone(estimator.smoothedGauge)
+
+
+class TestLowBatteryWarning(unittest.TestCase):
+    """Warning behaviour of the HAT when replayed through the simulator."""
+
+    def tearDown(self):
+        hardware.use_backend(None)
+
+    def test_warning_does_not_flap_on_jitter(self):
+        # Hovering just above the warning threshold with +/-2% jitter
+        scenario = Scenario(
+            durationSecs=3600,
+            battery=BatteryModel(dischargeCurve=((0, 5), (3600, 5)),
+                                 gaugeJitterPerc=2))
+
+        class RecordingDisplay(SimulatedDisplay):
+            # Only record changes in whether the warning is showing
+            def _record(self, name):
+                pass
+
+            def showLowBatteryWarning(self):
+                if not self.calls or self.calls[-1] != 'show':
+                    self.calls.append('show')
+
+            def hideLowBatteryWarning(self):
+                if self.calls and self.calls[-1] == 'show':
+                    self.calls.append('hide')
+
+        result = simulate(hats.q4y2018HAT, scenario, RecordingDisplay)
+        self.assertIsNone(result.shutdownTime)
+        self.assertLessEqual(result.displayCalls, 2)
+
+    def test_warning_is_not_shown_once_shutting_down(self):
+        scenario = Scenario(
+            durationSecs=3600,
+            battery=BatteryModel(dischargeCurve=((0, 5), (1800, 0))))
+        events = []
+
+        class RecordingDisplay(SimulatedDisplay):
+            def showLowBatteryWarning(self):
+                events.append('show')
+
+        class RecordingHAT(hats.q4y2018HAT):
+            # Carry on running, as when poweroff takes a while
+            def shutdownDevice(self, graceSecs=None, reason='requested'):
+                events.append('shutdown')
+
+        simulate(RecordingHAT, scenario, RecordingDisplay)
+        self.assertIn('shutdown', events)
+        self.assertNotIn('show', events[events.index('shutdown'):])
+
+
+if __name__ == '__main__':
+    unittest.main()
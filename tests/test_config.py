@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.config`."""
+
+
+import json
+import os
+import signal
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown import config
+
+
+class TestConfig(unittest.TestCase):
+    """Validation and reloading of the config file."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'config.json')
+
+    def tearDown(self):
+        config.use(config.DEFAULTS)
+        self.tmp.cleanup()
+
+    def write(self, values):
+        with open(self.path, 'w') as f:
+            json.dump(values, f)
+
+    def test_missing_file_is_defaults(self):
+        self.assertEqual(config.load(self.path), config.DEFAULTS)
+
+    def test_overrides(self):
+        self.write({'displayTimeoutSecs': 60, 'contentPath': '/srv/content',
+                    'displayBackend': 'epaper', 'copyExclude': ['*.tmp'],
+                    'copyDedup': True, 'copyIdleIO': False, 'copyPartial': 1})
+        loaded = config.load(self.path)
+        self.assertEqual(loaded.copyExclude, ('*.tmp',))
+        self.assertEqual(loaded.displayBackend, 'epaper')
+        self.assertEqual(loaded.displayTimeoutSecs, 60)
+        self.assertEqual(loaded.contentPath, '/srv/content')
+        self.assertTrue(loaded.copyDedup)
+        self.assertFalse(loaded.copyIdleIO)
+        self.assertTrue(loaded.copyPartial)
+        self.assertEqual(loaded.ledCycleTimeSecs,
+                         config.DEFAULTS.ledCycleTimeSecs)
+
+    def test_invalid(self):
+        for values in ({'displayTimeoutSec': 60},
+                       {'displayTimeoutSecs': '60'},
+                       {'displayTimeoutSecs': -1},
+                       {'contentPath': 'media/usb0'},
+                       {'batteryShutdownThresholdPerc': 5},
+                       {'ledSingleFlashThresholdPerc': 80},
+                       {'batteryCheckMinSecs': 300},
+                       {'displayBackend': ''},
+                       {'epaperFullRefreshEvery': 0},
+                       {'copyInclude': '*.mp4'},
+                       {'copyMaxBytesPerSec': 10 ** 6,
+                        'copyMinBytesPerSec': 10 ** 9},
+                       {'copyMaxBytesPerSec': 10 ** 6,
+                        'copyMinBytesPerSec': 0},
+                       {'copyPriority': ['*.mp4', 1]},
+                       {'copyDedup': 2},
+                       {'copyDedup': 'yes'},
+                       {'displayTimeoutSecs': True},
+                       {'dedupStorePath': '/media/usb0/.dedup'},
+                       {'contentPath': '/srv', 'dedupStorePath': '/srv'},
+                       [1, 2]):
+            with self.subTest(values=values):
+                self.assertRaises(config.ConfigError, config.validate, values)
+
+    def test_dedup_store_is_beside_the_content(self):
+        self.assertEqual(config.dedupStorePath(config.DEFAULTS),
+                         '/media/.usb0-dedup')
+        loaded = config.validate({'contentPath': '/srv/content/'})
+        self.assertEqual(config.dedupStorePath(loaded),
+                         '/srv/.content-dedup')
+        loaded = config.validate({'dedupStorePath': '/srv/dedup'})
+        self.assertEqual(config.dedupStorePath(loaded), '/srv/dedup')
+
+    def test_invalid_file_at_startup_runs_on_defaults(self):
+        previousHandler = signal.getsignal(signal.SIGHUP)
+        self.addCleanup(signal.signal, signal.SIGHUP, previousHandler)
+        config.use(config.DEFAULTS._replace(displayTimeoutSecs=60))
+        self.write({'displayTimeoutSecs': 'sixty'})
+        with self.assertLogs(level='ERROR'):
+            config.ConfigWatcher(self.path).start()
+        self.assertEqual(config.current(), config.DEFAULTS)
+
+    def test_reload_keeps_previous_config_on_error(self):
+        watcher = config.ConfigWatcher(self.path)
+        self.write({'displayTimeoutSecs': 60})
+        self.assertTrue(watcher.reload())
+        self.assertEqual(config.current().displayTimeoutSecs, 60)
+        with open(self.path, 'w') as f:
+            f.write('{"displayTimeoutSecs": ')
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(watcher.reload())
+        self.assertEqual(config.current().displayTimeoutSecs, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.controller`."""
+
+
+import asyncio
+import threading
+import unittest
+
+from neo_batterylevelshutdown import config, hardware, navigation
+from neo_batterylevelshutdown.controller import AsyncController
+from neo_batterylevelshutdown.hardware import clock
+from neo_batterylevelshutdown.simulator import Scenario, SimulatedBackend
+
+
+class FakeHAT:
+    """Records which thread did what, and whether it overlapped"""
+
+    def __init__(self):
+        self.navigator = navigation.Navigator(self)
+        self.calls = []
+        self.running = 0
+        self.overlapped = False
+        self.nextBatteryCheckTime = float('inf')
+        self.release = threading.Event()
+
+    def _work(self, name, wait=False):
+        self.running += 1
+        if self.running > 1:
+            self.overlapped = True
+        self.calls.append((name, threading.current_thread().name))
+        if wait:
+            self.release.wait()
+        self.running -= 1
+
+    def slowAction(self):
+        self._work('slowAction', wait=True)
+
+    def refreshDisplay(self):
+        self._work('refreshDisplay')
+
+    def powerOffDisplay(self, channel):
+        self._work('powerOffDisplay')
+
+    def handleButtonPress(self, channel):
+        self._work('handleButtonPress')
+
+    def checkBattery(self, updateDisplay=True):
+        self.calls.append(('checkBattery', updateDisplay))
+        self.nextBatteryCheckTime = clock.time() + 60
+
+
+class TestAsyncController(unittest.TestCase):
+    """Sequencing of HAT and display work."""
+
+    def setUp(self):
+        hardware.use_backend(SimulatedBackend(Scenario()))
+        self.hat = FakeHAT()
+        self.controller = AsyncController(self.hat)
+        self.loop = self.controller.loop
+
+    def tearDown(self):
+        self.hat.release.set()
+        self.loop.close()
+        self.controller.jobs.shutdown()
+        hardware.use_backend(None)
+
+    def run_until(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_jobs_and_display_work_share_one_slot(self):
+        async def scenario():
+            self.controller.activity = asyncio.Event()
+            job = asyncio.ensure_future(
+                self.controller._runJob(self.hat.slowAction))
+            await asyncio.sleep(0.05)
+            refresh = asyncio.ensure_future(
+                self.controller._exclusive(self.hat.refreshDisplay))
+            await asyncio.sleep(0.05)
+            # Queued behind the action rather than alongside it
+            self.assertEqual(len(self.hat.calls), 1)
+            self.hat.release.set()
+            await job
+            return await refresh
+        self.assertTrue(self.run_until(scenario()))
+        self.assertFalse(self.hat.overlapped)
+        self.assertEqual([name for name, _ in self.hat.calls],
+                         ['slowAction', 'refreshDisplay'])
+        self.assertEqual(len(set(thread for _, thread in self.hat.calls)), 1)
+
+    def test_display_work_skipped_while_a_command_runs(self):
+        # e.g. a command from the control socket, in its own thread
+        started = threading.Event()
+
+        def command():
+            started.set()
+            self.hat.release.wait()
+        thread = threading.Thread(target=self.hat.navigator.exclusive,
+                                  args=(command,))
+        thread.start()
+        started.wait()
+        self.assertFalse(self.run_until(
+            self.controller._exclusive(self.hat.refreshDisplay)))
+        self.hat.release.set()
+        thread.join()
+        self.assertEqual(self.hat.calls, [])
+
+    def test_display_power_off_skipped_while_a_command_runs(self):
+        self.hat.edgeHandlers = {5: (None, self.hat.powerOffDisplay, None)}
+        self.controller.edges = asyncio.Queue()
+        self.controller.activity = asyncio.Event()
+        started = threading.Event()
+
+        def command():
+            started.set()
+            self.hat.release.wait()
+
+        async def press():
+            task = asyncio.ensure_future(self.controller._dispatchEdges())
+            self.controller.edges.put_nowait(5)
+            await self.controller.activity.wait()
+            self.controller.activity.clear()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        thread = threading.Thread(target=self.hat.navigator.exclusive,
+                                  args=(command,))
+        thread.start()
+        started.wait()
+        self.run_until(press())
+        self.assertEqual(self.hat.calls, [])
+        self.hat.release.set()
+        thread.join()
+        self.run_until(press())
+        self.assertEqual([name for name, _ in self.hat.calls],
+                         ['powerOffDisplay'])
+
+    def test_battery_checked_during_a_command_without_the_display(self):
+        self.hat.nextBatteryCheckTime = 0
+        self.controller.batteryChecked = asyncio.Event()
+        self.controller.batteryCheckRequested = asyncio.Event()
+        self.controller.activity = asyncio.Event()
+        self.controller.busy = True
+
+        async def oneCheck():
+            task = asyncio.ensure_future(self.controller._batteryCheck())
+            await self.controller.batteryChecked.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.run_until(oneCheck())
+        self.assertEqual(self.hat.calls, [('checkBattery', False)])
+        # Again soon, to show any warning once the command is done
+        self.assertEqual(self.hat.nextBatteryCheckTime,
+                         config.current().batteryCheckMinSecs)
+
+
+if __name__ == '__main__':
+    unittest.main()
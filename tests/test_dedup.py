@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.dedup`."""
+
+
+import os
+import tempfile
+import threading
+import unittest
+
+from neo_batterylevelshutdown.dedup import DedupStore
+
+
+class TestDedupStore(unittest.TestCase):
+    """Storing identical content once."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'store')
+        self.source = os.path.join(self.tmp.name, 'source')
+        os.mkdir(self.source)
+        for name, content in (('a.mp4', b'video' * 100),
+                              ('b.mp4', b'video' * 100),
+                              ('c.mp4', b'other' * 100)):
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, *names):
+        return os.path.join(self.tmp.name, *names)
+
+    def files(self):
+        return [(self.path('source', name), 500)
+                for name in ('a.mp4', 'b.mp4', 'c.mp4')]
+
+    def test_identical_files_are_stored_once(self):
+        store = DedupStore(self.root)
+        self.assertEqual(store.newBytes(self.files()), 1000)
+        written = [store.copy(source, self.path(os.path.basename(source)))
+                   for source, _ in self.files()]
+        self.assertEqual(written, [500, 0, 500])
+        self.assertEqual(store.savedBytes, 500)
+        with open(self.path('b.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), b'video' * 100)
+        # Nothing new the second time
+        self.assertEqual(store.newBytes(self.files()), 0)
+
+    def test_index_survives_reopening_and_torn_writes(self):
+        store = DedupStore(self.root)
+        store.copy(self.path('source', 'a.mp4'), self.path('a.mp4'))
+        with open(store.indexPath, 'ab') as f:
+            f.write(b'torn')
+        reopened = DedupStore(self.root)
+        self.assertEqual(reopened.newBytes(self.files()[1:]), 500)
+        os.unlink(store.indexPath)
+        self.assertEqual(DedupStore(self.root).newBytes(self.files()), 500)
+
+    def test_changed_objects_are_not_linked_to(self):
+        store = DedupStore(self.root)
+        if store.reflinks:
+            self.skipTest("reflinked files don't share the object")
+        store.copy(self.path('source', 'a.mp4'), self.path('a.mp4'))
+        # Edited in place, so the hard linked object changes too
+        with open(self.path('a.mp4'), 'r+b') as f:
+            f.write(b'edits')
+        with self.assertLogs(level='WARNING'):
+            written = store.copy(self.path('source', 'b.mp4'),
+                                 self.path('b.mp4'))
+        self.assertEqual(written, 500)
+        with open(self.path('b.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), b'video' * 100)
+
+    def test_prune_removes_unlinked_objects(self):
+        store = DedupStore(self.root)
+        if store.reflinks:
+            self.skipTest("reflinked objects are never pruned")
+        for source, _ in self.files():
+            store.copy(source, self.path(os.path.basename(source)))
+        self.assertEqual(store.prune(), 0)
+        os.unlink(self.path('a.mp4'))
+        # b.mp4 still links to the video
+        self.assertEqual(store.prune(), 0)
+        os.unlink(self.path('b.mp4'))
+        self.assertGreater(store.prune(), 0)
+        self.assertEqual(store.newBytes(self.files()), 500)
+        self.assertEqual(DedupStore(self.root).newBytes(self.files()), 500)
+
+    def test_aborted_copy_leaves_nothing(self):
+        store = DedupStore(self.root)
+        abort = threading.Event()
+        abort.set()
+        dest = self.path('a.mp4')
+        self.assertEqual(store.copy(self.files()[0][0], dest, abort=abort), 0)
+        self.assertFalse(os.path.exists(dest))
+        self.assertEqual(store.newBytes(self.files()), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.exporter`."""
+
+
+import unittest
+from urllib.request import urlopen
+
+from neo_batterylevelshutdown import telemetry
+from neo_batterylevelshutdown.exporter import MetricsExporter, render
+from neo_batterylevelshutdown.sensors import SensorSnapshot
+
+
+class FakeHAT:
+    snapshot = SensorSnapshot(
+        time=1000.0, batteryGauge=87, batteryVoltage=4044.0,
+        batteryCurrent=312.5, charging=False, axpTemperature=41.2,
+        cpuTemperature=52.0, connectedUsers=4, bytesSent=None,
+        bytesRecv=None, throughput=None)
+
+
+class TestExporter(unittest.TestCase):
+    """OpenMetrics rendering and serving."""
+
+    def test_render_snapshot_and_registry(self):
+        telemetry.histogram('test_redraw_seconds', 'Redraws').observe(0.02)
+        text = render(FakeHAT.snapshot)
+        self.assertIn('connectbox_battery_gauge_percent 87\n', text)
+        self.assertIn('connectbox_charger_connected 0\n', text)
+        self.assertNotIn('throughput', text)
+        self.assertIn('test_redraw_seconds_bucket{le="0.025"} 1\n', text)
+        self.assertIn('test_redraw_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+    def test_render_without_snapshot(self):
+        self.assertTrue(render(None).endswith('# EOF\n'))
+
+    def test_serves_metrics(self):
+        exporter = MetricsExporter(FakeHAT(), 0)
+        exporter.start()
+        try:
+            # Not on the hotspot's Wi-Fi unless asked
+            self.assertEqual(exporter.server.server_address[0], '127.0.0.1')
+            port = exporter.server.server_address[1]
+            with urlopen('http://127.0.0.1:%d/metrics' % port) as response:
+                self.assertIn('openmetrics-text',
+                              response.headers['Content-Type'])
+                self.assertIn(b'connectbox_wifi_stations 4', response.read())
+        finally:
+            exporter.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.framebuffer`."""
+
+
+import unittest
+
+from neo_batterylevelshutdown.framebuffer import (
+    BLACK, WHITE, Bitmap, FrameBuffer)
+
+
+def pixels(bitmap):
+    return [''.join('#' if bitmap.getpixel(x, y) else '.'
+                    for x in range(bitmap.width))
+            for y in range(bitmap.height)]
+
+
+class TestFrameBuffer(unittest.TestCase):
+    """Bitwise drawing on 1-bit frames."""
+
+    def setUp(self):
+        self.frame = FrameBuffer(10, 4)
+
+    def test_bytes_round_trip_matches_pil_packing(self):
+        # Rows are padded to whole bytes, leftmost pixel in the top bit
+        self.frame.rectangle((0, 0, 0, 3), WHITE)
+        self.frame.rectangle((9, 1, 9, 1), WHITE)
+        data = self.frame.toBytes()
+        self.assertEqual(data[:4], b'\x80\x00\x80\x40')
+        self.assertEqual(Bitmap.fromBytes(10, 4, data), self.frame)
+
+    def test_pages_match_ssd1306_layout(self):
+        # Column bytes, top row of each 8 row page in the low bit
+        frame = FrameBuffer(3, 10)
+        frame.rectangle((0, 0, 0, 0), WHITE)
+        frame.rectangle((2, 7, 2, 8), WHITE)
+        data = frame.toPages()
+        self.assertEqual(data, b'\x01\x00\x80\x00\x00\x01')
+        self.assertEqual(Bitmap.fromPages(3, 10, data), frame)
+
+    def test_rectangle_is_inclusive_and_clipped(self):
+        self.frame.rectangle((8, 2, 20, 9), WHITE)
+        self.assertEqual(pixels(self.frame), [
+            '..........', '..........', '........##', '........##'])
+
+    def test_blit_sets_mask_pixels_only(self):
+        self.frame.fill(WHITE)
+        mask = Bitmap(3, 2, [0b101, 0b010])
+        self.frame.blit(mask, -1, 3, BLACK)
+        self.assertEqual(pixels(self.frame), [
+            '##########', '##########', '##########', '#.########'])
+
+    def test_paste_replaces_region(self):
+        self.frame.fill(WHITE)
+        self.frame.paste(Bitmap(2, 2, [0b10, 0b01]), 8, 0)
+        self.assertEqual(pixels(self.frame)[:2], [
+            '#########.', '########.#'])
+
+    def test_diagonal_line(self):
+        self.frame.line((0, 0, 3, 3), WHITE)
+        self.assertEqual(pixels(self.frame), [
+            '#.........', '.#........', '..#.......', '...#......'])
+
+
+if __name__ == '__main__':
+    unittest.main()
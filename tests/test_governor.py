@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.governor`."""
+
+
+import os
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown import hardware
+from neo_batterylevelshutdown.governor import PowerGovernor
+from neo_batterylevelshutdown.simulator import Scenario, SimulatedBackend
+
+
+class TestPowerGovernor(unittest.TestCase):
+    """Profiles chosen from the battery state and applied through sysfs."""
+
+    def setUp(self):
+        self.backend = SimulatedBackend(Scenario())
+        hardware.use_backend(self.backend)
+        self.tmp = tempfile.TemporaryDirectory()
+        for name, value in (('scaling_available_governors',
+                             'conservative ondemand powersave performance'),
+                            ('scaling_governor', 'ondemand'),
+                            ('cpuinfo_min_freq', '480000'),
+                            ('cpuinfo_max_freq', '1200000'),
+                            ('scaling_max_freq', '1200000')):
+            self.writeCpufreq(name, value)
+        self.commands = []
+        self.governor = PowerGovernor(cpufreqPath=self.tmp.name)
+        self.governor.runCommand = lambda args: self.commands.append(args) or 0
+
+    def tearDown(self):
+        hardware.use_backend(None)
+        self.tmp.cleanup()
+
+    def writeCpufreq(self, name, value):
+        with open(os.path.join(self.tmp.name, name), 'w') as f:
+            f.write(value)
+
+    def readCpufreq(self, name):
+        with open(os.path.join(self.tmp.name, name)) as f:
+            return f.read()
+
+    def test_profiles_follow_battery(self):
+        self.governor.update(80, False, 600, 3)
+        self.assertEqual(self.governor.profile.name, 'balanced')
+        self.assertEqual(self.readCpufreq('scaling_governor'), 'conservative')
+        self.assertEqual(self.readCpufreq('scaling_max_freq'), '900000')
+        self.assertEqual(self.commands[-1][-2:], ['fixed', '1500'])
+
+        self.governor.update(20, False, 300, 3)
+        self.assertEqual(self.governor.profile.name, 'saver')
+        self.assertEqual(self.readCpufreq('scaling_governor'), 'powersave')
+
+        self.governor.update(20, True, None, 3)
+        self.assertEqual(self.governor.profile.name, 'performance')
+        self.assertEqual(self.readCpufreq('scaling_max_freq'), '1200000')
+        self.assertEqual(self.commands[-1][-1], 'auto')
+
+    def test_hysteresis(self):
+        self.governor.update(29, False, None, 1)
+        self.assertEqual(self.governor.profile.name, 'saver')
+        # Just above the threshold isn't enough, even after the dwell time
+        self.backend.clock.advance(3600)
+        self.governor.update(32, False, None, 1)
+        self.assertEqual(self.governor.profile.name, 'saver')
+        self.governor.update(40, False, None, 1)
+        self.assertEqual(self.governor.profile.name, 'balanced')
+
+    def test_dry_run_changes_nothing(self):
+        self.governor.dryRun = True
+        with self.assertLogs(level='INFO'):
+            self.governor.update(10, False, None, 0)
+        self.assertEqual(self.readCpufreq('scaling_governor'), 'ondemand')
+        self.assertEqual(self.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
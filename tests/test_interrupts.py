@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.interrupts`."""
+
+
+import unittest
+
+from neo_batterylevelshutdown import interrupts
+from neo_batterylevelshutdown.simulator import SimulatedSMBus
+
+
+class TestIRQDispatcher(unittest.TestCase):
+    """Read, clear, decode and route AXP209 interrupts."""
+
+    def setUp(self):
+        self.bus = SimulatedSMBus()
+        self.bus.writeOneToClear.update(range(0x48, 0x4D))
+        self.irq = interrupts.IRQDispatcher(self.bus)
+        self.handled = []
+        for cause in (interrupts.LEVEL2, interrupts.ACIN_PLUGGED,
+                      interrupts.PEK_SHORT):
+            self.irq.addHandler(cause, self.handled.append)
+
+    def test_enable_masks_cover_handled_causes_only(self):
+        self.irq.enable()
+        self.assertEqual(list(self.bus.registers[0x40:0x45]),
+                         [0x40, 0x00, 0x02, 0x01, 0x00])
+
+    def test_decode(self):
+        self.assertEqual(
+            interrupts.decode([0x60, 0x00, 0x81, 0x03, 0x00]),
+            [interrupts.LEVEL2, interrupts.OVER_TEMPERATURE,
+             interrupts.LEVEL1, interrupts.ACIN_PLUGGED,
+             interrupts.ACIN_REMOVED, interrupts.PEK_LONG])
+
+    def test_dispatch_routes_and_clears_in_one_read(self):
+        self.bus.registers[0x48:0x4D] = bytes([0x60, 0x00, 0x02, 0x01, 0x00])
+        self.assertEqual(self.irq.dispatch(16),
+                         [interrupts.LEVEL2, interrupts.ACIN_PLUGGED,
+                          interrupts.PEK_SHORT])
+        self.assertEqual(self.handled, [interrupts.LEVEL2,
+                                        interrupts.ACIN_PLUGGED,
+                                        interrupts.PEK_SHORT])
+        self.assertEqual(bytes(self.bus.registers[0x48:0x4D]), bytes(5))
+        # One block read, then one write per register with bits set
+        self.assertEqual(self.bus.transactions, 4)
+
+    def test_nothing_pending_is_a_single_read(self):
+        self.assertEqual(self.irq.dispatch(), [])
+        self.assertEqual(self.bus.transactions, 1)
+
+    def test_unknown_cause(self):
+        self.assertRaises(ValueError, self.irq.addHandler, 'bogus', print)
+
+
+if __name__ == '__main__':
+    unittest.main()
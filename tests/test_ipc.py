@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.ipc`."""
+
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from neo_batterylevelshutdown.ipc import ControlServer
+from neo_batterylevelshutdown.sensors import SensorSnapshot
+
+
+class FakeNavigator:
+    state = 'status'
+
+
+class FakeHAT:
+    """Just enough of Axp209HAT for the control server"""
+
+    def __init__(self):
+        self.snapshot = SensorSnapshot(*[None] * len(SensorSnapshot._fields))
+        self.navigator = FakeNavigator()
+        self.commandLock = threading.Lock()
+        self.progressListener = None
+        self.shownPages = []
+
+    def runCommand(self, command, wait=True):
+        with self.commandLock:
+            for stage in ('started', 'copying'):
+                self.progressListener({'command': command, 'stage': stage})
+            self.navigator.state = 'success'
+            self.progressListener({'command': command, 'stage': 'finished',
+                                   'result': 'success'})
+        return True
+
+    def showStatusPage(self, index):
+        if index > 2:
+            raise IndexError(index)
+        self.shownPages.append(index)
+        return True
+
+
+class TestControlServer(unittest.TestCase):
+    """JSON requests over the control socket."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.hat = FakeHAT()
+        self.server = ControlServer(
+            self.hat, os.path.join(self.tmp.name, 'control.sock'))
+        self.server.start()
+        self.client = socket.socket(socket.AF_UNIX)
+        self.client.connect(self.server.path)
+        self.replies = self.client.makefile('r')
+
+    def tearDown(self):
+        self.replies.close()
+        self.client.close()
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def request(self, message):
+        self.client.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        return json.loads(self.replies.readline())
+
+    def test_snapshot(self):
+        reply = self.request({'cmd': 'snapshot'})
+        self.assertTrue(reply['ok'])
+        self.assertIn('batteryGauge', reply['snapshot'])
+        self.assertEqual(reply['pageStack'], 'status')
+        self.assertFalse(reply['busy'])
+        self.assertIsNone(reply['copyRateLimit'])
+
+    def test_run_and_follow_job(self):
+        reply = self.request({'cmd': 'run', 'command': 'copy_from_usb'})
+        self.assertTrue(reply['ok'])
+        event = self.request(
+            {'cmd': 'job', 'job': reply['job'], 'follow': True})
+        stages = [event['stage']]
+        while event['stage'] != 'finished':
+            event = json.loads(self.replies.readline())
+            stages.append(event['stage'])
+        self.assertEqual(stages, ['started', 'copying', 'finished'])
+        self.assertEqual(event['result'], 'success')
+
+    def test_force_page(self):
+        self.assertTrue(self.request({'cmd': 'page', 'index': 1})['ok'])
+        self.assertEqual(self.hat.shownPages, [1])
+        self.assertEqual(self.request({'cmd': 'page', 'index': 5}),
+                         {'ok': False, 'error': 'no status page 5'})
+
+    def test_negative_page_is_out_of_range(self):
+        self.assertEqual(self.request({'cmd': 'page', 'index': -1}),
+                         {'ok': False, 'error': 'no status page -1'})
+        self.assertEqual(self.hat.shownPages, [])
+
+    def test_boolean_page_is_out_of_range(self):
+        self.assertEqual(self.request({'cmd': 'page', 'index': True}),
+                         {'ok': False, 'error': 'no status page true'})
+        self.assertEqual(self.hat.shownPages, [])
+
+    def test_bad_requests(self):
+        self.assertFalse(self.request({'cmd': 'run', 'command': 'rm'})['ok'])
+        self.assertFalse(self.request({'cmd': 'reboot'})['ok'])
+        self.client.sendall(b'not json\n')
+        self.assertFalse(json.loads(self.replies.readline())['ok'])
+
+    def test_start_fails_rather_than_hanging(self):
+        hat = FakeHAT()
+        server = ControlServer(
+            hat, os.path.join(self.tmp.name, 'missing', 'control.sock'))
+        self.assertRaises(OSError, server.start)
+        self.assertIsNone(hat.progressListener)
+
+
+if __name__ == '__main__':
+    unittest.main()
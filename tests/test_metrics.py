@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.metrics`."""
+
+
+import math
+import os
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown.metrics import MetricsStore
+
+
+class TestMetricsStore(unittest.TestCase):
+    """Ring buffer rollups and persistence."""
+
+    def test_rollups_average_samples(self):
+        store = MetricsStore()
+        for minute in range(120):
+            store.record(minute * 60, battery=100 - minute / 2)
+        # Last two minutes
+        self.assertEqual(store.series('battery', 'minute', 2), [41, 40.5])
+        hours = store.series('battery', 'hour', 2)
+        self.assertAlmostEqual(hours[0], 100 - 59 / 4)
+        self.assertAlmostEqual(hours[1], 70 - 59 / 4)
+        self.assertEqual(store.latest('battery', 'day'), 100 - 119 / 4)
+
+    def test_gaps_are_nan(self):
+        store = MetricsStore()
+        store.record(0, clients=3)
+        store.record(180, clients=5)
+        series = store.series('clients', 'minute', 4)
+        self.assertEqual(series[0], 3)
+        self.assertTrue(math.isnan(series[1]) and math.isnan(series[2]))
+        self.assertEqual(series[3], 5)
+        self.assertIsNone(store.latest('battery'))
+
+    def test_wraps_around(self):
+        store = MetricsStore()
+        for minute in range(300):
+            store.record(minute * 60, cpu_temp=minute)
+        series = store.series('cpu_temp', 'minute')
+        self.assertEqual(len(series), 120)
+        self.assertEqual(series[0], 180)
+        self.assertEqual(series[-1], 299)
+
+    def test_persists_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.bin')
+            store = MetricsStore(path)
+            store.record(3600, battery=80, current=250)
+            store.close()
+            self.assertEqual(os.path.getsize(path), store._blobSize())
+            store = MetricsStore(path)
+            self.assertEqual(store.latest('battery'), 80)
+            self.assertEqual(store.latest('current', 'hour'), 250)
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
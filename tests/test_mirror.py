@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.mirror`."""
+
+
+import json
+import struct
+import unittest
+from urllib.request import urlopen
+import zlib
+
+from neo_batterylevelshutdown.framebuffer import WHITE, FrameBuffer
+from neo_batterylevelshutdown.mirror import (
+    FrameMirror, MirrorServer, encodePNG)
+
+
+class TestFrameMirror(unittest.TestCase):
+    """Frame diffs and the HTTP endpoints."""
+
+    def setUp(self):
+        self.mirror = FrameMirror()
+        self.frame = FrameBuffer(16, 3)
+        self.frame.rectangle((0, 0, 0, 2), WHITE)
+        self.mirror.publish(self.frame)
+
+    def test_diffs_only_changed_rows(self):
+        self.frame.rectangle((15, 1, 15, 1), WHITE)
+        self.mirror.publish(self.frame)
+        self.assertEqual(self.mirror.diff(1), {
+            'seq': 2, 'width': 16, 'height': 3, 'full': False,
+            'rows': [[1, '8001']]})
+        # Too old (or unknown) to diff against
+        self.assertTrue(self.mirror.diff(0)['full'])
+        self.assertEqual(len(self.mirror.diff(0)['rows']), 3)
+
+    def test_png(self):
+        png = encodePNG(self.frame)
+        self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(struct.unpack('>II', png[16:24]), (16, 3))
+        idatLength, = struct.unpack('>I', png[33:37])
+        self.assertEqual(zlib.decompress(png[41:41 + idatLength]),
+                         b'\0\x80\0' * 3)
+
+    def test_http(self):
+        server = MirrorServer(self.mirror, 0)
+        server.start()
+        self.addCleanup(server.stop)
+        # Only this machine, by default
+        self.assertEqual(server.server.server_address[0], '127.0.0.1')
+        base = 'http://127.0.0.1:%d' % server.server.server_address[1]
+        with urlopen(base + '/frame.png?scale=2') as response:
+            self.assertEqual(response.headers['Content-Type'], 'image/png')
+            self.assertEqual(struct.unpack('>II', response.read()[16:24]),
+                             (32, 6))
+        # Up to date, so the poll times out with nothing changed
+        with urlopen(base + '/frames?since=1&timeout=0') as response:
+            self.assertEqual(json.loads(response.read().decode())['rows'],
+                             [])
+
+
+if __name__ == '__main__':
+    unittest.main()
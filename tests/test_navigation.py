@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.navigation`."""
+
+
+import threading
+import unittest
+
+from neo_batterylevelshutdown import navigation
+
+
+class FakeTarget:
+    """Records navigation actions; the admin pages are copy, erase, exit"""
+
+    def __init__(self):
+        self.calls = []
+        self.adminPage = 0
+        self.outcome = navigation.SUCCEEDED
+
+    def __getattr__(self, name):
+        def action(*args):
+            self.calls.append(name)
+        return action
+
+    def moveForward(self):
+        self.calls.append('moveForward')
+        self.adminPage += 1
+
+    def chooseAdminPage(self):
+        self.calls.append('chooseAdminPage')
+        return navigation.EXIT_CHOSEN if self.adminPage == 2 \
+            else navigation.COMMAND_CHOSEN
+
+    def runChosenCommand(self):
+        self.calls.append('runChosenCommand')
+        return self.outcome
+
+
+class TestNavigator(unittest.TestCase):
+    """Table driven page stack transitions."""
+
+    def setUp(self):
+        self.target = FakeTarget()
+        self.navigator = navigation.Navigator(self.target)
+
+    def press(self, *events):
+        for event in events:
+            self.navigator.handle(event)
+
+    def test_choose_and_run_command(self):
+        self.press(navigation.LONG_PRESS, navigation.RIGHT)
+        self.assertEqual(self.navigator.state, navigation.CONFIRM)
+        self.press(navigation.RIGHT)
+        self.assertEqual(self.navigator.state, navigation.SUCCESS)
+        self.press(navigation.LEFT)
+        self.assertEqual(self.navigator.state, navigation.ADMIN)
+        self.assertEqual(self.target.calls, [
+            'showAdminPages', 'chooseAdminPage', 'showConfirmPage',
+            'runChosenCommand', 'chooseCancel'])
+
+    def test_exit_page_returns_to_status(self):
+        self.press(navigation.LONG_PRESS, navigation.LEFT, navigation.LEFT)
+        self.target.adminPage = 2
+        self.press(navigation.RIGHT)
+        self.assertEqual(self.navigator.state, navigation.STATUS)
+        self.assertEqual(self.target.calls[-1], 'showStatusPages')
+
+    def test_remove_usb_until_removed(self):
+        self.target.outcome = navigation.USB_PRESENT
+        self.press(navigation.LONG_PRESS, navigation.RIGHT, navigation.RIGHT)
+        self.assertEqual(self.navigator.state, navigation.REMOVE_USB)
+        self.press(navigation.LEFT)
+        self.assertEqual(self.navigator.state, navigation.REMOVE_USB)
+        self.press(navigation.USB_REMOVED)
+        self.assertEqual(self.navigator.state, navigation.SUCCESS)
+
+    def test_timeout_returns_to_status_from_anywhere(self):
+        self.press(navigation.LONG_PRESS, navigation.RIGHT,
+                   navigation.TIMEOUT)
+        self.assertEqual(self.navigator.state, navigation.STATUS)
+        self.assertEqual(self.target.calls[-1], 'resetPages')
+
+    def test_unknown_event_does_nothing(self):
+        self.assertFalse(self.navigator.handle(navigation.USB_REMOVED))
+        self.assertEqual(self.navigator.state, navigation.STATUS)
+        self.assertEqual(self.target.calls, [])
+
+    def test_presses_dropped_while_busy(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slowCommand(command):
+            started.set()
+            release.wait()
+            return navigation.FAILED
+        self.target.runCommandNow = slowCommand
+        thread = threading.Thread(target=self.navigator.handle,
+                                  args=(navigation.RUN, 'erase_folder'))
+        thread.start()
+        started.wait()
+        self.assertTrue(self.navigator.busy())
+        self.assertFalse(self.navigator.handle(navigation.LEFT,
+                                               blocking=False))
+        refreshes = []
+        self.assertFalse(self.navigator.exclusive(refreshes.append, 1,
+                                                  blocking=False))
+        release.set()
+        thread.join()
+        self.assertEqual(self.navigator.state, navigation.ERROR)
+        self.assertNotIn('moveForward', self.target.calls)
+        self.assertTrue(self.navigator.exclusive(refreshes.append, 2,
+                                                 blocking=False))
+        self.assertEqual(refreshes, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
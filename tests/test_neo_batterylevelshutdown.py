@@ -4,9 +4,19 @@
 """Tests for `neo_batterylevelshutdown` package."""
 
 
+import importlib
+import pkgutil
+import time
 import unittest
 from click.testing import CliRunner
 
+import neo_batterylevelshutdown
+from neo_batterylevelshutdown.cli import StartupTimer
+
+# Libraries that the pages need on the device but that may not be
+#  installed where the tests run
+PAGE_DEPENDENCIES = ('axp209', 'psutil', 'PIL', 'luma')
+
 
 class TestNeo_batterylevelshutdown(unittest.TestCase):
     """Tests for `neo_batterylevelshutdown` package."""
@@ -20,3 +30,44 @@ class TestNeo_batterylevelshutdown(unittest.TestCase):
     def test_first_test(self):
         """Test something."""
         self.assertTrue(True)
+
+    def test_page_modules_import(self):
+        """The display imports every page, so one bad import blanks it."""
+        missing = [name for name in PAGE_DEPENDENCIES
+                   if importlib.util.find_spec(name) is None]
+        pages = [info.name for info in
+                 pkgutil.iter_modules(neo_batterylevelshutdown.__path__)
+                 if info.name.startswith('page_')]
+        self.assertTrue(pages)
+        for name in pages:
+            with self.subTest(page=name):
+                try:
+                    importlib.import_module('neo_batterylevelshutdown.' + name)
+                except ImportError as e:
+                    if e.name in missing:
+                        self.skipTest("%s isn't installed" % e.name)
+                    raise
+                except SystemExit:
+                    # Pages that need psutil exit without it
+                    if 'psutil' in missing:
+                        self.skipTest("psutil isn't installed")
+                    raise
+
+    def test_startup_timer_reports_each_stage(self):
+        timer = StartupTimer(time.monotonic())
+        timer.mark('hardware')
+        timer.mark('display')
+        self.assertEqual([stage for stage, _ in timer.stages],
+                         ['hardware', 'display'])
+        self.assertTrue(all(secs >= 0 for _, secs in timer.stages))
+        with self.assertLogs(level='DEBUG') as logs:
+            timer.report()
+        self.assertEqual([line.split()[1] for line in logs.output],
+                         ['hardware', 'display', 'elapsed'])
+        self.assertTrue(all(line.endswith('s') for line in logs.output))
+        # Each stage is only reported once
+        self.assertEqual(timer.stages, [])
+        timer.mark('main loop')
+        with self.assertLogs(level='DEBUG') as logs:
+            timer.report()
+        self.assertEqual(len(logs.output), 2)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.page_history`."""
+
+
+import types
+import unittest
+
+from neo_batterylevelshutdown import framebuffer
+from neo_batterylevelshutdown.metrics import NAN, MetricsStore
+from neo_batterylevelshutdown.page_history import PageHistory, downsample
+
+
+class TestDownsample(unittest.TestCase):
+    """Reducing a series to plot columns."""
+
+    def test_keeps_spikes(self):
+        self.assertEqual(downsample([1, 9, 2, 3, 0, 4], 3),
+                         [(1, 9), (2, 3), (0, 4)])
+
+    def test_stretches_short_series(self):
+        self.assertEqual(downsample([1, 2], 4), [(1, 1), (1, 1), (2, 2),
+                                                 (2, 2)])
+
+    def test_nan_is_ignored(self):
+        self.assertEqual(downsample([NAN, 5, 3, NAN, NAN, NAN], 3),
+                         [(5, 5), (3, 3), None])
+
+    def test_empty_series(self):
+        self.assertEqual(downsample([], 2), [None, None])
+
+
+class TestPageHistory(unittest.TestCase):
+    """Sparklines of the metrics history."""
+
+    def test_sparkline_columns_span_min_to_max(self):
+        device = types.SimpleNamespace(width=PageHistory.PLOT_LEFT + 3,
+                                       height=16)
+        page = PageHistory(device, MetricsStore(), 'battery', 'Battery %')
+        frame = framebuffer.blank(device)
+        # No font is needed when there's data
+        page.draw_sparkline(frame, None, [0, 10, NAN, NAN, 5, 5], 0, 10)
+        # Drawn in black on white
+        drawn = [[y for y in range(device.height)
+                  if not frame.getpixel(x, y)]
+                 for x in range(PageHistory.PLOT_LEFT, device.width)]
+        self.assertEqual(drawn[0], list(range(11)))
+        self.assertEqual(drawn[1], [])
+        self.assertEqual(drawn[2], [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
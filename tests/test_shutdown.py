@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.shutdown`."""
+
+
+import threading
+import unittest
+
+from neo_batterylevelshutdown import hardware, shutdown
+from neo_batterylevelshutdown.simulator import (
+    Scenario, SimulatedBackend, SimulationFinished)
+
+
+class TestShutdown(unittest.TestCase):
+    """Prioritised hooks with deadlines, then poweroff."""
+
+    def setUp(self):
+        self.backend = SimulatedBackend(Scenario())
+        hardware.use_backend(self.backend)
+        shutdown._reset()
+        self.ran = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        for name in ('first', 'second', 'stuck'):
+            shutdown.removeHook(name)
+        shutdown._reset()
+        hardware.use_backend(None)
+
+    def test_hooks_run_in_order_then_poweroff(self):
+        shutdown.addHook('second', lambda: self.ran.append('second'),
+                         priority=20)
+        shutdown.addHook('stuck', self.release.wait, priority=15,
+                         deadlineSecs=0.05)
+        shutdown.addHook('first', lambda: self.ran.append('first'),
+                         priority=10)
+        with self.assertLogs(level='INFO') as logs:
+            self.assertRaises(SimulationFinished, shutdown.shutdown, 3, 'test')
+        self.assertEqual(self.ran, ['first', 'second'])
+        self.assertIsNotNone(self.backend.shutdownTime)
+        self.assertTrue(any('stuck abandoned' in line for line in logs.output))
+        self.assertTrue(any('of the 3.0s grace period' in line
+                            for line in logs.output))
+
+    def test_only_first_shutdown_runs(self):
+        shutdown.addHook('first', lambda: self.ran.append('first'))
+        self.assertRaises(SimulationFinished, shutdown.shutdown)
+        shutdown.shutdown()
+        self.assertEqual(self.ran, ['first'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.simulator`."""
+
+
+import unittest
+
+from neo_batterylevelshutdown import hardware, hats, interrupts
+from neo_batterylevelshutdown.hardware import clock
+from neo_batterylevelshutdown.simulator import (
+    DAY_SECS, BatteryModel, Scenario, SimulatedDisplay, simulate)
+
+
+class TestSimulator(unittest.TestCase):
+    """Replay scenarios through the HAT main loops off-device."""
+
+    def tearDown(self):
+        hardware.use_backend(None)
+
+    def test_shutdown_when_battery_exhausted(self):
+        scenario = Scenario(
+            durationSecs=DAY_SECS,
+            battery=BatteryModel(dischargeCurve=((0, 50), (DAY_SECS / 2, 0))))
+        result = simulate(hats.q4y2018HAT, scenario)
+        self.assertIsNotNone(result.shutdownTime)
+        self.assertLess(result.shutdownTime, DAY_SECS / 2)
+        self.assertGreater(result.i2cTransactions, 0)
+
+    def test_button_press_moves_page(self):
+        scenario = Scenario(durationSecs=600)
+        scenario.pressButton(60, hats.q4y2018HAT.PIN_L_BUTTON)
+        result = simulate(hats.q4y2018HAT, scenario)
+        self.assertIsNone(result.shutdownTime)
+        self.assertEqual(result.callbacks, 1)
+        self.assertGreaterEqual(result.virtualSecs, 600)
+
+    def test_display_dims_before_blanking(self):
+        displays = []
+
+        def recordingDisplay(*args):
+            displays.append(SimulatedDisplay(*args))
+            return displays[-1]
+
+        scenario = Scenario(durationSecs=120)
+        scenario.pressButton(30, hats.q4y2018HAT.PIN_L_BUTTON)
+        simulate(hats.q4y2018HAT, scenario, recordingDisplay)
+        calls = [call for call in displays[0].calls if call in
+                 ('moveForward', 'setContrast', 'powerOffDisplay')]
+        self.assertEqual(calls, ['powerOffDisplay', 'moveForward',
+                                 'setContrast', 'setContrast',
+                                 'powerOffDisplay'])
+
+    def test_axp_interrupt_line_shuts_down(self):
+        scenario = Scenario(durationSecs=600)
+        scenario.axpInterrupt(120, interrupts.LEVEL2)
+        result = simulate(hats.q4y2018HAT, scenario)
+        self.assertAlmostEqual(result.shutdownTime, 120, delta=1)
+
+    def test_spurious_interrupt_line_edge_is_ignored(self):
+        scenario = Scenario(durationSecs=600)
+        scenario.pulseLine(120, hats.q4y2018HAT.PIN_AXP_INTERRUPT_LINE)
+        result = simulate(hats.q4y2018HAT, scenario)
+        self.assertIsNone(result.shutdownTime)
+
+    def test_charger_plug_checks_battery_promptly(self):
+        checks = []
+
+        class RecordingHAT(hats.q3y2018HAT):
+            def checkBattery(self):
+                checks.append(clock.time())
+                super().checkBattery()
+
+        # q3y2018 has no interrupt line, so the status is polled
+        scenario = Scenario(
+            durationSecs=1000,
+            battery=BatteryModel(chargingPeriods=((500, 2000),)))
+        simulate(RecordingHAT, scenario)
+        self.assertTrue(any(500 <= at <= 506 for at in checks), checks)
+
+
+if __name__ == '__main__':
+    unittest.main()
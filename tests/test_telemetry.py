@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.telemetry`."""
+
+
+import unittest
+
+from neo_batterylevelshutdown import telemetry
+
+
+class TestProfiling(unittest.TestCase):
+    """Hot-path timing is only recorded when profiling is enabled."""
+
+    def tearDown(self):
+        telemetry.enableProfiling(False)
+
+    def test_disabled_records_nothing(self):
+        with telemetry.timed('test_disabled'):
+            pass
+        self.assertNotIn(
+            telemetry.PROFILE_PREFIX + 'test_disabled_seconds',
+            [metric.name for metric in telemetry.registered()])
+
+    def test_enabled_records_histogram(self):
+        telemetry.enableProfiling()
+        for _ in range(3):
+            with telemetry.timed('test_enabled'):
+                pass
+        metric = telemetry.histogram(
+            telemetry.PROFILE_PREFIX + 'test_enabled_seconds', '')
+        self.assertEqual(metric.count, 3)
+        self.assertEqual(metric.quantile(0.5), telemetry.PROFILE_BUCKETS[0])
+        with self.assertLogs(level='INFO') as logs:
+            telemetry.dumpProfile()
+        self.assertTrue(any('test_enabled' in line for line in logs.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.throttle`."""
+
+
+import threading
+import unittest
+
+from neo_batterylevelshutdown import hardware, throttle
+from neo_batterylevelshutdown.hardware import clock
+from neo_batterylevelshutdown.simulator import Scenario, SimulatedBackend
+
+
+class TestCopyThrottle(unittest.TestCase):
+    """Pacing copies and backing off as the Wi-Fi gets busy."""
+
+    def setUp(self):
+        self.scenario = Scenario()
+        hardware.use_backend(SimulatedBackend(self.scenario))
+
+    def tearDown(self):
+        hardware.use_backend(None)
+
+    def test_paces_bytes_and_operations(self):
+        copyThrottle = throttle.CopyThrottle(1000)
+        start = clock.monotonic()
+        for _ in range(5):
+            copyThrottle.pace(1000)
+        # A second's worth up front, then the rate
+        self.assertAlmostEqual(clock.monotonic() - start, 4)
+        copyThrottle = throttle.CopyThrottle(0, maxOpsPerSec=10)
+        self.assertEqual(copyThrottle.rateLimit, 0)
+        start = clock.monotonic()
+        for _ in range(10):
+            copyThrottle.pace(1 << 20)
+        self.assertAlmostEqual(clock.monotonic() - start, 1)
+
+    def test_abort_cuts_waits_short(self):
+        abort = threading.Event()
+        copyThrottle = throttle.CopyThrottle(1000, abort=abort)
+        copyThrottle.pace(1000)
+        abort.set()
+        start = clock.monotonic()
+        copyThrottle.pace(100000)
+        self.assertEqual(clock.monotonic(), start)
+
+    def test_backs_off_as_users_and_traffic_rise(self):
+        copyThrottle = throttle.CopyThrottle(800000, 100000)
+        limits = []
+        copyThrottle.listener = limits.append
+        copyThrottle.adapt(1, (0, 0), 0)
+        self.assertEqual(copyThrottle.rateLimit, 800000)
+        # Another station
+        copyThrottle.adapt(2, (0, 0), 2)
+        self.assertEqual(copyThrottle.rateLimit, 400000)
+        # Busier, then the same
+        copyThrottle.adapt(2, (100000, 100000), 4)
+        self.assertEqual(copyThrottle.rateLimit, 200000)
+        copyThrottle.adapt(2, (210000, 190000), 6)
+        self.assertEqual(copyThrottle.rateLimit, 200000)
+        copyThrottle.adapt(3, (210000, 190000), 8)
+        copyThrottle.adapt(4, (210000, 190000), 10)
+        self.assertEqual(copyThrottle.rateLimit, 100000)
+        # Quiet again, so it climbs back
+        copyThrottle.adapt(0, (210000, 190000), 12)
+        self.assertEqual(copyThrottle.rateLimit, 200000)
+        # Told of each change
+        self.assertEqual(limits, [400000, 200000, 100000, 200000])
+
+    def test_samples_sensors_while_pacing(self):
+        self.scenario.setUsers(5, 3)
+        copyThrottle = throttle.CopyThrottle(100000, sampleSecs=2)
+        for _ in range(10):
+            copyThrottle.pace(100000)
+        self.assertLess(copyThrottle.rateLimit, 100000)
+
+
+class TestIdleIO(unittest.TestCase):
+    """The copying thread's I/O priority."""
+
+    def test_only_this_thread_is_idle_for_the_duration(self):
+        if throttle.ioPriority() is None:
+            self.skipTest("no ioprio syscalls here")
+        mainPriority = throttle.ioPriority()
+        idle = threading.Event()
+        done = threading.Event()
+        seen = []
+
+        def copy():
+            before = throttle.ioPriority()
+            with throttle.idleIO():
+                seen.append(throttle.ioPriority() >>
+                            throttle.IOPRIO_CLASS_SHIFT)
+                idle.set()
+                done.wait(5)
+            seen.append(throttle.ioPriority() == before)
+
+        thread = threading.Thread(target=copy)
+        thread.start()
+        self.assertTrue(idle.wait(5))
+        self.assertEqual(throttle.ioPriority(), mainPriority)
+        done.set()
+        thread.join()
+        self.assertEqual(seen, [throttle.IOPRIO_CLASS_IDLE, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
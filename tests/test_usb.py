@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `neo_batterylevelshutdown.usb` and `copyplan`."""
+
+
+import os
+import tempfile
+import unittest
+
+from neo_batterylevelshutdown import config, copyplan, hardware, usb
+from neo_batterylevelshutdown.dedup import DedupStore
+from neo_batterylevelshutdown.simulator import Scenario, SimulatedBackend
+from neo_batterylevelshutdown.throttle import CopyThrottle
+from neo_batterylevelshutdown.usb import USB
+
+
+class TestCopyPlan(unittest.TestCase):
+    """Planning and copying from a USB stick."""
+
+    def setUp(self):
+        # Throttled copies are paced by the clock
+        hardware.use_backend(SimulatedBackend(Scenario()))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'usb')
+        self.dest = os.path.join(self.tmp.name, 'content')
+        os.makedirs(os.path.join(self.source, 'videos', 'empty'))
+        os.mkdir(self.dest)
+        self.write(self.source, 'a.txt', 10)
+        self.write(self.source, 'videos/b.mp4', 5000)
+        stat = os.statvfs(self.dest)
+        self.blockSize = stat.f_frsize or stat.f_bsize
+
+    def tearDown(self):
+        hardware.use_backend(None)
+        config.use(config.DEFAULTS)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def write(root, name, size):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def leaveFree(self, bytesFree):
+        """Make the cushion leave about bytesFree for the copy"""
+        # Checked each time, as the stick's files take space here too
+        free = os.statvfs(self.dest).f_bavail * self.blockSize
+        config.use(config.current()._replace(
+            freeSpaceCushionBytes=free - bytesFree))
+
+    def test_blocks_inodes_and_folders(self):
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        self.assertEqual(plan.dirs, [os.path.join(self.dest, 'videos'),
+                                     os.path.join(self.dest, 'videos',
+                                                  'empty')])
+        self.assertEqual([os.path.relpath(planned.dest, self.dest)
+                          for planned in plan.files],
+                         ['a.txt', os.path.join('videos', 'b.mp4')])
+        # Each file and folder is rounded up to whole blocks
+        rounded = -(-5000 // self.blockSize) * self.blockSize
+        self.assertEqual(plan.bytesNeeded,
+                         self.blockSize * 3 + rounded)
+        self.assertEqual(plan.inodesNeeded, 4)
+
+    def test_overwritten_files_give_back_their_blocks(self):
+        self.write(self.dest, 'a.txt', 10)
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        self.assertEqual(plan.inodesNeeded, 3)
+        self.assertLessEqual(plan.bytesNeeded,
+                             self.blockSize * 2 + 5000 + self.blockSize)
+
+    def test_hard_linked_files_are_replaced_not_overwritten(self):
+        self.write(self.dest, 'a.txt', 20)
+        os.link(os.path.join(self.dest, 'a.txt'),
+                os.path.join(self.tmp.name, 'other.txt'))
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        # Another link keeps a.txt's blocks and inode in use
+        self.assertEqual(plan.inodesNeeded, 4)
+        for throttle in (None, CopyThrottle(10 ** 9)):
+            with self.subTest(throttle=throttle):
+                USB().copyTree(self.source, self.dest, throttle=throttle)
+                self.assertEqual(
+                    os.path.getsize(os.path.join(self.dest, 'a.txt')), 10)
+                self.assertEqual(os.path.getsize(
+                    os.path.join(self.tmp.name, 'other.txt')), 20)
+
+    def test_refuses_or_partially_copies(self):
+        usb = USB()
+        needed = copyplan.plan(self.source, self.dest,
+                               limited=False).bytesNeeded
+        self.leaveFree(needed)
+        self.assertTrue(usb.checkSpace(self.source, self.dest))
+        self.leaveFree(needed - 1)
+        self.assertFalse(usb.checkSpace(self.source, self.dest))
+        self.assertEqual(len(usb.plan.files), 1)
+        config.use(config.current()._replace(copyPartial=1))
+        self.assertTrue(usb.checkSpace(self.source, self.dest))
+        self.assertTrue(usb.copyFiles(self.source, self.dest))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['a.txt', 'videos'])
+        self.assertEqual(os.listdir(os.path.join(self.dest, 'videos')),
+                         ['empty'])
+
+    def test_throttled_copy_reports_its_rate_limit(self):
+        limits = []
+        self.assertTrue(USB().copyFiles(self.source, self.dest,
+                                        rateListener=limits.append))
+        # Not throttled
+        self.assertEqual(limits, [])
+        config.use(config.DEFAULTS._replace(copyMaxBytesPerSec=10 ** 9))
+        self.assertTrue(USB().copyFiles(self.source, self.dest,
+                                        rateListener=limits.append))
+        self.assertEqual(limits, [10 ** 9])
+
+    def test_failed_copy_is_logged(self):
+        # A file where a folder is to be copied
+        self.write(self.dest, 'videos', 10)
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertFalse(USB().copyFiles(self.source, self.dest))
+        self.assertIn('Traceback', logs.output[0])
+
+    def test_filters(self):
+        self.write(self.source, 'videos/c.tmp', 10)
+        os.mkdir(os.path.join(self.source, 'trash'))
+        self.write(self.source, 'trash/d.mp4', 10)
+        config.use(config.DEFAULTS._replace(copyExclude=('*.tmp', 'trash'),
+                                            copyMaxFileBytes=1000))
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        self.assertEqual([os.path.relpath(planned.source, self.source)
+                          for planned in plan.files], ['a.txt'])
+        # Empty folders are still copied without copyInclude
+        self.assertEqual(len(plan.dirs), 2)
+        config.use(config.DEFAULTS._replace(copyInclude=('*.mp4',)))
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        self.assertEqual([os.path.relpath(planned.source, self.source)
+                          for planned in plan.files],
+                         [os.path.join('trash', 'd.mp4'),
+                          os.path.join('videos', 'b.mp4')])
+        self.assertEqual(plan.dirs, [os.path.join(self.dest, 'trash'),
+                                     os.path.join(self.dest, 'videos')])
+
+    def test_folders_must_fit(self):
+        self.leaveFree(self.blockSize)
+        plan = copyplan.plan(self.source, self.dest)
+        self.assertEqual(plan.dirs, [os.path.join(self.dest, 'videos')])
+        self.assertEqual(plan.skippedDirs,
+                         [os.path.join(self.dest, 'videos', 'empty')])
+        self.assertEqual(plan.bytesNeeded, self.blockSize)
+        self.assertEqual(plan.files, [])
+        self.assertFalse(plan.complete)
+
+    def test_included_folders_are_planned_with_their_files(self):
+        self.write(self.source, 'videos/c.txt', 10)
+        config.use(config.DEFAULTS._replace(copyInclude=('*.txt', '*.mp4')))
+        self.leaveFree(self.blockSize * 3)
+        plan = copyplan.plan(self.source, self.dest)
+        # b.mp4 doesn't fit, but c.txt (and so its folder) does
+        self.assertEqual([os.path.relpath(planned.dest, self.dest)
+                          for planned in plan.files],
+                         ['a.txt', os.path.join('videos', 'c.txt')])
+        self.assertEqual(plan.dirs, [os.path.join(self.dest, 'videos')])
+        self.assertEqual(plan.bytesNeeded, self.blockSize * 3)
+        self.assertEqual(plan.inodesNeeded, 3)
+        self.leaveFree(self.blockSize)
+        plan = copyplan.plan(self.source, self.dest)
+        # Nothing fits in videos, so it isn't created
+        self.assertEqual(plan.dirs, [])
+        self.assertEqual(plan.inodesNeeded, 1)
+
+    def test_store_inodes(self):
+        self.write(self.source, 'videos/c.mp4', 5000)
+        store = DedupStore(os.path.join(self.tmp.name, 'store'))
+        plan = copyplan.plan(self.source, self.dest, store, limited=False)
+        # Two folders, and b.mp4's and c.mp4's content is stored once
+        if store.reflinks:
+            # Each file's inode, and each object's
+            self.assertEqual(plan.inodesNeeded, 2 + 3 + 2)
+        else:
+            # Files are hard links of their objects
+            self.assertEqual(plan.inodesNeeded, 2 + 2)
+
+    def test_priority_decides_what_fits(self):
+        config.use(config.DEFAULTS._replace(copyPriority=('videos/*',)))
+        plan = copyplan.plan(self.source, self.dest, limited=False)
+        self.assertEqual([os.path.basename(planned.source)
+                          for planned in plan.files], ['b.mp4', 'a.txt'])
+        self.leaveFree(plan.bytesNeeded - 1)
+        plan = copyplan.plan(self.source, self.dest)
+        self.assertEqual([os.path.basename(planned.source)
+                          for planned in plan.files], ['b.mp4'])
+
+    def test_aborted_copy_removes_the_partial_file(self):
+        self.addCleanup(USB.abortCopy.clear)
+        source = os.path.join(self.source, 'big.mp4')
+        dest = os.path.join(self.dest, 'big.mp4')
+        self.write(self.source, 'big.mp4', 3 * usb.COPY_CHUNK_SIZE)
+
+        class AbortingThrottle:
+            # Abort, as on shutdown, once the first chunk is written
+            @staticmethod
+            def pace(_):
+                USB.abortCopy.set()
+
+        self.assertFalse(USB.copyFile(source, dest, AbortingThrottle()))
+        self.assertFalse(os.path.exists(dest))
+        # Unthrottled copies stop too
+        self.assertFalse(USB.copyFile(source, dest))
+        self.assertFalse(os.path.exists(dest))
+        USB.abortCopy.clear()
+        self.assertTrue(USB.copyFile(source, dest))
+        self.assertEqual(os.path.getsize(dest), 3 * usb.COPY_CHUNK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()